@@ -7,12 +7,23 @@ setup(
     entry_points={
         'console_scripts': [
             "slurm-ec2-clusterconfig=slurmec2utils.clusterconfig:main",
+            "slurm-ec2-fetch=slurmec2utils.fetch:main",
+            "slurm-ec2-upload-watch=slurmec2utils.upload:main",
+            "slurm-ec2-setup-ephemeral=slurmec2utils.storage:main",
             "slurm-ec2-fallback-slurm-s3-root=slurmec2utils.clusterconfig:get_fallback_slurm_s3_root",
             "slurm-ec2-resume=slurmec2utils.powersave:start_node",
             "slurm-ec2-suspend=slurmec2utils.powersave:stop_node",
+            "slurm-ec2-reconcile=slurmec2utils.reconcile:main",
+            "slurm-ec2-inventory=slurmec2utils.inventory:main",
+            "slurm-ec2-resolver=slurmec2utils.hostsdb:main",
+            "slurm-ec2-config-sync=slurmec2utils.configsync:main",
+            "slurm-ec2-spot-watch=slurmec2utils.interruption:main",
+            "slurm-ec2-trace=slurmec2utils.trace:main",
             "slurm-ec2-run-tasks=slurmec2utils.task:run_tasks",
             "slurm-ec2-initialize-queue=slurmec2utils.task:initialize_queue",
             "slurm-ec2-submit-task=slurmec2utils.task:submit_task",
+            "slurm-ec2-submit-array=slurmec2utils.task:submit_array",
+            "slurm-ec2-cancel-tasks=slurmec2utils.task:cancel_tasks",
             "slurm-ec2-wait-tasks=slurmec2utils.task:wait_tasks",
         ],
     },
@@ -0,0 +1,488 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from json import dumps as json_dumps
+from os import killpg, makedirs, setsid
+from os.path import isdir, join as path_join
+from signal import SIGTERM
+from subprocess import Popen, STDOUT
+from sys import exit, stderr, stdout
+from threading import Condition, Lock, Thread
+from time import time
+
+"""
+Node bootstrap orchestration.
+
+slurm-ec2-bootstrap unpacks slurm-ec2-utils and runs this module from the
+unpacked tree to install and configure the node.  Each step is a shell
+command with the steps it requires; independent steps run concurrently.
+A step whose outputs already exist (its done check succeeds) is skipped,
+and the first failure cancels every running step and stops the bootstrap.
+
+This runs before boto (and slurm-ec2-utils itself) are installed, so it
+only uses the standard library.
+"""
+
+MUNGE_VERSION = "0.5.11-1.amzn1"
+SLURM_VERSION = "14.11.1-1.amzn1"
+
+# Each step's output goes to <log dir>/<step>.log.
+BOOTSTRAP_LOG_DIR = "/var/log/slurm-ec2-bootstrap"
+
+# Step timings are appended here in the format slurmec2utils.trace reads.
+# (That module needs boto, so the name isn't imported from it.)
+BOOTSTRAP_TRACE_FILENAME = "/var/log/slurm-ec2-bootstrap-trace.json"
+
+# Lines of a failed step's log to show.
+FAILURE_LOG_LINES = 20
+
+# Step states.
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+SKIPPED = "skipped"
+FAILED = "failed"
+CANCELLED = "cancelled"
+NOT_RUN = "not run"
+
+class BootstrapStep(object):
+    """
+    A bootstrap step: a bash command (run with -e -x) which may only start
+    once the steps named in requires have succeeded or been skipped.
+
+    If done is given, it's a bash command which succeeds when the step's
+    outputs already exist; the step is then skipped.
+    """
+
+    def __init__(self, name, command, requires=(), done=None):
+        self.name = name
+        self.command = command
+        self.requires = list(requires)
+        self.done = done
+        self.status = PENDING
+        self.returncode = None
+        self.start = None
+        self.end = None
+        self.process = None
+        self.reported = False
+        return
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return None
+        return (self.end if self.end is not None else time()) - self.start
+
+class BootstrapGraph(object):
+    """
+    Runs a set of BootstrapSteps in dependency order, starting each as
+    soon as its requirements are met.
+    """
+
+    def __init__(self, steps, log_dir=BOOTSTRAP_LOG_DIR,
+                 trace_filename=BOOTSTRAP_TRACE_FILENAME, run=None):
+        self.steps = list(steps)
+        self.by_name = dict((step.name, step) for step in self.steps)
+        self.log_dir = log_dir
+        self.trace_filename = trace_filename
+        self.run_id = run if run is not None else time()
+        self.failed = False
+        self._condition = Condition(Lock())
+        self._trace_lock = Lock()
+        self.validate()
+        return
+
+    def validate(self):
+        """
+        Raise ValueError if a step requires an unknown step or the steps
+        have a dependency cycle.
+        """
+        if len(self.by_name) != len(self.steps):
+            raise ValueError("Duplicate step names")
+
+        for step in self.steps:
+            for name in step.requires:
+                if name not in self.by_name:
+                    raise ValueError("Step %s requires unknown step %s" %
+                                     (step.name, name))
+
+        # Kahn's algorithm; anything left over is on a cycle.
+        remaining = dict((step.name, set(step.requires))
+                         for step in self.steps)
+        while remaining:
+            ready = [name for name, requires in remaining.items()
+                     if not requires]
+            if not ready:
+                raise ValueError("Dependency cycle among steps: %s" %
+                                 ", ".join(sorted(remaining)))
+            for name in ready:
+                del remaining[name]
+            for requires in remaining.values():
+                requires.difference_update(ready)
+        return
+
+    def get_ready(self):
+        """
+        Returns the pending steps whose requirements are all met.
+        """
+        return [step for step in self.steps
+                if step.status == PENDING and all(
+                    self.by_name[name].status in (SUCCEEDED, SKIPPED)
+                    for name in step.requires)]
+
+    def log(self, message):
+        print("[%7.1fs] %s" % (time() - self.run_id, message))
+        stdout.flush()
+        return
+
+    def trace(self, step):
+        record = {"run": self.run_id, "phase": step.name,
+                  "start": step.start, "end": step.end,
+                  "status": step.returncode}
+        if step.status == SKIPPED:
+            record["skipped"] = True
+        try:
+            with self._trace_lock:
+                with open(self.trace_filename, "a") as fd:
+                    fd.write(json_dumps(record) + "\n")
+        except IOError as e:
+            print("Unable to write %s: %s" % (self.trace_filename, e),
+                  file=stderr)
+        return
+
+    def _call(self, step, command, log_fd):
+        with self._condition:
+            if self.failed:
+                return None
+            # Each step gets its own process group so it can be cancelled
+            # along with its children.
+            step.process = Popen(["/bin/bash", "-e", "-x", "-c", command],
+                                 stdout=log_fd, stderr=STDOUT,
+                                 preexec_fn=setsid, close_fds=True)
+        return step.process.wait()
+
+    def _run_step(self, step):
+        log_filename = path_join(self.log_dir, step.name + ".log")
+        step.start = time()
+        try:
+            with open(log_filename, "a") as log_fd:
+                if (step.done is not None and
+                    self._call(step, step.done, log_fd) == 0):
+                    status = SKIPPED
+                    step.returncode = 0
+                else:
+                    step.returncode = self._call(step, step.command, log_fd)
+                    status = SUCCEEDED if step.returncode == 0 else FAILED
+        except (IOError, OSError) as e:
+            print("Unable to run step %s: %s" % (step.name, e), file=stderr)
+            step.returncode = 127
+            status = FAILED
+        step.end = time()
+
+        with self._condition:
+            if step.returncode is None or (status == FAILED and self.failed):
+                # Killed (or never started) because another step failed.
+                status = CANCELLED
+            step.status = status
+            step.process = None
+            if step.returncode is not None:
+                self.trace(step)
+            self._condition.notify_all()
+
+        if status == FAILED:
+            self.show_failure(step, log_filename)
+        return
+
+    def show_failure(self, step, log_filename):
+        print("Step %s failed with status %s; the end of %s:" % (
+            step.name, step.returncode, log_filename), file=stderr)
+        try:
+            with open(log_filename, "r") as fd:
+                lines = fd.readlines()[-FAILURE_LOG_LINES:]
+        except IOError:
+            lines = []
+        for line in lines:
+            print("    " + line.rstrip(), file=stderr)
+        return
+
+    def cancel_running(self):
+        """
+        Terminate every running step.  Must be called with the condition
+        held.
+        """
+        for step in self.steps:
+            if step.status == RUNNING and step.process is not None:
+                try:
+                    killpg(step.process.pid, SIGTERM)
+                except OSError:
+                    pass
+        return
+
+    def run(self):
+        """
+        Run the steps.  Returns True if every step succeeded or was skipped.
+        """
+        if not isdir(self.log_dir):
+            makedirs(self.log_dir)
+
+        with self._condition:
+            while True:
+                for step in (self.get_ready() if not self.failed else []):
+                    step.status = RUNNING
+                    self.log("%s: started" % step.name)
+                    thread = Thread(target=self._run_step, args=(step,),
+                                    name=step.name)
+                    thread.daemon = True
+                    thread.start()
+
+                running = [step for step in self.steps
+                           if step.status == RUNNING]
+                if not running:
+                    break
+
+                # Condition.wait() without a timeout can't be interrupted.
+                self._condition.wait(1.0)
+
+                for step in self.steps:
+                    if step.status in (PENDING, RUNNING):
+                        continue
+                    if step.reported:
+                        continue
+                    step.reported = True
+                    self.log("%s: %s (%.1fs)" % (step.name, step.status,
+                                                 step.duration))
+                    if step.status == FAILED and not self.failed:
+                        # Fail fast.
+                        self.failed = True
+                        self.cancel_running()
+
+        for step in self.steps:
+            if step.status == PENDING:
+                step.status = NOT_RUN
+
+        return all(step.status in (SUCCEEDED, SKIPPED)
+                   for step in self.steps)
+
+    def print_summary(self):
+        print("%-20s %-10s %9s" % ("step", "status", "seconds"))
+        for step in sorted(self.steps,
+                           key=lambda s: (s.start is None, s.start)):
+            duration = step.duration
+            print("%-20s %-10s %9s" % (
+                step.name, step.status,
+                "%.1f" % duration if duration is not None else "-"))
+        return
+
+def get_bootstrap_steps(region, slurm_s3_root, utils_dir, ccargs="",
+                        arch="x86_64"):
+    """
+    get_bootstrap_steps(region, slurm_s3_root, utils_dir, ccargs="",
+                        arch="x86_64") -> [BootstrapStep]
+
+    Returns the steps for bootstrapping a node.  utils_dir is the unpacked
+    slurm-ec2-utils tree; ccargs are extra (shell-quoted) arguments to
+    slurm-ec2-clusterconfig when creating /etc/slurm-ec2.conf.
+    """
+    munge_rpm = "munge-%s.%s.rpm" % (MUNGE_VERSION, arch)
+    slurm_rpm = "slurm-%s.%s.rpm" % (SLURM_VERSION, arch)
+    params = {
+        "region": region,
+        "slurm_s3_root": slurm_s3_root,
+        "utils_dir": utils_dir,
+        "ccargs": ccargs,
+        "munge_rpm": munge_rpm,
+        "slurm_rpm": slurm_rpm,
+        "os_packages": ("glib2 hwloc jq lua openmpi openssl patch python27 "
+                        "python27-pip readline rrdtool"),
+    }
+
+    def step(name, command, requires=(), done=None):
+        return BootstrapStep(
+            name, command % params, requires,
+            done % params if done is not None else None)
+
+    return [
+        # yum and rpm can't run concurrently (they share the RPM database
+        # lock), so the package steps form a chain.
+        step("os-update", "yum -y update"),
+        step("os-packages", "yum -y install %(os_packages)s",
+             requires=["os-update"],
+             done="rpm --query %(os_packages)s"),
+        # pip-2.7 is installed by slurm-ec2-bootstrap, so this (and the
+        # steps which only need Python) runs alongside the yum steps.
+        step("python-packages", "pip-2.7 install boto netaddr",
+             done="python2.7 -c 'import boto, netaddr'"),
+        step("download-rpms", """\
+for rpm in %(munge_rpm)s %(slurm_rpm)s; do
+    if [[ ! -r /tmp/$rpm ]]; then
+        aws s3 cp "%(slurm_s3_root)s/packages/$rpm" /tmp/$rpm.tmp;
+        mv /tmp/$rpm.tmp /tmp/$rpm;
+    fi;
+done""",
+             done="rpm --query munge slurm"),
+        step("install-rpms", """\
+for package in munge slurm; do
+    if ! rpm --query $package; then
+        rpm --install /tmp/$package-*.rpm;
+    fi;
+done
+rm -f /tmp/%(munge_rpm)s /tmp/%(slurm_rpm)s""",
+             requires=["os-packages", "download-rpms"],
+             done="rpm --query munge slurm"),
+        step("set-hostname", """\
+aws s3 cp "%(slurm_s3_root)s/packages/slurm-ec2-set-hostname" \\
+    /etc/init.d/slurm-ec2-set-hostname
+chmod 755 /etc/init.d/slurm-ec2-set-hostname
+chkconfig --add slurm-ec2-set-hostname
+service slurm-ec2-set-hostname start"""),
+        # Always reinstalled: the tarball may change without a version bump.
+        step("slurm-ec2-utils", """\
+cd "%(utils_dir)s"
+python2.7 ./setup.py build
+python2.7 ./setup.py install""",
+             requires=["python-packages"]),
+        # Striping the ephemeral stores isn't essential to the node.  It
+        # runs from the unpacked tree so it doesn't wait for the install.
+        step("ephemeral-storage", """\
+cd "%(utils_dir)s"
+if ! python2.7 -m slurmec2utils.storage; then
+    echo "Unable to set up ephemeral storage" 1>&2;
+fi""",
+             requires=["python-packages"],
+             done="mountpoint -q /ephemeral"),
+        step("slurm-ec2-conf", """\
+slurm-ec2-clusterconfig --region "%(region)s" \\
+    --slurm-s3-root "%(slurm_s3_root)s" \\
+    %(ccargs)s \\
+    --write-slurm-ec2-config /etc/slurm-ec2.conf""",
+             requires=["slurm-ec2-utils"],
+             done="test -r /etc/slurm-ec2.conf"),
+        # Create /etc/hosts (controllers only), the compute node hosts
+        # database and /etc/slurm.conf
+        step("slurm-config", """\
+slurm-ec2-clusterconfig --config /etc/slurm-ec2.conf \\
+    --write-controller-hosts /etc/hosts \\
+    --write-hosts-db /etc/slurm-ec2-hosts.db \\
+    --write-slurm-config /etc/slurm.conf""",
+             requires=["slurm-ec2-conf"]),
+        # Resolve compute node names through slurm-ec2-resolver on localhost
+        # instead of listing every node in /etc/hosts.
+        step("resolver", """\
+aws s3 cp "%(slurm_s3_root)s/packages/slurm-ec2-resolver" \\
+    /etc/init.d/slurm-ec2-resolver
+chmod 755 /etc/init.d/slurm-ec2-resolver
+chkconfig --add slurm-ec2-resolver
+if service slurm-ec2-resolver start; then
+    # Keep the resolver first across DHCP lease renewals.
+    if ! grep -q "prepend domain-name-servers 127.0.0.1" \\
+        /etc/dhcp/dhclient.conf 2> /dev/null; then
+        echo "prepend domain-name-servers 127.0.0.1;" >> \\
+            /etc/dhcp/dhclient.conf;
+    fi;
+    if ! grep -q "^nameserver 127.0.0.1" /etc/resolv.conf; then
+        sed -i -e '0,/^nameserver/s//nameserver 127.0.0.1\\nnameserver/' \\
+            /etc/resolv.conf;
+    fi;
+else
+    # Fall back to listing every node in /etc/hosts.
+    chkconfig --del slurm-ec2-resolver;
+    rm -f /etc/slurm-ec2-hosts.db;
+    slurm-ec2-clusterconfig --config /etc/slurm-ec2.conf \\
+        --write-hosts /etc/hosts;
+fi""",
+             requires=["slurm-config"]),
+        step("munge-key", """\
+mkdir -p /etc/munge
+# Try to download it; if it doesn't exist, create it and upload it.
+if ! aws s3 cp "%(slurm_s3_root)s/etc/munge.key" /etc/munge/munge.key; then
+    dd if=/dev/urandom bs=1024 count=1 of=/etc/munge/munge.key;
+    aws s3 cp /etc/munge/munge.key "%(slurm_s3_root)s/etc/munge.key";
+fi
+chown -R munge:munge /etc/munge
+chmod 600 /etc/munge/munge.key""",
+             requires=["install-rpms"],
+             done="test -r /etc/munge/munge.key"),
+        # slurm-ec2-clusterconfig may already have created state files in
+        # /var/slurm as root (e.g. for --address-ordering spot-price).
+        step("slurm-dirs", """\
+if [[ ! -d /var/log/slurm ]]; then
+    mkdir -p /var/log/slurm;
+    chown slurm:slurm /var/log/slurm;
+fi
+mkdir -p /var/slurm
+chown -R slurm:slurm /var/slurm""",
+             requires=["install-rpms", "slurm-config"]),
+        step("start-services", """\
+service munge start
+service slurm start""",
+             requires=["munge-key", "slurm-dirs", "resolver", "set-hostname",
+                       "ephemeral-storage"]),
+        # On the controller, reconcile spot requests and orphaned instances
+        # (as the SLURM user since it shares state with slurm-ec2-resume),
+        # and pick up configuration changes published with
+        # slurm-ec2-config-sync --publish.
+        step("background-services", """\
+su slurm -s /bin/sh -c "nohup slurm-ec2-reconcile --controller-only \\
+    >> /var/log/slurm/slurm-ec2-reconcile.log 2>&1 &"
+nohup slurm-ec2-config-sync >> /var/log/slurm-ec2-config-sync.log 2>&1 \\
+    < /dev/null &""",
+             requires=["start-services"]),
+    ]
+
+def main():
+    from argparse import ArgumentParser
+    from platform import machine
+
+    parser = ArgumentParser(
+        description=("Install and configure SLURM on this node, running "
+                     "independent steps concurrently."))
+    parser.add_argument(
+        "--region", "-r", required=True,
+        help="The AWS region of this node.")
+    parser.add_argument(
+        "--slurm-s3-root", "-S", required=True,
+        help="The SLURM S3 root holding the packages and configuration.")
+    parser.add_argument(
+        "--utils-dir", "-u", required=True,
+        help="The unpacked slurm-ec2-utils source tree.")
+    parser.add_argument(
+        "--clusterconfig-args", default="",
+        help=("Extra (shell-quoted) arguments to slurm-ec2-clusterconfig "
+              "when creating /etc/slurm-ec2.conf."))
+    parser.add_argument(
+        "--log-dir", default=BOOTSTRAP_LOG_DIR,
+        help=("Where to write each step's output.  Defaults to %s." %
+              BOOTSTRAP_LOG_DIR))
+    parser.add_argument(
+        "--trace", default=BOOTSTRAP_TRACE_FILENAME,
+        help=("Where to append step timings.  Defaults to %s." %
+              BOOTSTRAP_TRACE_FILENAME))
+    parser.add_argument(
+        "--run", type=float,
+        help=("The bootstrap run's start time, for the trace.  Defaults to "
+              "now."))
+    parser.add_argument(
+        "--list", "-l", action="store_true", default=False,
+        help="List the steps and their requirements and exit.")
+    args = parser.parse_args()
+
+    steps = get_bootstrap_steps(args.region, args.slurm_s3_root,
+                                args.utils_dir, args.clusterconfig_args,
+                                machine())
+    try:
+        graph = BootstrapGraph(steps, log_dir=args.log_dir,
+                               trace_filename=args.trace, run=args.run)
+    except ValueError as e:
+        print(str(e), file=stderr)
+        return 1
+
+    if args.list:
+        for step in steps:
+            print("%s: %s" % (step.name, " ".join(step.requires)))
+        return 0
+
+    result = graph.run()
+    graph.print_summary()
+    return 0 if result else 1
+
+if __name__ == "__main__":
+    exit(main())
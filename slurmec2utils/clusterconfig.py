@@ -1,14 +1,20 @@
 #!/usr/bin/python
 from __future__ import absolute_import, print_function
+from .fetch import parse_s3_url
+from .hostsdb import build_hosts_db
 from .instanceinfo import get_instance_id, get_instance, get_region, get_vpc_id
-import boto.ec2
-import boto.vpc
+from .ordering import get_subnet_weights, interleave_addresses
+import boto.s3
 from boto.vpc.subnet import Subnet
 from ConfigParser import DEFAULTSECT, RawConfigParser
 try: from cStringIO import StringIO
 except ImportError: from StringIO import StringIO
+from hashlib import sha256
 from math import floor, log10
 from netaddr import IPAddress, IPNetwork
+from os import chmod, getpid, rename, stat
+from .ratelimit import connect_ec2, connect_vpc
+from stat import S_IMODE
 from sys import argv, exit, stderr, stdout
 from types import NoneType
 
@@ -21,7 +27,7 @@ def get_fallback_slurm_s3_root(region=None):
     if region is None:
         region = get_region()
     instance_id = get_instance_id()
-    ec2 = boto.ec2.connect_to_region(region)
+    ec2 = connect_ec2(region)
     if ec2 is None:
         raise ValueError("Unable to connect to EC2 endpoint in region %r" %
                          (region,))
@@ -34,6 +40,359 @@ def get_fallback_slurm_s3_root(region=None):
     
     return tags[0].value
 
+def publish_slurm_ec2_configuration(slurm_s3_root, data, region=None):
+    """
+    publish_slurm_ec2_configuration(slurm_s3_root, data, region=None) -> url
+
+    Upload the given slurm-ec2.conf contents to
+    <slurm_s3_root>/etc/slurm-ec2.conf.d/<sha256>, where <sha256> is the hex
+    digest of the contents.  Since the object name is derived from the
+    contents, an existing object is never overwritten.
+    """
+    if region is None:
+        region = get_region()
+    digest = sha256(data).hexdigest()
+    bucket_name, prefix = parse_s3_url(slurm_s3_root)
+    key_name = "/".join(filter(None, [
+        prefix.strip("/"), "etc/slurm-ec2.conf.d", digest]))
+
+    s3 = boto.s3.connect_to_region(region)
+    if s3 is None:
+        raise ValueError("Unable to connect to S3 endpoint in region %r" %
+                         (region,))
+
+    bucket = s3.get_bucket(bucket_name, validate=False)
+    if bucket.get_key(key_name) is None:
+        key = bucket.new_key(key_name)
+        key.set_metadata("sha256", digest)
+        key.set_contents_from_string(data)
+
+    return "s3://%s/%s" % (bucket_name, key_name)
+
+def replace_file(filename, data):
+    """
+    replace_file(filename, data)
+
+    Atomically replace filename with data so readers never see a partially
+    written file.  The permissions of an existing file are preserved.
+    """
+    tmp_filename = "%s.tmp.%d" % (filename, getpid())
+    with open(tmp_filename, "wb") as fd:
+        fd.write(data)
+    try:
+        chmod(tmp_filename, S_IMODE(stat(filename).st_mode))
+    except OSError:
+        pass
+    rename(tmp_filename, filename)
+    return
+
+def expand_hostlist(hostlist):
+    """
+    expand_hostlist(hostlist) -> [hostname, ...]
+
+    Expand a SLURM hostlist expression such as "node-[0-3,7],gpu-1" into
+    individual hostnames.
+    """
+    # Split on commas which aren't inside brackets.
+    items = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(hostlist):
+        if c == "[":
+            depth += 1
+        elif c == "]":
+            depth -= 1
+        elif c == "," and depth == 0:
+            items.append(hostlist[start:i])
+            start = i + 1
+    items.append(hostlist[start:])
+
+    hostnames = []
+    for item in items:
+        item = item.strip()
+        if not item:
+            continue
+
+        if "[" not in item:
+            hostnames.append(item)
+            continue
+
+        prefix, rest = item.split("[", 1)
+        if "]" not in rest:
+            raise ValueError("Invalid hostlist %r" % (hostlist,))
+        ranges, suffix = rest.split("]", 1)
+
+        for range_spec in ranges.split(","):
+            if "-" in range_spec:
+                low, high = range_spec.split("-", 1)
+            else:
+                low = high = range_spec
+
+            # Preserve zero-padding, e.g. node-[001-010].
+            width = len(low) if low.startswith("0") else 0
+            for i in xrange(int(low), int(high) + 1):
+                hostnames.append("%s%0*d%s" % (prefix, width, i, suffix))
+
+    return hostnames
+
+class NodePool(object):
+    """
+    A named group of SLURM computation nodes which share an instance type
+    and launch settings.
+
+    Each pool is written to slurm.conf as its own NodeName and PartitionName
+    lines.  Pools take the cluster's node addresses in the order they are
+    configured; a pool pinned to subnets takes only addresses in those
+    subnets.
+
+    Settings which are None are inherited from the cluster's compute_*
+    settings.
+    """
+
+    # Keys which may appear in a [pool:<name>] section.
+    config_keys = ["instance_type", "ami", "bid_price", "spot_instance_types",
+                   "spot_timeout", "spot_fallback", "hostname_prefix",
+                   "max_nodes", "weight", "features", "default",
+                   "placement_group", "placement_fallback", "subnet_ids"]
+
+    # Prefix for pool section names in slurm-ec2.conf
+    section_prefix = "pool:"
+
+    def __init__(self, name, instance_type=None, ami=None, bid_price=None,
+                 spot_instance_types=None, spot_timeout=None,
+                 spot_fallback=None, hostname_prefix=None, max_nodes=None,
+                 weight=None, features=None, default=False,
+                 placement_group=None, placement_fallback=None,
+                 subnet_ids=None):
+        """
+        NodePool(name, instance_type=None, ami=None, bid_price=None,
+                 spot_instance_types=None, spot_timeout=None,
+                 spot_fallback=None, hostname_prefix=None, max_nodes=None,
+                 weight=None, features=None, default=False,
+                 placement_group=None, placement_fallback=None,
+                 subnet_ids=None)
+
+        Create a node pool.
+
+        instance_type, ami, bid_price, spot_instance_types, spot_timeout and
+        spot_fallback override the corresponding compute_* settings of the
+        cluster.  A bid_price of "ondemand" forces on-demand instances even
+        if the cluster has a bid price.
+
+        hostname_prefix is the hostname prefix for nodes in this pool.  If
+        None, this is "<name>-".
+
+        max_nodes limits the number of node addresses assigned to this pool.
+        If None, the pool takes all remaining addresses.
+
+        weight is the SLURM scheduling weight; SLURM prefers nodes with lower
+        weights.  This defaults to 1.
+
+        features is a list of additional SLURM features for the pool's nodes.
+
+        default specifies whether the pool's partition is the default SLURM
+        partition.  If no pool is marked as the default, the first pool is.
+
+        placement_group, if specified, is the name of a cluster placement
+        group to launch the pool's nodes into, or "auto" to use a group named
+        after the cluster and pool.  The group is created if necessary.  The
+        pool is pinned to a single availability zone; if subnet_ids isn't
+        specified, the first node subnet is used.
+
+        placement_fallback specifies what to do when the placement group has
+        no capacity: "no-group" (the default) launches the node outside the
+        group; "none" gives up.
+
+        subnet_ids, if specified, restricts the pool's nodes to addresses in
+        the given node subnets.
+        """
+        self.name = name
+        self._instance_type = instance_type
+        self._ami = ami
+        self._bid_price = bid_price
+        if isinstance(spot_instance_types, basestring):
+            spot_instance_types = spot_instance_types.split()
+        self._spot_instance_types = spot_instance_types
+        self._spot_timeout = (
+            None if spot_timeout is None else int(spot_timeout))
+        if spot_fallback not in (None, "ondemand", "none"):
+            raise ValueError("Invalid spot_fallback %r for pool %r" %
+                             (spot_fallback, name))
+        self._spot_fallback = spot_fallback
+        self._hostname_prefix = hostname_prefix
+        self.max_nodes = None if max_nodes is None else int(max_nodes)
+        self._weight = None if weight is None else int(weight)
+        if isinstance(features, basestring):
+            features = features.replace(",", " ").split()
+        self.features = list(features) if features else []
+        if isinstance(default, basestring):
+            default = default.lower() in ("1", "yes", "true", "on")
+        self.default = bool(default)
+        self._placement_group = placement_group
+        if placement_fallback not in (None, "no-group", "none"):
+            raise ValueError("Invalid placement_fallback %r for pool %r" %
+                             (placement_fallback, name))
+        self._placement_fallback = placement_fallback
+        if isinstance(subnet_ids, basestring):
+            subnet_ids = subnet_ids.replace(",", " ").split()
+        self.subnet_ids = list(subnet_ids) if subnet_ids else None
+        self.cluster = None
+        return
+
+    @classmethod
+    def from_dict(cls, name, values):
+        """
+        NodePool.from_dict(name, values) -> NodePool
+
+        Create a pool from a dictionary of configuration keys (as found in a
+        [pool:<name>] section).
+        """
+        kw = {}
+        for key, value in values.items():
+            if key not in cls.config_keys:
+                raise ValueError("Unknown node pool setting %r for pool %r" %
+                                 (key, name))
+            kw[key] = value
+        return cls(name, **kw)
+
+    @property
+    def instance_type(self):
+        if self._instance_type is not None:
+            return self._instance_type
+        return self.cluster.compute_instance_type
+
+    @property
+    def ami(self):
+        if self._ami is not None:
+            return self._ami
+        return self.cluster.compute_ami
+
+    @property
+    def bid_price(self):
+        if self._bid_price == "ondemand":
+            return None
+        if self._bid_price is not None:
+            return self._bid_price
+        return self.cluster.compute_bid_price
+
+    @property
+    def spot_instance_types(self):
+        """
+        The ranked list of instance types to request spot instances for.
+        """
+        if self._spot_instance_types is not None:
+            return self._spot_instance_types
+        if self.cluster.compute_spot_instance_types is not None:
+            return self.cluster.compute_spot_instance_types
+        return [self.instance_type]
+
+    @property
+    def spot_timeout(self):
+        if self._spot_timeout is not None:
+            return self._spot_timeout
+        return self.cluster.compute_spot_timeout
+
+    @property
+    def spot_fallback(self):
+        if self._spot_fallback is not None:
+            return self._spot_fallback
+        return self.cluster.compute_spot_fallback
+
+    @property
+    def hostname_prefix(self):
+        if self._hostname_prefix is not None:
+            return self._hostname_prefix
+        return self.name + "-"
+
+    @property
+    def weight(self):
+        return self._weight if self._weight is not None else 1
+
+    @property
+    def placement_group(self):
+        """
+        The name of the pool's cluster placement group, or None.
+        """
+        if self._placement_group == "auto":
+            return "slurm-%s-%s" % (
+                sha256(self.cluster.slurm_s3_root).hexdigest()[:8], self.name)
+        return self._placement_group
+
+    @property
+    def placement_fallback(self):
+        if self._placement_fallback is not None:
+            return self._placement_fallback
+        return "no-group"
+
+    @property
+    def subnets(self):
+        """
+        The node subnets this pool is pinned to (list of
+        boto.vpc.subnet.Subnet objects), or None if it can use any of them.
+        """
+        if self.subnet_ids is not None:
+            subnets = [subnet for subnet in self.cluster.node_subnets
+                       if subnet.id in self.subnet_ids]
+            missing = set(self.subnet_ids) - set(
+                subnet.id for subnet in subnets)
+            if missing:
+                raise ValueError("Node pool %r uses unknown node subnet(s) %s"
+                                 % (self.name, " ".join(sorted(missing))))
+            return subnets
+
+        if self._placement_group is not None:
+            return self.cluster.node_subnets[:1]
+
+        return None
+
+    @property
+    def addresses(self):
+        """
+        The node addresses assigned to this pool (list of netaddr.IPAddress
+        objects); the node with index i has address addresses[i].
+        """
+        return self.cluster.get_pool_addresses(self)
+
+    @property
+    def hostlist(self):
+        """
+        The SLURM hostlist expression for this pool's nodes, or None if the
+        pool has no addresses.
+        """
+        n_nodes = len(self.addresses)
+        if n_nodes == 0:
+            return None
+        return "%s[0-%d]" % (self.hostname_prefix, n_nodes - 1)
+
+    def get_nodename(self, index):
+        return "%s%d" % (self.hostname_prefix, index)
+
+    def config_items(self):
+        """
+        Returns the (key, value) pairs to write to this pool's slurm-ec2.conf
+        section.  Inherited settings are omitted.
+        """
+        items = []
+        for key, value in [("instance_type", self._instance_type),
+                           ("ami", self._ami),
+                           ("bid_price", self._bid_price),
+                           ("spot_instance_types",
+                            " ".join(self._spot_instance_types or []) or None),
+                           ("spot_timeout", self._spot_timeout),
+                           ("spot_fallback", self._spot_fallback),
+                           ("hostname_prefix", self._hostname_prefix),
+                           ("max_nodes", self.max_nodes),
+                           ("weight", self._weight),
+                           ("features", " ".join(self.features) or None),
+                           ("default", "yes" if self.default else None),
+                           ("placement_group", self._placement_group),
+                           ("placement_fallback", self._placement_fallback),
+                           ("subnet_ids",
+                            " ".join(self.subnet_ids or []) or None)]:
+            if value is not None:
+                items.append((key, value))
+        return items
+
 class ClusterConfiguration(object):
     """
     Configure resources for SLURM operation.
@@ -47,31 +406,39 @@ class ClusterConfiguration(object):
     regenerate the other files.
     """
 
+    # Hardware per instance type: (sockets, cores per socket, threads per
+    # core, memory in MB).
+    instance_hardware = {
+        "t2.micro":     (1, 1, 1, 1024),
+        "t2.small":     (1, 1, 1, 2048),
+        "t2.medium":    (1, 2, 1, 4096),
+        "m3.medium":    (1, 1, 1, 3840),
+        "m3.large":     (1, 1, 2, 7680),
+        "m3.xlarge":    (1, 2, 2, 15360),
+        "m3.2xlarge":   (1, 4, 2, 30720),
+        "c3.large":     (1, 1, 2, 3840),
+        "c3.xlarge":    (1, 2, 2, 7680),
+        "c3.2xlarge":   (1, 4, 2, 15360),
+        "c3.4xlarge":   (1, 8, 2, 30720),
+        "c3.8xlarge":   (2, 8, 2, 61440),
+        "r3.large":     (1, 1, 2, 15616),
+        "r3.xlarge":    (1, 2, 2, 31232),
+        "r3.2xlarge":   (1, 4, 2, 62464),
+        "r3.4xlarge":   (1, 8, 2, 124928),
+        "r3.8xlarge":   (2, 8, 2, 249856),
+        "g2.2xlarge":   (1, 4, 2, 15360),
+        "i2.xlarge":    (1, 2, 2, 31232),
+        "i2.2xlarge":   (1, 4, 2, 62464),
+        "i2.4xlarge":   (1, 8, 2, 124928),
+        "i2.8xlarge":   (2, 8, 2, 249856),
+        "hs1.8xlarge":  (2, 4, 2, 119808),
+    }
+
     # SLURM features per instance type
-    slurm_features = {
-        "t2.micro": "CoresPerSocket=1 Feature=burst",
-        "t2.small": "CoresPerSocket=1 Feature=burst",
-        "t2.medium": "CoresPerSocket=2 Feature=burst",
-        "m3.medium": "CoresPerSocket=1",
-        "m3.large": "CoresPerSocket=1 ThreadsPerCore=2",
-        "m3.xlarge": "CoresPerSocket=2 ThreadsPerCore=2",
-        "m3.2xlarge": "CoresPerSocket=4 ThreadsPerCore=2",
-        "c3.large": "CoresPerSocket=1 ThreadsPerCore=2",
-        "c3.xlarge": "CoresPerSocket=2 ThreadsPerCore=2",
-        "c3.2xlarge": "CoresPerSocket=4 ThreadsPerCore=2",
-        "c3.4xlarge": "CoresPerSocket=8 ThreadsPerCore=2",
-        "c3.8xlarge": "CoresPerSocket=16 ThreadsPerCore=2",
-        "r3.large": "CoresPerSocket=1 ThreadsPerCore=2",
-        "r3.xlarge": "CoresPerSocket=2 ThreadsPerCore=2",
-        "r3.2xlarge": "CoresPerSocket=4 ThreadsPerCore=2",
-        "r3.4xlarge": "CoresPerSocket=8 ThreadsPerCore=2",
-        "r3.8xlarge": "CoresPerSocket=16 ThreadsPerCore=2",
-        "g2.2xlarge": "CoresPerSocket=4 ThreadsPerCore=2",
-        "i2.xlarge": "CoresPerSocket=2 ThreadsPerCore=2",
-        "i2.2xlarge": "CoresPerSocket=4 ThreadsPerCore=2",
-        "i2.4xlarge": "CoresPerSocket=8 ThreadsPerCore=2",
-        "i2.8xlarge": "CoresPerSocket=16 ThreadsPerCore=2",
-        "hs1.8xlarge": "CoresPerSocket=8 ThreadsPerCore=2",
+    instance_features = {
+        "t2.micro":     ["burst"],
+        "t2.small":     ["burst"],
+        "t2.medium":    ["burst"],
     }
 
     # Ephemeral storage volume sizes (in GB) per instance type
@@ -101,6 +468,19 @@ class ClusterConfiguration(object):
         "hs1.8xlarge":  [2000] * 24,
     }
 
+    # Memory (in MB) withheld from SLURM for the kernel and daemons is this
+    # fraction of the instance's memory, but at least min_memory_reserve; a
+    # node registering less than its RealMemory is drained.
+    memory_reserve_fraction = 0.05
+    min_memory_reserve = 256
+
+    # MB of TmpDisk per GB of ephemeral store: GB are decimal and ext4 keeps
+    # some of each volume for itself.
+    tmp_disk_per_gb = 900
+
+    # Where TmpDisk is measured; see slurm-ec2-setup-ephemeral.
+    tmp_fs = "/ephemeral"
+
     # Default values for the parser and constructor.
     defaults = {
         'region': None,
@@ -117,24 +497,34 @@ class ClusterConfiguration(object):
         'node_hostname_prefix': "node-",
         'reserved_addresses': 8,
         'max_nodes': None,
+        'address_ordering': "round-robin",
+        'select_type': "linear",
         'compute_instance_type': "c3.8xlarge",
         'compute_ami': None,
         'compute_bid_price': None,
+        'compute_spot_instance_types': None,
+        'compute_spot_timeout': 300,
+        'compute_spot_fallback': "ondemand",
         'compute_os_packages': None,
         'compute_external_packages': None,
+        'node_pools': None,
         'app_config': None,
     }
 
     # Keys which are lists in the slurm-ec2 config section.
     list_keys = {'security_groups', 'node_subnet_ids', 'compute_os_packages',
-                 'compute_external_packages'}
+                 'compute_external_packages', 'node_pools',
+                 'compute_spot_instance_types'}
 
     # Keys which are integers in the slurm-ec2 config section
-    int_keys = {'reserved_addresses', 'max_nodes'}
+    int_keys = {'reserved_addresses', 'max_nodes', 'compute_spot_timeout'}
 
     # Master configuration section name
     master_config_section = "slurm-ec2"
 
+    # Where the configuration is read from if no filename is given.
+    default_config_filename = "/etc/slurm-ec2.conf"
+
     def __init__(self, **kw):
         """
         ClusterConfiguration(
@@ -143,9 +533,13 @@ class ClusterConfiguration(object):
             backup_controller_address=None, controller_hostname="controller",
             backup_controller_hostname="backup-controller",
             node_hostname_prefix="node-", reserved_addresses=8,
-            max_nodes=65535, compute_instance_type="c3.8xlarge",
-            compute_ami=None, compute_bid_price=None, compute_os_packages=None,
-            compute_external_packages=None, app_config=None)
+            max_nodes=65535, address_ordering="round-robin",
+            select_type="linear", compute_instance_type="c3.8xlarge",
+            compute_ami=None, compute_bid_price=None,
+            compute_spot_instance_types=None, compute_spot_timeout=300,
+            compute_spot_fallback="ondemand", compute_os_packages=None,
+            compute_external_packages=None, node_pools=None,
+            app_config=None)
 
         Create a ClusterConfiguration object.
 
@@ -190,6 +584,10 @@ class ClusterConfiguration(object):
         This is limited to 65531 (the size of a /16 - 3 (AWS reserved
         addresses) - 1 (SLURM controller)).
 
+        select_type specifies how SLURM allocates nodes: "linear" (the
+        default) gives each job whole nodes; "cons_res" allocates cores and
+        memory, so several small jobs can share a node.
+
         compute_instance_type specifies the EC2 instance type to use.
         This defaults to c3.8xlarge.
 
@@ -199,6 +597,17 @@ class ClusterConfiguration(object):
         compute_bid_price specifies the bid price for requesting spot
         instances.  If None, on-demand instances are used.
 
+        compute_spot_instance_types is a ranked list of instance types to
+        request spot instances for.  Each type is tried in turn, waiting up to
+        compute_spot_timeout seconds for the request to be fulfilled.  If
+        None, only compute_instance_type is tried.  Alternative types should
+        provide at least the resources of compute_instance_type, since
+        slurm.conf describes nodes using the latter.
+
+        compute_spot_fallback specifies what to do if no spot request is
+        fulfilled: "ondemand" (the default) launches an on-demand instance of
+        compute_instance_type; "none" gives up.
+
         compute_os_packages specifies the names of packages provided by the OS
         vendor to install on compute nodes.  These are installed via
         "yum install" (RedHat variants) or "apt-get install" (Debian variants).
@@ -208,6 +617,10 @@ class ClusterConfiguration(object):
         installed via "rpm --install" (RedHat variants) or "dpkg --install"
         (Debian variants).
 
+        node_pools, if specified, is a list of NodePool objects.  If None, a
+        single pool named "cluster" is used whose nodes are named with
+        node_hostname_prefix and use the compute_* settings.
+
         app_config, if specified, is a two-level dictionary of configuration
         information for applications.  Top level keys are written to
         slurm-ec2.conf as sections; second level keys are configuration keys.
@@ -235,7 +648,7 @@ class ClusterConfiguration(object):
             else [g.id for g in get_instance().groups])
 
         if kw.get('_all_subnets') is None:
-            vpc_conn = boto.vpc.connect_to_region(self.region)
+            vpc_conn = connect_vpc(self.region)
             if vpc_conn is None:
                 raise ValueError("Cannot connect to AWS VPC endpoint in "
                                  "region %r" % self.region)
@@ -268,14 +681,81 @@ class ClusterConfiguration(object):
         self.node_hostname_prefix = kw['node_hostname_prefix']
         self.reserved_addresses = kw['reserved_addresses']
         self.max_nodes = kw['max_nodes']
+        self.address_ordering = kw['address_ordering']
+        self.select_type = kw['select_type']
+        if self.select_type not in ("linear", "cons_res"):
+            raise ValueError("Invalid select_type %r" % (self.select_type,))
         self.compute_instance_type = kw['compute_instance_type']
         self.compute_ami = (
             kw['compute_ami'] if kw['compute_ami'] is not None
             else get_instance().image_id)
         self.compute_bid_price = kw['compute_bid_price']
+        self.compute_spot_instance_types = kw['compute_spot_instance_types']
+        self.compute_spot_timeout = kw['compute_spot_timeout']
+        self.compute_spot_fallback = kw['compute_spot_fallback']
+        if self.compute_spot_fallback not in ("ondemand", "none"):
+            raise ValueError("Invalid compute_spot_fallback %r" %
+                             (self.compute_spot_fallback,))
         self.compute_os_packages = kw['compute_os_packages']
         self.compute_external_packages = kw['compute_external_packages']
         self.app_config = kw['app_config']
+
+        # Use a single implicit pool if none were configured; it isn't
+        # written to slurm-ec2.conf.
+        self.explicit_node_pools = bool(kw['node_pools'])
+        if self.explicit_node_pools:
+            self.node_pools = list(kw['node_pools'])
+        else:
+            self.node_pools = [NodePool(
+                "cluster", hostname_prefix=self.node_hostname_prefix)]
+
+        for pool in self.node_pools:
+            pool.cluster = self
+
+        names = [pool.name for pool in self.node_pools]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate node pool names: %s" %
+                             " ".join(names))
+
+        # Node names are mapped to pools by prefix, so no prefix may be a
+        # prefix of another one.
+        prefixes = [pool.hostname_prefix for pool in self.node_pools]
+        for i, prefix in enumerate(prefixes):
+            for j, other in enumerate(prefixes):
+                if i != j and other.startswith(prefix):
+                    raise ValueError(
+                        "Node pool hostname prefixes %r and %r are ambiguous"
+                        % (prefix, other))
+
+        # Cluster placement groups can't span availability zones.
+        for pool in self.node_pools:
+            subnets = pool.subnets
+            if pool.placement_group is not None and len(set(
+                    subnet.availability_zone for subnet in subnets)) > 1:
+                raise ValueError(
+                    "Node pool %r has a placement group but its subnets span "
+                    "availability zones" % (pool.name,))
+
+        self._pool_addresses = None
+
+        # Subnet weights are stored in slurm-ec2.conf; only compute them for
+        # a new configuration.
+        if kw.get('_subnet_weights') is not None:
+            self.subnet_weights = kw['_subnet_weights']
+        else:
+            self.reweight_subnets()
+        return
+
+    def reweight_subnets(self):
+        """
+        Recompute the node subnet weights using the address ordering policy.
+
+        This changes the address of existing node names; only do this when no
+        compute nodes are running.
+        """
+        self.subnet_weights = get_subnet_weights(
+            self.address_ordering, self, self.node_subnets)
+        self._pool_addresses = None
         return
 
     @property
@@ -358,42 +838,82 @@ class ClusterConfiguration(object):
         A list of all valid node addresses (list of netaddr.IPAddress objects).
 
         The resulting list is ordered so that the load is distributed across
-        availability zones.
+        availability zones in proportion to the subnet weights.
         """
         hosts_by_subnet = [
             list(IPNetwork(subnet.cidr_block).iter_hosts())[
                 self.reserved_addresses:]
             for subnet in self.node_subnets]
 
-        # Make sure each list has the same length; append Nones to subnets
-        # which are short.
-        max_length = max([len(host_list) for host_list in hosts_by_subnet])
-        for host_list in hosts_by_subnet:
-            host_list.extend([None] * (max_length - len(host_list)))
-
         # Then interweave the hosts in each subnet so we distribute the load
-        # across AZs appropriately.
-        hosts = []
-        for host_tuple in zip(*hosts_by_subnet):
-            for host in filter(None, host_tuple):
-                hosts.append(host)
-                if len(hosts) >= self.max_nodes:
+        # across AZs according to the subnet weights.
+        weights = [self.subnet_weights.get(subnet.id, 1.0)
+                   for subnet in self.node_subnets]
+        return interleave_addresses(hosts_by_subnet, weights, self.max_nodes)
+
+    def get_pool_addresses(self, pool):
+        """
+        Returns the node addresses assigned to the given pool.  Pools take
+        the next unassigned node_addresses (in their subnets, if pinned) in
+        configuration order.
+        """
+        if self._pool_addresses is None:
+            node_addresses = self.node_addresses
+            pool_addresses = {}
+            taken = set()
+            for p in self.node_pools:
+                subnets = p.subnets
+                if subnets is None:
+                    candidates = node_addresses
+                else:
+                    networks = [IPNetwork(subnet.cidr_block)
+                                for subnet in subnets]
+                    candidates = [
+                        addr for addr in node_addresses
+                        if any(addr in network for network in networks)]
+
+                addresses = [addr for addr in candidates if addr not in taken]
+                if p.max_nodes is not None:
+                    addresses = addresses[:p.max_nodes]
+                taken.update(addresses)
+                pool_addresses[p.name] = addresses
+            self._pool_addresses = pool_addresses
+
+        return self._pool_addresses[pool.name]
+
+    def get_pool(self, name):
+        """
+        Returns the node pool with the given name.
+        """
+        for pool in self.node_pools:
+            if pool.name == name:
+                return pool
+        raise KeyError("Unknown node pool %r" % (name,))
+
+    def get_pool_for_nodename(self, nodename):
+        """
+        cc.get_pool_for_nodename(nodename) -> (NodePool, index)
+
+        Returns the pool the given node belongs to and its index within the
+        pool.
+        """
+        for pool in self.node_pools:
+            prefix = pool.hostname_prefix
+            if (nodename.startswith(prefix) and
+                nodename[len(prefix):].isdigit()):
+                index = int(nodename[len(prefix):])
+                if index >= len(pool.addresses):
                     break
-        
-            if len(hosts) >= self.max_nodes:
-                break
-            
-        return hosts
+                return pool, index
+
+        raise ValueError("Invalid node name %r" % (nodename,))
 
     def get_address_for_nodename(self, nodename):
         """
         Return the address for the given nodename.
         """
-        if not nodename.startswith(self.node_hostname_prefix):
-            raise ValueError("Invalid node name %r" % (nodename,))
-        
-        node_id = int(nodename[len(self.node_hostname_prefix):])
-        return self.node_addresses[node_id]
+        pool, index = self.get_pool_for_nodename(nodename)
+        return pool.addresses[index]
 
     @property
     def slurm_ec2_configuration(self):
@@ -412,9 +932,11 @@ class ClusterConfiguration(object):
                      "key_name", "security_groups", "controller_address",
                      "backup_controller_address", "controller_hostname",
                      "backup_controller_hostname", "node_hostname_prefix",
-                     "reserved_addresses", "max_nodes",
-                     "compute_instance_type", "compute_ami",
-                     "compute_bid_price", "compute_os_packages",
+                     "reserved_addresses", "max_nodes", "address_ordering",
+                     "select_type", "compute_instance_type", "compute_ami",
+                     "compute_bid_price", "compute_spot_instance_types",
+                     "compute_spot_timeout", "compute_spot_fallback",
+                     "compute_os_packages",
                      "compute_external_packages"]:
             value = getattr(self, attr)
             if value is None:
@@ -426,6 +948,16 @@ class ClusterConfiguration(object):
                 conf.write("%s=%s\n" % (attr, value))
         conf.write("node_subnet_ids=%s\n" % " ".join(
             [subnet.id for subnet in self.node_subnets]))
+        if self.explicit_node_pools:
+            conf.write("node_pools=%s\n" % " ".join(
+                [pool.name for pool in self.node_pools]))
+
+        # Write out each node pool
+        if self.explicit_node_pools:
+            for pool in self.node_pools:
+                conf.write("\n[%s%s]\n" % (NodePool.section_prefix, pool.name))
+                for kv in pool.config_items():
+                    conf.write("%s=%s\n" % kv)
 
         # Write out the VPC configuration
         conf.write("\n[%s]\n" % self.vpc_id)
@@ -437,6 +969,9 @@ class ClusterConfiguration(object):
             conf.write("\n[%s]\n" % subnet.id)
             conf.write("cidr_block=%s\n" % subnet.cidr_block)
             conf.write("availability_zone=%s\n" % subnet.availability_zone)
+            weight = self.subnet_weights.get(subnet.id, 1.0)
+            if weight != 1.0:
+                conf.write("weight=%s\n" % weight)
 
         # Write out any application-specific data.
         if self.app_config is not None:
@@ -448,6 +983,34 @@ class ClusterConfiguration(object):
             
         return conf.getvalue()
 
+    @classmethod
+    def get_node_hardware(cls, instance_type):
+        """
+        cc.get_node_hardware(instance_type) -> dict
+
+        Returns the SLURM node description of the given instance type:
+        Sockets, CoresPerSocket, ThreadsPerCore, RealMemory and TmpDisk (if
+        it has ephemeral stores).  Unknown instance types return {}.
+        """
+        hardware = cls.instance_hardware.get(instance_type)
+        if hardware is None:
+            return {}
+
+        sockets, cores_per_socket, threads_per_core, memory = hardware
+        result = {
+            "Sockets": sockets,
+            "CoresPerSocket": cores_per_socket,
+            "ThreadsPerCore": threads_per_core,
+            "RealMemory": memory - max(
+                int(memory * cls.memory_reserve_fraction),
+                cls.min_memory_reserve),
+        }
+
+        stores = cls.ephemeral_stores.get(instance_type)
+        if stores:
+            result["TmpDisk"] = sum(stores) * cls.tmp_disk_per_gb
+        return result
+
     @property
     def slurm_configuration(self):
         """
@@ -464,10 +1027,48 @@ class ClusterConfiguration(object):
             control.write("BackupAddr=%s\n" % backup_addr)
 
         control = control.getvalue().strip()
-        features = self.slurm_features.get(self.compute_instance_type, "")
-        
-        node_addresses = self.node_addresses
-        max_node = len(self.node_addresses) - 1
+
+        default_pools = [pool for pool in self.node_pools if pool.default]
+        default_pool = (
+            default_pools[0] if default_pools else self.node_pools[0])
+
+        nodes = StringIO()
+        for pool in self.node_pools:
+            hostlist = pool.hostlist
+            if hostlist is None:
+                continue
+
+            # Merge any features from the instance type table with the pool's
+            # features; SLURM only honors one Feature= per line.
+            features = ["cloud"]
+            features.extend(self.instance_features.get(pool.instance_type, []))
+            features.extend(pool.features)
+
+            hardware = self.get_node_hardware(pool.instance_type)
+            nodes.write("NodeName=%s Weight=%d Feature=%s %s State=CLOUD\n" % (
+                hostlist, pool.weight, ",".join(features), " ".join([
+                    "%s=%d" % (key, hardware[key])
+                    for key in ["Sockets", "CoresPerSocket", "ThreadsPerCore",
+                                "RealMemory", "TmpDisk"]
+                    if key in hardware])))
+
+            partition = "PartitionName=%s Nodes=%s Default=%s" % (
+                pool.name, hostlist, "yes" if pool is default_pool else "no")
+            if self.select_type == "cons_res" and hardware:
+                # Jobs which don't ask for memory get a share proportional to
+                # their CPUs instead of the whole node.
+                partition += " DefMemPerCPU=%d" % (
+                    hardware["RealMemory"] // (
+                        hardware["Sockets"] * hardware["CoresPerSocket"] *
+                        hardware["ThreadsPerCore"]))
+            nodes.write(partition + "\n")
+
+        if self.select_type == "cons_res":
+            select = ("SelectType=select/cons_res\n"
+                      "SelectTypeParameters=CR_Core_Memory")
+        else:
+            select = "SelectType=select/linear"
+
         return """
 %(control)s
 AuthType=auth/munge
@@ -483,6 +1084,7 @@ SlurmUser=slurm
 StateSaveLocation=/var/slurm/state
 SwitchType=switch/none
 TaskPlugin=task/none
+TmpFS=%(tmp_fs)s
 
 # TIMERS
 InactiveLimit=0
@@ -496,7 +1098,7 @@ Waittime=0
 FastSchedule=1
 SchedulerType=sched/backfill
 SchedulerPort=7321
-SelectType=select/linear
+%(select)s
 SuspendProgram=/usr/bin/slurm-ec2-suspend
 ResumeProgram=/usr/bin/slurm-ec2-resume
 SuspendTime=600
@@ -515,17 +1117,17 @@ SlurmdLogFile=/var/log/slurm/slurmd.log
 SlurmdDebug=3
 
 # COMPUTE NODES
-NodeName=%(node_hostname_prefix)s[0-%(max_node)d] Weight=1 Feature=cloud %(features)s State=CLOUD
-PartitionName=cluster Nodes=node-[0-%(max_node)d] Default=yes
-""" % {'control': control,
-       'node_hostname_prefix': self.node_hostname_prefix,
-       'max_node': max_node,
-       'features': features}
+%(nodes)s""" % {'control': control,
+       'select': select,
+       'tmp_fs': self.tmp_fs,
+       'nodes': nodes.getvalue()}
 
     @property
-    def hosts(self):
+    def controller_hosts(self):
         """
-        Returns the desired hosts configuration file.
+        Returns a hosts configuration file with only the localhost and
+        controller entries.  Compute nodes are resolved from the hosts
+        database (see hosts_db) by slurm-ec2-resolver.
         """
         hosts = StringIO()
         hosts.write("127.0.0.1 localhost localhost.localdomain\n")
@@ -537,14 +1139,31 @@ PartitionName=cluster Nodes=node-[0-%(max_node)d] Default=yes
             hosts.write("%s %s %s.%s.compute.internal\n" % (
                 backup_addr, self.backup_controller_hostname,
                 self.backup_controller_hostname, self.region))
+        return hosts.getvalue()
+
+    @property
+    def hosts(self):
+        """
+        Returns the desired hosts configuration file.
+        """
+        hosts = StringIO()
+        hosts.write(self.controller_hosts)
         
-        for i, addr in enumerate(self.node_addresses):
-            hosts.write("%s %s%d %s%d.%s.compute.internal\n" % (
-                addr, self.node_hostname_prefix, i,
-                self.node_hostname_prefix, i, self.region))
+        for pool in self.node_pools:
+            for i, addr in enumerate(pool.addresses):
+                nodename = pool.get_nodename(i)
+                hosts.write("%s %s %s.%s.compute.internal\n" % (
+                    addr, nodename, nodename, self.region))
 
         return hosts.getvalue()
 
+    @property
+    def hosts_db(self):
+        """
+        Returns the compute node hosts database read by slurm-ec2-resolver.
+        """
+        return build_hosts_db(self)
+
     def get_subnet_for_address(self, addr):
         """
         cc.get_subnet_for_address(addr) -> boto.vpc.subnet.Subnet | None
@@ -576,13 +1195,15 @@ PartitionName=cluster Nodes=node-[0-%(max_node)d] Default=yes
             cp.set(DEFAULTSECT, key, value)
 
         if filename is None and fp is None:
-            filename = "/etc/slurm-ec2.conf"
+            filename = cls.default_config_filename
 
         if fp is not None:
             if filename is not None:
                 raise ValueError("Cannot specify both filename and fp")
-            cp.readfp(fp)
-            app_config_cp.readfp(fp)
+            # Both parsers need to read the contents.
+            data = fp.read()
+            cp.readfp(StringIO(data))
+            app_config_cp.readfp(StringIO(data))
         else:
             cp.read(filename)
             app_config_cp.read(filename)
@@ -617,6 +1238,7 @@ PartitionName=cluster Nodes=node-[0-%(max_node)d] Default=yes
             vpc_id = kw['vpc_id']
             subnet_ids = parse_list(cp.get(vpc_id, "subnet_ids"))
             subnets = []
+            subnet_weights = {}
 
             # Parse each subnet and create a Boto subnet object without
             # querying the EC2 endpoint.
@@ -633,14 +1255,29 @@ PartitionName=cluster Nodes=node-[0-%(max_node)d] Default=yes
                 subnet.availability_zone = availability_zone
                 subnets.append(subnet)
 
+                if cp.has_option(subnet_id, "weight"):
+                    subnet_weights[subnet_id] = float(
+                        cp.get(subnet_id, "weight"))
+                else:
+                    subnet_weights[subnet_id] = 1.0
+
             kw["_all_subnets"] = subnets
+            kw["_subnet_weights"] = subnet_weights
+
+        if kw.get("node_pools"):
+            # Parse each node pool section.
+            kw["node_pools"] = [
+                NodePool.from_dict(name, dict(app_config_cp.items(
+                    NodePool.section_prefix + name)))
+                for name in kw["node_pools"]]
 
         # We use the app_config_cp config parser here to avoid polluting
         # application config with our defaults.
         app_config = {}
         for appname in app_config_cp.sections():
             if (appname == "slurm-ec2" or appname.startswith("vpc-") or 
-                appname.startswith("subnet-")):
+                appname.startswith("subnet-") or
+                appname.startswith(NodePool.section_prefix)):
                 continue
 
             app_config[appname] = cp.items(appname)
@@ -726,6 +1363,24 @@ def main():
     parser.add_argument(
         "--max-nodes", "-m", type=int, default=65535,
         help=("The maximum number of SLURM computation nodes."))
+    parser.add_argument(
+        "--address-ordering", default="round-robin",
+        help=("How node addresses are ordered across subnets: round-robin "
+              "(the default), free-addresses, launch-failures, spot-price or "
+              "module:ClassName.  The subnet weights are computed when the "
+              "configuration is created and stay fixed until --reweight is "
+              "run; launch failures and spot prices seen later don't change "
+              "them."))
+    parser.add_argument(
+        "--reweight", action="store_true", default=False,
+        help=("Recompute the subnet weights of the configuration read with "
+              "--config.  This moves node names to different addresses; only "
+              "use it when no compute nodes are running."))
+    parser.add_argument(
+        "--select-type", choices=["linear", "cons_res"], default="linear",
+        help=("How SLURM allocates nodes: whole nodes per job (linear, the "
+              "default) or cores and memory (cons_res), so small jobs can "
+              "share a node."))
     parser.add_argument(
         "--compute-instance-type", "-i", default="c3.8xlarge",
         help=("The EC2 instance type to use for computation nodes.  This "
@@ -738,12 +1393,35 @@ def main():
         "--compute-bid-price", "-p",
         help=("The bid price for requesting spot instances.  If unspecified, "
               "on-demand instances are used."))
+    parser.add_argument(
+        "--compute-spot-instance-types", action="append",
+        help=("A ranked list of instance types to request spot instances "
+              "for.  If unspecified, only the compute instance type is "
+              "requested."))
+    parser.add_argument(
+        "--compute-spot-timeout", type=int, default=300,
+        help=("How long to wait for each spot request to be fulfilled, in "
+              "seconds.  Defaults to 300."))
+    parser.add_argument(
+        "--compute-spot-fallback", choices=["ondemand", "none"],
+        default="ondemand",
+        help=("What to do if no spot request is fulfilled: launch an "
+              "on-demand instance (the default) or give up."))
     parser.add_argument(
         "--compute-os-packages", action="append",
         help=("OS packages to install via yum."))
     parser.add_argument(
         "--compute-external-packages", action="append",
         help=("External packages to install from SLURMS3Root/external."))
+    parser.add_argument(
+        "--node-pool", "-P", action='append', default=[], dest="node_pools",
+        help=("A node pool in the form <name>[:<key>=<value>[,...]], where "
+              "keys are instance_type, ami, bid_price, spot_instance_types, "
+              "spot_timeout, spot_fallback, hostname_prefix, max_nodes, "
+              "weight, features, default, placement_group (a name, or "
+              "auto), placement_fallback (no-group or none) and subnet_ids; "
+              "separate list items with '+'.  May be repeated; if "
+              "unspecified, a single pool named \"cluster\" is used."))
     parser.add_argument(
         "--app-config", "-X", action='append', default=[],
         help=("Application-specific configuration in the form "
@@ -763,13 +1441,21 @@ def main():
         "--write-hosts", action='append', default=[],
         help=("Write a hosts file derived from the input parameters to the "
               "given file."))
+    parser.add_argument(
+        "--write-controller-hosts", action='append', default=[],
+        help=("Write a hosts file containing only the controller entries to "
+              "the given file.  Use with --write-hosts-db."))
+    parser.add_argument(
+        "--write-hosts-db", action='append', default=[],
+        help=("Write an indexed compute node hosts database, served by "
+              "slurm-ec2-resolver, to the given file."))
 
     ns = parser.parse_args()
     kw = vars(ns)
 
-    # Flatten list keys
+    # Flatten list keys (node pools are parsed separately below)
     for key in ClusterConfiguration.list_keys:
-        if key in kw and kw[key] is not None:
+        if key != "node_pools" and key in kw and kw[key] is not None:
             result = []
             for element in kw[key]:
                 if " " in element:
@@ -781,6 +1467,26 @@ def main():
             kw[key] = result
     
     config_filename = kw.pop("config", None)
+    reweight = kw.pop("reweight")
+
+    # Parse --node-pool items.
+    node_pools = []
+    for item in kw.pop("node_pools"):
+        name, _, settings = item.partition(":")
+        values = {}
+        for keyvalue in filter(None, settings.split(",")):
+            if "=" not in keyvalue:
+                print("Invalid node pool setting %r" % (keyvalue,),
+                      file=stderr)
+                return 1
+            key, value = keyvalue.split("=", 1)
+            values[key] = value.replace("+", " ")
+        try:
+            node_pools.append(NodePool.from_dict(name, values))
+        except ValueError as e:
+            print(str(e), file=stderr)
+            return 1
+    kw['node_pools'] = node_pools or None
 
     # Parse --app-config items.
     app_config_list = kw.pop("app_config")
@@ -802,10 +1508,14 @@ def main():
         "slurm_configuration": kw.pop("write_slurm_config", []),
         "slurm_ec2_configuration": kw.pop("write_slurm_ec2_config", []),
         "hosts": kw.pop("write_hosts", []),
+        "controller_hosts": kw.pop("write_controller_hosts", []),
+        "hosts_db": kw.pop("write_hosts_db", []),
     }
 
     if config_filename is not None:
         config = ClusterConfiguration.from_config(filename=config_filename)
+        if reweight:
+            config.reweight_subnets()
     else:
         config = ClusterConfiguration(**kw)
 
@@ -817,14 +1527,10 @@ def main():
         
         for filename in filenames:
             if filename == "-":
-                fd = stdout
-            else:
-                fd = open(filename, "w")
+                stdout.write(data)
+                continue
 
-            fd.write(data)
-        
-            if fd is not stdout:
-                fd.close()
-            del fd
+            # Readers such as slurm-ec2-resolver may be watching the file.
+            replace_file(filename, data)
     
     return 0
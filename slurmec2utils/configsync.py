@@ -0,0 +1,273 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+import boto.s3
+from .clusterconfig import (
+    ClusterConfiguration, publish_slurm_ec2_configuration, replace_file)
+from .fetch import parse_s3_url
+from .hostsdb import HOSTS_DB_FILENAME
+from .instanceinfo import get_metadata, get_region
+try: from cStringIO import StringIO
+except ImportError: from StringIO import StringIO
+from hashlib import sha256
+from os import stat
+from os.path import exists, join as path_join
+from random import uniform
+from subprocess import call
+from sys import stderr
+from time import sleep
+
+# The pointer object names the content-addressed configuration (see
+# publish_slurm_ec2_configuration) which nodes should be running.
+CONFIG_POINTER = "slurm-ec2.conf.current"
+
+DEFAULT_INTERVAL = 60
+
+# Poll intervals are randomized by up to this fraction so thousands of nodes
+# don't check (and reload) in lockstep.
+INTERVAL_JITTER = 0.5
+
+class S3ConfigSource(object):
+    """
+    Watches the configuration pointer under a SLURM S3 root
+    (<slurm_s3_root>/etc/slurm-ec2.conf.current).
+
+    Each poll is a single HEAD request on the pointer object.  The pointer
+    and the configuration it names are only downloaded when the pointer's
+    ETag changes; the configuration is verified against the SHA-256 digest
+    in its name.
+    """
+
+    def __init__(self, slurm_s3_root, region=None):
+        self.slurm_s3_root = slurm_s3_root
+        self.region = region if region is not None else get_region()
+        self.bucket_name, prefix = parse_s3_url(slurm_s3_root)
+        self.pointer_name = "/".join(filter(None, [
+            prefix.strip("/"), "etc", CONFIG_POINTER]))
+        self.etag = None
+        self._bucket = None
+        return
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            s3 = boto.s3.connect_to_region(self.region)
+            if s3 is None:
+                raise ValueError(
+                    "Unable to connect to S3 endpoint in region %r" %
+                    (self.region,))
+            self._bucket = s3.get_bucket(self.bucket_name, validate=False)
+        return self._bucket
+
+    def poll(self):
+        """
+        Returns the configuration contents if the pointer has changed since
+        the last poll, or None otherwise (including when nothing has been
+        published yet).
+        """
+        key = self.bucket.get_key(self.pointer_name)
+        if key is None or key.etag == self.etag:
+            return None
+
+        config_url = key.get_contents_as_string().strip()
+        bucket_name, key_name = parse_s3_url(config_url)
+        data = self.bucket.connection.get_bucket(
+            bucket_name, validate=False).get_key(
+                key_name).get_contents_as_string()
+
+        digest = key_name.rsplit("/", 1)[-1]
+        if sha256(data).hexdigest() != digest:
+            raise ValueError("Checksum mismatch for %s" % (config_url,))
+
+        self.etag = key.etag
+        return data
+
+    def publish(self, data):
+        """
+        Upload the configuration and point nodes at it.
+        """
+        config_url = publish_slurm_ec2_configuration(
+            self.slurm_s3_root, data, region=self.region)
+        key = self.bucket.new_key(self.pointer_name)
+        key.set_contents_from_string(config_url + "\n")
+        return config_url
+
+class DirectoryConfigSource(object):
+    """
+    Watches slurm-ec2.conf in a local (e.g. shared) directory.  Each poll is
+    a stat call; the file is only read when its size or mtime changes.
+    """
+
+    def __init__(self, path):
+        self.filename = path_join(path, "slurm-ec2.conf")
+        self.stat_key = None
+        return
+
+    def poll(self):
+        st = stat(self.filename)
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        if key == self.stat_key:
+            return None
+
+        with open(self.filename, "rb") as fd:
+            data = fd.read()
+        self.stat_key = key
+        return data
+
+    def publish(self, data):
+        replace_file(self.filename, data)
+        return self.filename
+
+def get_config_source(url, region=None):
+    if url.startswith("s3://"):
+        return S3ConfigSource(url, region=region)
+    return DirectoryConfigSource(url)
+
+class ConfigSync(object):
+    """
+    Regenerate the local configuration files when the published
+    slurm-ec2.conf changes.
+
+    Only files whose contents actually change are replaced (atomically), and
+    SLURM is only reloaded when slurm.conf changes.  Nodes poll at different
+    times, so each node reloads its own daemons once its own slurm.conf has
+    been replaced: the controller runs scontrol reconfigure, and compute
+    nodes have the slurm init script send slurmd a SIGHUP.  (A slurmd told
+    to reconfigure by the controller before its node has synced rereads the
+    old file; it's reloaded again when the node catches up.)
+    """
+
+    controller_reload_command = ["scontrol", "reconfigure"]
+    node_reload_command = ["service", "slurm", "reload"]
+
+    def __init__(self, source, config_filename=None, full_hosts=False,
+                 is_controller=False, reload_command=None):
+        self.source = source
+        self.config_filename = (
+            config_filename if config_filename is not None
+            else ClusterConfiguration.default_config_filename)
+        self.full_hosts = full_hosts
+        self.is_controller = is_controller
+        if reload_command is None:
+            reload_command = (self.controller_reload_command if is_controller
+                              else self.node_reload_command)
+        self.reload_command = reload_command
+        return
+
+    def get_outputs(self, data):
+        """
+        Returns a list of (filename, contents) for the given slurm-ec2.conf
+        contents.
+        """
+        cc = ClusterConfiguration.from_config(fp=StringIO(data))
+        outputs = [
+            (self.config_filename, data),
+            ("/etc/slurm.conf", cc.slurm_configuration),
+        ]
+        if self.full_hosts:
+            outputs.append(("/etc/hosts", cc.hosts))
+        else:
+            outputs.append(("/etc/hosts", cc.controller_hosts))
+            outputs.append((HOSTS_DB_FILENAME, cc.hosts_db))
+        return outputs
+
+    def apply(self, data):
+        """
+        Write the outputs for the given configuration and reload SLURM if
+        needed.  Returns the list of files changed.
+        """
+        changed = []
+        for filename, contents in self.get_outputs(data):
+            try:
+                with open(filename, "rb") as fd:
+                    current = sha256(fd.read()).digest()
+            except IOError:
+                current = None
+
+            if current != sha256(contents).digest():
+                replace_file(filename, contents)
+                changed.append(filename)
+
+        if changed:
+            print("Updated %s" % " ".join(changed))
+
+        if "/etc/slurm.conf" in changed:
+            print("Reloading SLURM: %s" % " ".join(self.reload_command))
+            if call(self.reload_command) != 0:
+                print("%s failed" % " ".join(self.reload_command),
+                      file=stderr)
+
+        return changed
+
+    def sync(self):
+        """
+        Perform a single check.  Returns the list of files changed.
+        """
+        data = self.source.poll()
+        if data is None:
+            return []
+        return self.apply(data)
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description=("Keep the local SLURM configuration in sync with the "
+                     "published slurm-ec2.conf."))
+    parser.add_argument(
+        "--source", "-s",
+        help=("The SLURM S3 root (s3://...) or local directory to watch.  "
+              "Defaults to the slurm_s3_root in the configuration."))
+    parser.add_argument(
+        "--config", "-c",
+        default=ClusterConfiguration.default_config_filename,
+        help=("The local slurm-ec2.conf file.  Defaults to %s." %
+              ClusterConfiguration.default_config_filename))
+    parser.add_argument(
+        "--publish", "-p", metavar="FILENAME",
+        help=("Publish the given slurm-ec2.conf file to the source and "
+              "exit."))
+    parser.add_argument(
+        "--once", action="store_true", default=False,
+        help=("Check once and exit."))
+    parser.add_argument(
+        "--interval", "-i", type=int, default=DEFAULT_INTERVAL,
+        help=("Average seconds between checks.  Defaults to %d." %
+              DEFAULT_INTERVAL))
+    parser.add_argument(
+        "--full-hosts", action="store_true", default=False,
+        help=("Write every node to /etc/hosts instead of writing the hosts "
+              "database.  Defaults to this if %s doesn't exist." %
+              HOSTS_DB_FILENAME))
+    args = parser.parse_args()
+
+    cc = ClusterConfiguration.from_config(filename=args.config)
+    source = get_config_source(
+        args.source if args.source is not None else cc.slurm_s3_root,
+        region=cc.region)
+
+    if args.publish is not None:
+        with open(args.publish, "rb") as fd:
+            print(source.publish(fd.read()))
+        return 0
+
+    is_controller = (
+        get_metadata().get('local-ipv4') == str(cc.controller_address))
+    sync = ConfigSync(
+        source, config_filename=args.config,
+        full_hosts=args.full_hosts or not exists(HOSTS_DB_FILENAME),
+        is_controller=is_controller)
+
+    while True:
+        try:
+            sync.sync()
+        except Exception as e:
+            print("Configuration sync failed: %s" % (e,), file=stderr)
+            if args.once:
+                return 1
+
+        if args.once:
+            break
+        sleep(args.interval * uniform(1 - INTERVAL_JITTER,
+                                      1 + INTERVAL_JITTER))
+
+    return 0
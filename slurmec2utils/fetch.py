@@ -0,0 +1,609 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+import boto.s3
+from errno import EAGAIN, EACCES, EEXIST, ENOENT, EXDEV
+from fcntl import flock, LOCK_EX, LOCK_NB
+from glob import glob
+from hashlib import md5, sha1, sha256
+from .instanceinfo import get_region
+from os import (
+    access, chmod, fdopen, link, lstat, makedirs, rename, statvfs, unlink,
+    utime, walk, W_OK)
+from os.path import dirname, getsize, isdir, join as path_join
+from Queue import Queue
+from shutil import copyfile, rmtree
+from stat import S_ISDIR
+from sys import exc_info, stderr
+from tempfile import mkstemp
+from threading import Thread, local
+from time import time
+
+# Objects at least this large are downloaded as parallel ranged GETs.
+MULTIPART_THRESHOLD = 64 << 20 # 64 MB
+PART_SIZE = 16 << 20 # 16 MB
+MAX_WORKERS = 8
+HASH_BUFSIZE = 1 << 20 # 1 MB
+
+# Entries used within this many seconds are never evicted; they may belong to
+# a run which is about to use them.
+EVICTION_MIN_AGE = 10 * 60
+
+# Directories containing this file are in use while it is locked (flock).
+LOCK_FILENAME = ".lock"
+
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+def get_default_cache_dir():
+    """
+    Returns the default cache directory: /ephemeral/slurm-ec2-cache if the
+    ephemeral volume is mounted and writable, otherwise
+    /var/tmp/slurm-ec2-cache.
+    """
+    if isdir("/ephemeral") and access("/ephemeral", W_OK):
+        return "/ephemeral/slurm-ec2-cache"
+    return "/var/tmp/slurm-ec2-cache"
+
+def parse_s3_url(url):
+    """
+    parse_s3_url(url) -> (bucket_name, key_name)
+
+    Split an S3 URL in the form s3://<bucket>/<key> into its components.
+    """
+    if not url.startswith("s3://"):
+        raise ValueError("Not an S3 URL: %r" % (url,))
+
+    bucket_name, _, key_name = url[5:].partition("/")
+    if not bucket_name:
+        raise ValueError("Missing bucket name in S3 URL %r" % (url,))
+
+    return bucket_name, key_name
+
+def parallel_map(func, items, max_workers=MAX_WORKERS):
+    """
+    parallel_map(func, items, max_workers=MAX_WORKERS) -> list
+
+    Call func on each item using up to max_workers threads and return the
+    results in the same order as items.  If any call raises an exception,
+    the first such exception is re-raised once all calls have finished.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    work = Queue()
+
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Exception:
+                return
+
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(exc_info()[1])
+
+    threads = [Thread(target=worker)
+               for i in xrange(max(1, min(max_workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+def _makedirs(path):
+    try:
+        makedirs(path)
+    except OSError as e:
+        if e.errno != EEXIST:
+            raise
+    return
+
+def _file_digests(filename):
+    """
+    Returns the (md5, sha256) hex digests of the given file.
+    """
+    md5_hash = md5()
+    sha256_hash = sha256()
+    with open(filename, "rb") as fd:
+        while True:
+            data = fd.read(HASH_BUFSIZE)
+            if not data:
+                break
+            md5_hash.update(data)
+            sha256_hash.update(data)
+
+    return md5_hash.hexdigest(), sha256_hash.hexdigest()
+
+def link_or_copy(src, dest):
+    """
+    Hardlink src to dest, replacing dest if it exists.  If src and dest are
+    on different filesystems, the file is copied instead.
+    """
+    _makedirs(dirname(dest) or ".")
+    try:
+        unlink(dest)
+    except OSError as e:
+        if e.errno != ENOENT:
+            raise
+
+    try:
+        link(src, dest)
+    except OSError as e:
+        if e.errno != EXDEV:
+            raise
+        copyfile(src, dest)
+    return
+
+def parse_size(value, path="/"):
+    """
+    parse_size(value, path="/") -> int
+
+    Parse a size such as "512M", "50G" or "1T" into bytes.  A percentage
+    ("80%") is taken of the size of the filesystem containing path.
+    """
+    value = value.strip().upper()
+    if value.endswith("%"):
+        st = statvfs(path)
+        return int(st.f_blocks * st.f_frsize * float(value[:-1]) / 100)
+
+    multiplier = 1
+    if value.endswith("B"):
+        value = value[:-1]
+    if value and value[-1] in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[value[-1]]
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+def _entry_inodes(path):
+    """
+    Returns [((st_dev, st_ino), size), ...] for the file or every file
+    beneath the directory at path.
+    """
+    st = lstat(path)
+    if not S_ISDIR(st.st_mode):
+        return [((st.st_dev, st.st_ino), st.st_size)]
+
+    result = []
+    for dirpath, dirnames, filenames in walk(path):
+        for filename in filenames:
+            try:
+                st = lstat(path_join(dirpath, filename))
+            except OSError:
+                continue
+            result.append(((st.st_dev, st.st_ino), st.st_size))
+    return result
+
+def _is_locked(path):
+    """
+    Returns True if path is a directory whose lock file is held, or a file
+    which is itself locked.
+    """
+    try:
+        fd = open(path_join(path, LOCK_FILENAME) if isdir(path) else path,
+                  "r")
+    except IOError:
+        return False
+
+    try:
+        flock(fd, LOCK_EX | LOCK_NB)
+    except IOError as e:
+        if e.errno in (EAGAIN, EACCES):
+            return True
+        raise
+    finally:
+        fd.close()
+    return False
+
+def evict_lru(paths, max_size, min_age=EVICTION_MIN_AGE):
+    """
+    evict_lru(paths, max_size, min_age=EVICTION_MIN_AGE) -> [path]
+
+    Remove the least recently modified of the given files and directories
+    until they use at most max_size bytes, and return the paths removed.
+
+    Space is counted per inode, so files hardlinked between entries (e.g.
+    a cached object and the run directories it was fetched into) count
+    once and only free space when the last entry linking them is removed.
+    Entries modified within min_age seconds, directories whose lock file is
+    held, and locked files are kept.
+    """
+    now = time()
+    entries = []
+    # (st_dev, st_ino) -> [size, links among the entries]
+    inodes = {}
+
+    for path in paths:
+        try:
+            mtime = lstat(path).st_mtime
+            files = _entry_inodes(path)
+        except OSError:
+            continue
+
+        for inode, size in files:
+            inodes.setdefault(inode, [size, 0])[1] += 1
+        entries.append((mtime, path, files))
+
+    usage = sum(size for size, n_links in inodes.itervalues())
+    removed = []
+
+    for mtime, path, files in sorted(entries):
+        if usage <= max_size:
+            break
+        if now - mtime < min_age or _is_locked(path):
+            continue
+
+        try:
+            if isdir(path):
+                rmtree(path)
+            else:
+                unlink(path)
+        except OSError as e:
+            print("Unable to evict %s: %s" % (path, e), file=stderr)
+            continue
+
+        removed.append(path)
+        for inode, size in files:
+            inodes[inode][1] -= 1
+            if inodes[inode][1] == 0:
+                usage -= size
+
+    return removed
+
+class ChecksumError(ValueError):
+    """
+    Raised when a downloaded object does not match its expected checksum.
+    """
+    pass
+
+class Fetcher(object):
+    """
+    Download S3 objects concurrently into a content-addressed cache.
+
+    The cache directory contains:
+        objects/<xx>/<sha256> - Object contents, stored read-only.
+        index/<key> - Maps an S3 URL, ETag and size to a sha256 digest.
+        tmp/ - Partial downloads.
+
+    Files are hardlinked from the cache into their destination; callers must
+    replace, not modify, fetched files.
+    """
+
+    def __init__(self, cache_dir=None, max_workers=MAX_WORKERS,
+                 part_size=PART_SIZE, multipart_threshold=MULTIPART_THRESHOLD,
+                 region=None):
+        """
+        Fetcher(cache_dir=None, max_workers=8, part_size=16 MB,
+                multipart_threshold=64 MB, region=None)
+
+        Create a new Fetcher.
+
+        cache_dir specifies the cache directory.  If None, the value of
+        get_default_cache_dir() is used.
+
+        max_workers specifies how many objects are downloaded concurrently;
+        it also limits the number of concurrent ranged GETs per object.
+
+        Objects of at least multipart_threshold bytes are downloaded in
+        part_size chunks.
+
+        region specifies the S3 region to connect to.  If None, the region
+        of the current instance is used.
+        """
+        self.cache_dir = (
+            cache_dir if cache_dir is not None else get_default_cache_dir())
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.region = region if region is not None else get_region()
+        self._local = local()
+
+        for subdir in ["objects", "index", "tmp"]:
+            _makedirs(path_join(self.cache_dir, subdir))
+        return
+
+    @property
+    def s3(self):
+        """
+        The S3 connection for the current thread.  boto connections are not
+        thread-safe, so each worker thread gets its own.
+        """
+        s3 = getattr(self._local, "s3", None)
+        if s3 is None:
+            s3 = boto.s3.connect_to_region(self.region)
+            if s3 is None:
+                raise ValueError("Unable to connect to S3 endpoint in region "
+                                 "%r" % (self.region,))
+            self._local.s3 = s3
+        return s3
+
+    def get_bucket(self, bucket_name):
+        return self.s3.get_bucket(bucket_name, validate=False)
+
+    def object_path(self, digest):
+        """
+        Returns the cache path for an object with the given sha256 digest.
+        """
+        return path_join(self.cache_dir, "objects", digest[:2], digest)
+
+    def _index_path(self, url, etag, size):
+        index_key = sha1("%s\0%s\0%d" % (url, etag, size)).hexdigest()
+        return path_join(self.cache_dir, "index", index_key)
+
+    def lookup(self, url, etag, size):
+        """
+        Returns the cache path of the object at url with the given ETag and
+        size, or None if it is not cached.
+        """
+        try:
+            with open(self._index_path(url, etag, size), "r") as fd:
+                digest = fd.read().strip()
+        except IOError:
+            return None
+
+        path = self.object_path(digest)
+        try:
+            if getsize(path) != size:
+                return None
+        except OSError:
+            return None
+
+        # Bump the modification time so eviction can find least recently
+        # used objects.
+        utime(path, None)
+        return path
+
+    def fetch(self, url, dest, key=None):
+        """
+        fetcher.fetch(url, dest, key=None) -> dest
+
+        Download the object at url to dest, using the cache if possible.
+        key, if specified, is a boto.s3.key.Key for the object obtained from
+        a listing; this avoids a HEAD request if the object is cached.
+        """
+        path = None
+        if key is not None:
+            path = self.lookup(url, key.etag.strip('"'), int(key.size))
+
+        if path is None:
+            # Listings don't include user metadata, which holds the sha256
+            # digest _download() checks, so get the object's own headers.
+            bucket_name, key_name = parse_s3_url(url)
+            key = self.get_bucket(bucket_name).get_key(key_name)
+            if key is None:
+                raise ValueError("S3 object not found: %s" % (url,))
+
+            etag = key.etag.strip('"')
+            size = int(key.size)
+
+            path = self.lookup(url, etag, size)
+            if path is None:
+                path = self._download(url, key, etag, size)
+
+        link_or_copy(path, dest)
+        return dest
+
+    def fetch_all(self, urls, dest_dir):
+        """
+        fetcher.fetch_all(urls, dest_dir) -> [filename, ...]
+
+        Download each URL in urls into dest_dir concurrently.
+        """
+        return parallel_map(
+            lambda url: self.fetch(url, path_join(
+                dest_dir, url.rstrip("/").rsplit("/", 1)[-1])),
+            urls, self.max_workers)
+
+    def fetch_prefix(self, url, dest_dir):
+        """
+        fetcher.fetch_prefix(url, dest_dir) -> [filename, ...]
+
+        Download every object under the S3 prefix url into dest_dir,
+        preserving relative paths (like "aws s3 sync").
+        """
+        bucket_name, prefix = parse_s3_url(url)
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+
+        bucket = self.get_bucket(bucket_name)
+        keys = [key for key in bucket.list(prefix=prefix)
+                if not key.name.endswith("/")]
+
+        return parallel_map(
+            lambda key: self.fetch(
+                "s3://%s/%s" % (bucket_name, key.name),
+                path_join(dest_dir, key.name[len(prefix):]), key=key),
+            keys, self.max_workers)
+
+    def evict(self, max_size, paths=(), min_age=EVICTION_MIN_AGE):
+        """
+        fetcher.evict(max_size, paths=(), min_age=EVICTION_MIN_AGE) -> [path]
+
+        Evict least recently used cached objects, along with the given
+        files and directories (e.g. old run directories populated from the
+        cache), until they use at most max_size bytes.  See evict_lru().
+        """
+        objects = glob(path_join(self.cache_dir, "objects", "*", "*"))
+        removed = evict_lru(list(objects) + list(paths), max_size, min_age)
+
+        # Drop index entries for evicted objects.
+        if removed:
+            for index_path in glob(path_join(self.cache_dir, "index", "*")):
+                try:
+                    with open(index_path, "r") as fd:
+                        digest = fd.read().strip()
+                    lstat(self.object_path(digest))
+                except (IOError, OSError):
+                    try:
+                        unlink(index_path)
+                    except OSError:
+                        pass
+
+        return removed
+
+    def _download(self, url, key, etag, size):
+        fd, tmp_path = mkstemp(dir=path_join(self.cache_dir, "tmp"))
+        try:
+            fp = fdopen(fd, "wb")
+            if size >= self.multipart_threshold:
+                # Preallocate the file so each part can be written in place.
+                fp.truncate(size)
+                fp.close()
+                self._download_parts(key, tmp_path, size)
+            else:
+                key.get_contents_to_file(fp)
+                fp.close()
+
+            if getsize(tmp_path) != size:
+                raise ChecksumError("Size mismatch for %s: expected %d, got "
+                                    "%d" % (url, size, getsize(tmp_path)))
+
+            md5_digest, digest = _file_digests(tmp_path)
+
+            # Single-part uploads have the MD5 as their ETag; multipart
+            # uploads have a "-<parts>" suffix and can't be checked this way.
+            if "-" not in etag and md5_digest != etag:
+                raise ChecksumError("MD5 mismatch for %s: expected %s, got %s"
+                                    % (url, etag, md5_digest))
+
+            expected = key.get_metadata("sha256")
+            if expected is not None and expected != digest:
+                raise ChecksumError("SHA-256 mismatch for %s: expected %s, "
+                                    "got %s" % (url, expected, digest))
+
+            path = self.object_path(digest)
+            _makedirs(dirname(path))
+            chmod(tmp_path, 0o444)
+            rename(tmp_path, path)
+        except:
+            try:
+                unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        index_path = self._index_path(url, etag, size)
+        fd, tmp_index = mkstemp(dir=path_join(self.cache_dir, "tmp"))
+        with fdopen(fd, "w") as fp:
+            fp.write(digest + "\n")
+        rename(tmp_index, index_path)
+
+        return path
+
+    def _download_parts(self, key, filename, size):
+        bucket_name = key.bucket.name
+        key_name = key.name
+        ranges = [(start, min(start + self.part_size, size) - 1)
+                  for start in xrange(0, size, self.part_size)]
+
+        def download_part(byte_range):
+            start, end = byte_range
+            part_key = self.get_bucket(bucket_name).new_key(key_name)
+            with open(filename, "r+b") as fp:
+                fp.seek(start)
+                part_key.get_contents_to_file(
+                    fp, headers={"Range": "bytes=%d-%d" % (start, end)})
+            return
+
+        parallel_map(download_part, ranges, self.max_workers)
+        return
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description=("Download S3 objects concurrently through a local "
+                     "content-addressed cache."))
+    parser.add_argument(
+        "--cache-dir", "-c",
+        help=("The cache directory.  Defaults to /ephemeral/slurm-ec2-cache "
+              "if /ephemeral is writable, otherwise "
+              "/var/tmp/slurm-ec2-cache."))
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=MAX_WORKERS,
+        help=("The number of concurrent downloads.  Defaults to %d." %
+              MAX_WORKERS))
+    parser.add_argument(
+        "--part-size", type=int, default=PART_SIZE >> 20,
+        help=("The size of ranged GET requests for large objects, in MB.  "
+              "Defaults to %d." % (PART_SIZE >> 20)))
+    parser.add_argument(
+        "--region", "-r",
+        help=("The AWS region to use.  If unspecified, the region of the "
+              "current instance is used."))
+    parser.add_argument(
+        "--recursive", "-R", action="store_true", default=False,
+        help=("Treat each URL as a prefix and download all objects beneath "
+              "it into the destination directory."))
+    parser.add_argument(
+        "--dest", "-d", default=".",
+        help=("The destination directory.  Defaults to the current "
+              "directory."))
+    parser.add_argument(
+        "--output", "-o",
+        help=("Write the single object specified to the given filename."))
+    parser.add_argument(
+        "--evict", metavar="SIZE",
+        help=("After downloading, evict least recently used cache objects "
+              "and --evict-path entries until they use at most SIZE (e.g. "
+              "50G, or 80%% of the cache filesystem)."))
+    parser.add_argument(
+        "--evict-path", action="append", default=[], metavar="GLOB",
+        help=("Also consider the files or directories matching GLOB for "
+              "eviction.  Directories containing a locked %s file, and "
+              "locked files, are kept.  May be specified multiple times." %
+              LOCK_FILENAME))
+    parser.add_argument("urls", nargs="*", metavar="s3-url")
+
+    args = parser.parse_args()
+
+    if not args.urls and args.evict is None:
+        parser.error("No URLs specified")
+
+    if args.output is not None and (args.recursive or len(args.urls) != 1):
+        print("--output requires exactly one non-recursive URL", file=stderr)
+        return 1
+
+    fetcher = Fetcher(cache_dir=args.cache_dir, max_workers=args.jobs,
+                      part_size=args.part_size << 20, region=args.region)
+
+    try:
+        if args.output is not None:
+            filenames = [fetcher.fetch(args.urls[0], args.output)]
+        elif args.recursive:
+            filenames = []
+            for url in args.urls:
+                filenames.extend(fetcher.fetch_prefix(url, args.dest))
+        else:
+            filenames = fetcher.fetch_all(args.urls, args.dest)
+    except Exception as e:
+        print("Download failed: %s" % (e,), file=stderr)
+        return 1
+
+    for filename in filenames:
+        print(filename)
+
+    if args.evict is not None:
+        paths = []
+        for pattern in args.evict_path:
+            paths.extend(glob(pattern))
+
+        try:
+            removed = fetcher.evict(
+                parse_size(args.evict, fetcher.cache_dir), paths)
+        except (IOError, OSError, ValueError) as e:
+            print("Eviction failed: %s" % (e,), file=stderr)
+            return 1
+
+        for path in removed:
+            print("Evicted %s" % (path,), file=stderr)
+
+    return 0
@@ -0,0 +1,411 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from bisect import bisect_left
+from mmap import mmap, ACCESS_READ
+from os import stat
+from socket import (
+    AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, inet_aton, inet_ntoa,
+    socket, timeout as SocketTimeout)
+from struct import calcsize, error as StructError, pack, unpack, unpack_from
+from sys import stderr
+from threading import Thread
+from time import time
+
+# With tens of thousands of nodes, /etc/hosts becomes a large file which glibc
+# scans linearly on every lookup.  The hosts database stores node addresses in
+# a compact binary file indexed by node name (O(1)) and by address
+# (O(log n)); the resolver serves it over DNS on localhost and forwards all
+# other queries upstream.
+
+HOSTS_DB_FILENAME = "/etc/slurm-ec2-hosts.db"
+
+# File layout (all integers big-endian):
+#   header: magic, version, number of pools, number of nodes, domain length
+#   domain: the DNS domain for nodes (e.g. us-west-2.compute.internal)
+#   pools: for each pool, prefix length, prefix, first node, node count
+#   forward table: node count IPv4 addresses, in pool order
+#   reverse table: node count (IPv4 address, node) pairs sorted by address
+MAGIC = b"SEHD"
+VERSION = 1
+HEADER_FORMAT = "!4sHHIH"
+POOL_FORMAT = "!II"
+REVERSE_FORMAT = "!II"
+
+DNS_PORT = 53
+DNS_TTL = 300
+FORWARD_TIMEOUT = 5.0
+AWS_DNS_SERVER = "169.254.169.253"
+
+# DNS constants
+TYPE_A = 1
+TYPE_PTR = 12
+CLASS_IN = 1
+RCODE_NXDOMAIN = 3
+
+def ip_to_int(addr):
+    return unpack("!I", inet_aton(str(addr)))[0]
+
+def int_to_ip(value):
+    return inet_ntoa(pack("!I", value))
+
+def build_hosts_db(cc):
+    """
+    build_hosts_db(cc) -> str
+
+    Returns the contents of the hosts database for the given
+    ClusterConfiguration.
+    """
+    domain = ("%s.compute.internal" % cc.region).encode("ascii")
+    pools = []
+    forward = []
+    for pool in cc.node_pools:
+        addresses = [ip_to_int(addr) for addr in pool.addresses]
+        prefix = pool.hostname_prefix.encode("ascii")
+        pools.append(pack("!B", len(prefix)) + prefix +
+                     pack(POOL_FORMAT, len(forward), len(addresses)))
+        forward.extend(addresses)
+
+    reverse = sorted((addr, i) for i, addr in enumerate(forward))
+
+    parts = [pack(HEADER_FORMAT, MAGIC, VERSION, len(pools), len(forward),
+                  len(domain)), domain]
+    parts.extend(pools)
+    parts.append(pack("!%dI" % len(forward), *forward))
+    parts.extend(pack(REVERSE_FORMAT, addr, i) for addr, i in reverse)
+    return b"".join(parts)
+
+class _SortedAddresses(object):
+    """
+    Presents the addresses in the reverse table as a sequence for bisect,
+    without copying them out of the mapping.
+    """
+    def __init__(self, mm, offset, count):
+        self.mm = mm
+        self.offset = offset
+        self.count = count
+        return
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return unpack_from(
+            "!I", self.mm, self.offset + calcsize(REVERSE_FORMAT) * i)[0]
+
+class HostsDatabase(object):
+    """
+    Read-only access to a hosts database written by build_hosts_db().
+    The file is memory-mapped, so opening it is cheap regardless of size.
+    """
+
+    def __init__(self, filename=HOSTS_DB_FILENAME):
+        self.filename = filename
+        with open(filename, "rb") as fd:
+            self.mm = mmap(fd.fileno(), 0, access=ACCESS_READ)
+
+        magic, version, n_pools, self.n_nodes, domain_length = unpack_from(
+            HEADER_FORMAT, self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a hosts database" % (filename,))
+
+        offset = calcsize(HEADER_FORMAT)
+        self.domain = self.mm[offset:offset + domain_length].decode("ascii")
+        offset += domain_length
+
+        # Pools are kept as (prefix, first node, node count).
+        self.pools = []
+        for i in xrange(n_pools):
+            prefix_length = unpack_from("!B", self.mm, offset)[0]
+            offset += 1
+            prefix = self.mm[offset:offset + prefix_length].decode("ascii")
+            offset += prefix_length
+            first, count = unpack_from(POOL_FORMAT, self.mm, offset)
+            offset += calcsize(POOL_FORMAT)
+            self.pools.append((prefix, first, count))
+
+        self.forward_offset = offset
+        self.reverse_offset = offset + 4 * self.n_nodes
+        return
+
+    def close(self):
+        self.mm.close()
+        return
+
+    def _strip_domain(self, name):
+        name = name.rstrip(".").lower()
+        suffix = "." + self.domain
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+        return name
+
+    def _node_index(self, name):
+        name = self._strip_domain(name)
+        for prefix, first, count in self.pools:
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                index = int(name[len(prefix):])
+                if index < count:
+                    return first + index
+        return None
+
+    def lookup_name(self, name):
+        """
+        Returns the address (as a string) of the node with the given name,
+        which may be qualified with the database's domain, or None.
+        """
+        i = self._node_index(name)
+        if i is None:
+            return None
+        return int_to_ip(unpack_from("!I", self.mm,
+                                     self.forward_offset + 4 * i)[0])
+
+    def get_nodename(self, i):
+        for prefix, first, count in self.pools:
+            if first <= i < first + count:
+                return "%s%d" % (prefix, i - first)
+        return None
+
+    def lookup_address(self, addr):
+        """
+        Returns the node name for the given address, or None.
+        """
+        value = ip_to_int(addr)
+        i = bisect_left(_SortedAddresses(self.mm, self.reverse_offset,
+                                         self.n_nodes), value)
+        if i >= self.n_nodes:
+            return None
+
+        found, node = unpack_from(
+            REVERSE_FORMAT, self.mm,
+            self.reverse_offset + calcsize(REVERSE_FORMAT) * i)
+        if found != value:
+            return None
+        return self.get_nodename(node)
+
+def get_upstream_servers(resolv_conf="/etc/resolv.conf"):
+    """
+    Returns the non-local nameservers listed in resolv.conf, or the AWS
+    DNS server if there are none.
+    """
+    servers = []
+    try:
+        with open(resolv_conf, "r") as fd:
+            for line in fd:
+                parts = line.split()
+                if (len(parts) >= 2 and parts[0] == "nameserver" and
+                    not parts[1].startswith("127.")):
+                    servers.append(parts[1])
+    except IOError:
+        pass
+    return servers or [AWS_DNS_SERVER]
+
+def parse_dns_query(packet):
+    """
+    parse_dns_query(packet) -> (id, flags, name, qtype, qclass, end)
+
+    Parse the first question of a DNS query.  end is the offset just past
+    the question.
+    """
+    qid, flags, qdcount = unpack_from("!HHH", packet, 0)
+    if qdcount < 1:
+        raise ValueError("No question in query")
+
+    offset = 12
+    labels = []
+    while True:
+        length = unpack_from("!B", packet, offset)[0]
+        offset += 1
+        if length == 0:
+            break
+        if length & 0xc0:
+            raise ValueError("Compressed name in question")
+        labels.append(packet[offset:offset + length].decode("ascii"))
+        offset += length
+
+    qtype, qclass = unpack_from("!HH", packet, offset)
+    return qid, flags, ".".join(labels), qtype, qclass, offset + 4
+
+def encode_dns_name(name):
+    return b"".join(pack("!B", len(label)) + label.encode("ascii")
+                    for label in name.rstrip(".").split(".")) + b"\0"
+
+def build_dns_response(packet, qid, flags, end, answers, rcode=0):
+    """
+    Build an authoritative response to the query in packet echoing its first
+    question; answers is a list of (type, rdata) tuples.
+    """
+    # QR, AA, copy RD, RA
+    resp_flags = 0x8000 | 0x0400 | (flags & 0x0100) | 0x0080 | rcode
+    parts = [pack("!HHHHHH", qid, resp_flags, 1, len(answers), 0, 0),
+             packet[12:end]]
+    for rtype, rdata in answers:
+        # 0xc00c is a pointer to the name in the question.
+        parts.append(pack("!HHHIH", 0xc00c, rtype, CLASS_IN, DNS_TTL,
+                          len(rdata)))
+        parts.append(rdata)
+    return b"".join(parts)
+
+class StubResolver(object):
+    """
+    A stub DNS responder which answers A and PTR queries for SLURM nodes
+    from a hosts database and forwards everything else upstream.
+
+    The database is reopened when the file is replaced, so configuration
+    changes are picked up without restarting the resolver.
+    """
+
+    def __init__(self, filename=HOSTS_DB_FILENAME, address="127.0.0.1",
+                 port=DNS_PORT, upstream=None):
+        self.filename = filename
+        self.upstream = upstream if upstream else get_upstream_servers()
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock.bind((address, port))
+        self.db = None
+        self.db_stat = None
+        self.last_check = 0
+        self.reload()
+        return
+
+    def reload(self):
+        """
+        Reopen the hosts database if it has been replaced.
+        """
+        try:
+            st = stat(self.filename)
+        except OSError:
+            return
+
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        if key != self.db_stat:
+            try:
+                db = HostsDatabase(self.filename)
+            except (IOError, ValueError, StructError) as e:
+                print("Unable to load %s: %s" % (self.filename, e),
+                      file=stderr)
+                return
+            if self.db is not None:
+                self.db.close()
+            self.db = db
+            self.db_stat = key
+        return
+
+    def answer(self, packet):
+        """
+        Returns a response for the given query, or None if it should be
+        forwarded upstream.
+        """
+        qid, flags, name, qtype, qclass, end = parse_dns_query(packet)
+        if self.db is None or qclass != CLASS_IN:
+            return None
+
+        lname = name.lower()
+        if lname.endswith(".in-addr.arpa"):
+            octets = lname[:-len(".in-addr.arpa")].split(".")
+            if len(octets) != 4:
+                return None
+            nodename = self.db.lookup_address(".".join(reversed(octets)))
+            if nodename is None:
+                return None
+            answers = []
+            if qtype == TYPE_PTR:
+                answers.append((TYPE_PTR, encode_dns_name(
+                    "%s.%s" % (nodename, self.db.domain))))
+            return build_dns_response(packet, qid, flags, end, answers)
+
+        addr = self.db.lookup_name(lname)
+        if addr is None:
+            return None
+
+        # The name exists; answer other types (e.g. AAAA) with no records
+        # rather than making the client wait on upstream.
+        answers = []
+        if qtype == TYPE_A:
+            answers.append((TYPE_A, inet_aton(addr)))
+        return build_dns_response(packet, qid, flags, end, answers)
+
+    def forward(self, packet, client):
+        """
+        Relay a query to the upstream servers and the first response back to
+        the client.
+        """
+        upstream = socket(AF_INET, SOCK_DGRAM)
+        upstream.settimeout(FORWARD_TIMEOUT / len(self.upstream))
+        try:
+            for server in self.upstream:
+                try:
+                    upstream.sendto(packet, (server, DNS_PORT))
+                    response, _ = upstream.recvfrom(65535)
+                    self.sock.sendto(response, client)
+                    return
+                except (SocketTimeout, IOError):
+                    continue
+        finally:
+            upstream.close()
+        return
+
+    def serve_forever(self):
+        while True:
+            packet, client = self.sock.recvfrom(65535)
+
+            # Check for a new database at most once a second.
+            now = time()
+            if now - self.last_check >= 1:
+                self.reload()
+                self.last_check = now
+
+            try:
+                response = self.answer(packet)
+            except Exception:
+                # Malformed (or unsupported) query; let upstream decide.
+                response = None
+
+            if response is not None:
+                self.sock.sendto(response, client)
+            else:
+                thread = Thread(target=self.forward, args=(packet, client))
+                thread.daemon = True
+                thread.start()
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description=("Serve SLURM node names from a hosts database over DNS, "
+                     "forwarding other queries upstream."))
+    parser.add_argument(
+        "--hosts-db", "-d", default=HOSTS_DB_FILENAME,
+        help=("The hosts database written by slurm-ec2-clusterconfig "
+              "--write-hosts-db.  Defaults to %s." % HOSTS_DB_FILENAME))
+    parser.add_argument(
+        "--address", "-a", default="127.0.0.1",
+        help=("The address to listen on.  Defaults to 127.0.0.1."))
+    parser.add_argument(
+        "--port", "-p", type=int, default=DNS_PORT,
+        help=("The port to listen on.  Defaults to %d." % DNS_PORT))
+    parser.add_argument(
+        "--upstream", "-u", action="append",
+        help=("An upstream nameserver.  May be repeated.  Defaults to the "
+              "non-local nameservers in /etc/resolv.conf."))
+    parser.add_argument(
+        "--query", "-q", action="append",
+        help=("Look up the given node name or address in the hosts database "
+              "and exit instead of serving."))
+    args = parser.parse_args()
+
+    if args.query:
+        db = HostsDatabase(args.hosts_db)
+        result = 0
+        for query in args.query:
+            if query.replace(".", "").isdigit():
+                answer = db.lookup_address(query)
+            else:
+                answer = db.lookup_name(query)
+            if answer is None:
+                result = 1
+            print("%s %s" % (query, answer if answer is not None else "-"))
+        return result
+
+    resolver = StubResolver(args.hosts_db, args.address, args.port,
+                            args.upstream)
+    resolver.serve_forever()
+    return 0
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 from __future__ import absolute_import, print_function
-import boto.ec2 
 from boto.utils import get_instance_metadata
+from .ratelimit import connect_ec2
 
 """
 Details about the current instance.
@@ -47,6 +47,12 @@ def get_instance_id():
     """
     return get_metadata()['instance-id']
 
+def get_instance_type():
+    """
+    Returns the instance type of this instance.
+    """
+    return get_metadata()['instance-type']
+
 def get_instance():
     """
     Returns the boto.ec2.Instance object for this instance.
@@ -58,7 +64,7 @@ def get_instance():
     except NameError:
         region = get_region()
         instance_id = get_instance_id()
-        ec2 = boto.ec2.connect_to_region(region)
+        ec2 = connect_ec2(region)
         if ec2 is None:
             raise ValueError("Unable to connect to EC2 endpoint in region %r" %
                              (region,))
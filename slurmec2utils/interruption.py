@@ -0,0 +1,156 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from json import loads as json_loads
+from os import environ
+from socket import gethostname
+from subprocess import call
+from sys import stderr
+from threading import Event, Thread
+from urllib2 import HTTPError, URLError, urlopen
+
+# The instance metadata service; SLURM_EC2_METADATA_URL overrides this (e.g.
+# to point at a fake endpoint for testing).
+DEFAULT_METADATA_URL = "http://169.254.169.254"
+
+# How often to check for a termination notice, in seconds.  EC2 gives two
+# minutes of warning.
+POLL_INTERVAL = 5
+
+METADATA_TIMEOUT = 2
+
+def get_metadata_url():
+    return environ.get("SLURM_EC2_METADATA_URL", DEFAULT_METADATA_URL)
+
+def get_spot_interruption(metadata_url=None):
+    """
+    get_spot_interruption(metadata_url=None) -> dict | None
+
+    Returns the pending spot interruption notice (e.g.
+    {"action": "terminate", "time": "2015-01-05T18:02:00Z"}), or None if
+    there is none.
+    """
+    if metadata_url is None:
+        metadata_url = get_metadata_url()
+    base = metadata_url.rstrip("/") + "/latest/meta-data/spot/"
+
+    try:
+        body = urlopen(base + "instance-action",
+                       timeout=METADATA_TIMEOUT).read()
+        return json_loads(body)
+    except HTTPError as e:
+        if e.code != 404:
+            raise
+    except ValueError:
+        return {"action": "terminate", "time": None}
+
+    # Older instances only publish the termination time.
+    try:
+        body = urlopen(base + "termination-time",
+                       timeout=METADATA_TIMEOUT).read()
+        return {"action": "terminate", "time": body.strip()}
+    except HTTPError as e:
+        if e.code != 404:
+            raise
+    return None
+
+def drain_node(nodename=None, reason="spot interruption"):
+    """
+    Drain the given node (by default, this one) in SLURM so no new jobs are
+    scheduled on it.  Returns True on success.
+    """
+    if nodename is None:
+        nodename = gethostname().split(".")[0]
+    try:
+        result = call(["scontrol", "update", "NodeName=%s" % nodename,
+                       "State=DRAIN", "Reason=%s" % reason])
+    except OSError as e:
+        print("Unable to run scontrol: %s" % (e,), file=stderr)
+        return False
+    return result == 0
+
+class SpotInterruptionWatcher(Thread):
+    """
+    A daemon thread which polls the instance metadata service for a spot
+    interruption notice and calls callback(notice) once when one appears.
+    """
+
+    def __init__(self, callback, metadata_url=None,
+                 poll_interval=POLL_INTERVAL):
+        super(SpotInterruptionWatcher, self).__init__(
+            name="SpotInterruptionWatcher")
+        self.daemon = True
+        self.callback = callback
+        self.metadata_url = (metadata_url if metadata_url is not None
+                             else get_metadata_url())
+        self.poll_interval = poll_interval
+        self.notice = None
+        self._stop_event = Event()
+        return
+
+    def stop(self):
+        self._stop_event.set()
+        return
+
+    def check(self):
+        """
+        Check for a notice once.  Returns the notice or None.
+        """
+        try:
+            notice = get_spot_interruption(self.metadata_url)
+        except (HTTPError, URLError, IOError) as e:
+            print("Unable to query spot interruption status: %s" % (e,),
+                  file=stderr)
+            return None
+
+        if notice is not None and notice.get("action") in (
+                "terminate", "stop", "hibernate"):
+            return notice
+        return None
+
+    def run(self):
+        while not self._stop_event.is_set():
+            notice = self.check()
+            if notice is not None:
+                self.notice = notice
+                print("Spot interruption notice: %r" % (notice,))
+                self.callback(notice)
+                return
+            self._stop_event.wait(self.poll_interval)
+        return
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description=("Wait for a spot interruption notice, then drain this "
+                     "node in SLURM."))
+    parser.add_argument(
+        "--metadata-url", default=None,
+        help=("The instance metadata service URL.  Defaults to "
+              "$SLURM_EC2_METADATA_URL or %s." % DEFAULT_METADATA_URL))
+    parser.add_argument(
+        "--once", action="store_true", default=False,
+        help=("Check once and exit with status 0 if a notice is pending, 1 "
+              "otherwise."))
+    parser.add_argument(
+        "--no-drain", action="store_true", default=False,
+        help=("Don't drain the node when a notice appears."))
+    args = parser.parse_args()
+
+    watcher = SpotInterruptionWatcher(
+        lambda notice: None, metadata_url=args.metadata_url)
+
+    if args.once:
+        notice = watcher.check()
+        if notice is None:
+            return 1
+        print("%s %s" % (notice.get("action"), notice.get("time")))
+        return 0
+
+    watcher.start()
+    while watcher.is_alive():
+        watcher.join(60)
+
+    if not args.no_drain:
+        drain_node()
+    return 0
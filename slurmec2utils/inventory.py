@@ -0,0 +1,313 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from calendar import timegm
+from .clusterconfig import ClusterConfiguration, expand_hostlist
+from errno import EEXIST
+from .instanceinfo import get_region
+from os import makedirs
+from os.path import dirname
+from .ratelimit import connect_ec2
+import sqlite3
+from sys import stderr
+from time import gmtime, sleep, strftime, strptime, time
+
+INVENTORY_FILENAME = "/var/slurm/ec2-inventory.db"
+DEFAULT_REFRESH_INTERVAL = 60
+
+# Instance states which mean a node has (or will shortly have) an instance.
+LIVE_STATES = ("pending", "running")
+
+# Instance states for which an instance still needs to be terminated.
+TERMINABLE_STATES = ("pending", "running", "stopping", "stopped")
+
+# Entries updated more recently than this are trusted without asking EC2.
+TRUST_PERIOD = 3 * DEFAULT_REFRESH_INTERVAL
+
+# Entries updated more recently than this aren't marked terminated by a
+# refresh if they're missing; DescribeInstances lags behind RunInstances.
+REFRESH_GRACE = 120
+
+# Terminated entries are purged after this many seconds.
+TERMINATED_RETENTION = 24 * 60 * 60
+
+def parse_aws_time(value):
+    """
+    Convert an AWS timestamp (e.g. "2015-01-02T03:04:05.000Z") into seconds
+    since the epoch.
+    """
+    return timegm(strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+
+def get_slurm_instances(ec2, filters=None):
+    """
+    get_slurm_instances(ec2, filters=None) -> [boto.ec2.instance.Instance]
+
+    Returns all pending, running, stopping and stopped instances which have
+    a SLURMHostname tag, with additional filters applied.  boto pages through
+    the results, so this scales to large clusters.
+    """
+    all_filters = {
+        "tag-key": "SLURMHostname",
+        "instance-state-name": ["pending", "running", "stopping", "stopped"],
+    }
+    if filters is not None:
+        all_filters.update(filters)
+    return ec2.get_only_instances(filters=all_filters, max_results=1000)
+
+class Inventory(object):
+    """
+    A local database of compute node instances.
+
+    Each row maps an instance id to its node name, state, launch time,
+    lifecycle ("spot" or "ondemand") and instance type.  Rows are updated by
+    slurm-ec2-resume and slurm-ec2-suspend as they act and refreshed in bulk
+    from a single paginated DescribeInstances call.
+
+    Connections are not thread-safe; use one Inventory per thread.
+    """
+
+    schema = """
+CREATE TABLE IF NOT EXISTS instances (
+    instance_id TEXT PRIMARY KEY,
+    nodename TEXT NOT NULL,
+    state TEXT NOT NULL,
+    launch_time REAL,
+    lifecycle TEXT,
+    instance_type TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_nodename ON instances (nodename);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+    columns = ["instance_id", "nodename", "state", "launch_time", "lifecycle",
+               "instance_type", "updated"]
+
+    def __init__(self, filename=INVENTORY_FILENAME):
+        try:
+            makedirs(dirname(filename))
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.schema)
+        return
+
+    def close(self):
+        self.db.close()
+        return
+
+    def get_instances(self, nodename=None, states=None):
+        """
+        inventory.get_instances(nodename=None, states=None) -> [sqlite3.Row]
+
+        Returns the inventory rows for the given node (or all nodes) whose
+        state is in states (or any state).
+        """
+        query = "SELECT * FROM instances"
+        where = []
+        params = []
+        if nodename is not None:
+            where.append("nodename = ?")
+            params.append(nodename)
+        if states is not None:
+            where.append("state IN (%s)" % ",".join("?" * len(states)))
+            params.extend(states)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY nodename, launch_time"
+        return self.db.execute(query, params).fetchall()
+
+    def get_live_instances(self, nodename):
+        """
+        Returns the rows for instances which are live for the given node.
+        """
+        return self.get_instances(nodename, LIVE_STATES)
+
+    def record(self, instance_id, nodename, state, launch_time=None,
+               lifecycle=None, instance_type=None):
+        """
+        Insert or replace the row for the given instance.
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO instances (%s) VALUES (?,?,?,?,?,?,?)"
+                % ",".join(self.columns),
+                (instance_id, nodename, state, launch_time, lifecycle,
+                 instance_type, time()))
+        return
+
+    def set_state(self, instance_ids, state):
+        """
+        Set the state of the given instances.
+        """
+        with self.db:
+            self.db.executemany(
+                "UPDATE instances SET state = ?, updated = ? "
+                "WHERE instance_id = ?",
+                [(state, time(), instance_id) for instance_id in instance_ids])
+        return
+
+    def delete(self, instance_ids):
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM instances WHERE instance_id = ?",
+                [(instance_id,) for instance_id in instance_ids])
+        return
+
+    def update_from_instances(self, instances):
+        """
+        Replace the instance rows with the given list of boto instances (as
+        returned by get_slurm_instances).  Instances which are no longer
+        returned are marked terminated.
+        """
+        now = time()
+        seen = set()
+        rows = []
+        for instance in instances:
+            nodename = instance.tags.get("SLURMHostname")
+            if nodename is None:
+                continue
+            seen.add(instance.id)
+            rows.append((
+                instance.id, nodename, instance.state,
+                parse_aws_time(instance.launch_time),
+                "spot" if getattr(instance, "spot_instance_request_id", None)
+                else "ondemand",
+                instance.instance_type, now))
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO instances (%s) VALUES (?,?,?,?,?,?,?)"
+                % ",".join(self.columns), rows)
+
+            # Anything we didn't see is gone.
+            stale = [row["instance_id"] for row in self.db.execute(
+                "SELECT instance_id FROM instances WHERE state != "
+                "'terminated' AND updated < ?", (now - REFRESH_GRACE,))
+                     if row["instance_id"] not in seen]
+            self.db.executemany(
+                "UPDATE instances SET state = 'terminated', updated = ? "
+                "WHERE instance_id = ?",
+                [(now, instance_id) for instance_id in stale])
+
+            self.db.execute(
+                "DELETE FROM instances WHERE state = 'terminated' AND "
+                "updated < ?", (now - TERMINATED_RETENTION,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES "
+                "('last_refresh', ?)", (str(now),))
+        return
+
+    def refresh(self, ec2, cc):
+        """
+        Refresh the inventory from EC2 with a single paginated
+        DescribeInstances call.  Returns the list of boto instances.
+        """
+        instances = get_slurm_instances(
+            ec2, filters={"tag:SLURMS3Root": cc.slurm_s3_root})
+        self.update_from_instances(instances)
+        return instances
+
+    @property
+    def last_refresh(self):
+        """
+        The time of the last refresh, or None if the inventory has never
+        been refreshed.
+        """
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'last_refresh'").fetchone()
+        return float(row["value"]) if row is not None else None
+
+def open_inventory(filename=INVENTORY_FILENAME):
+    """
+    Returns an Inventory, or None (after logging the error) if it can't be
+    opened.  Callers fall back to querying EC2 directly in that case.
+    """
+    try:
+        return Inventory(filename)
+    except (sqlite3.Error, OSError) as e:
+        print("Unable to open inventory %s: %s" % (filename, e), file=stderr)
+        return None
+
+def format_time(value):
+    if value is None:
+        return "-"
+    return strftime("%Y-%m-%dT%H:%M:%SZ", gmtime(value))
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Query or refresh the local SLURM EC2 instance inventory")
+    parser.add_argument(
+        "--inventory", default=INVENTORY_FILENAME,
+        help=("The inventory database.  Defaults to %s." %
+              INVENTORY_FILENAME))
+    subparsers = parser.add_subparsers(dest="command")
+
+    refresh_parser = subparsers.add_parser(
+        "refresh", help="Refresh the inventory from EC2.")
+    refresh_parser.add_argument(
+        "--interval", "-i", type=int,
+        help=("Keep refreshing every interval seconds instead of exiting."))
+
+    list_parser = subparsers.add_parser(
+        "list", help="List inventory entries.")
+    list_parser.add_argument(
+        "--all", "-a", action="store_true", default=False,
+        help="Include terminated instances.")
+    list_parser.add_argument(
+        "hostlist", nargs="?",
+        help="Only list nodes in the given SLURM hostlist.")
+
+    args = parser.parse_args()
+    inventory = Inventory(args.inventory)
+
+    if args.command == "refresh":
+        cc = ClusterConfiguration.from_config()
+        region = get_region()
+        ec2 = connect_ec2(region)
+        if ec2 is None:
+            print("Could not connect to EC2 endpoint in region %r" %
+                  (region,), file=stderr)
+            return 1
+
+        while True:
+            try:
+                instances = inventory.refresh(ec2, cc)
+                print("Inventory refreshed: %d instance(s)" % len(instances))
+            except Exception as e:
+                print("Inventory refresh failed: %s" % (e,), file=stderr)
+                if args.interval is None:
+                    return 1
+
+            if args.interval is None:
+                break
+            sleep(args.interval)
+
+        return 0
+
+    states = None if args.all else TERMINABLE_STATES
+    if args.hostlist is not None:
+        rows = []
+        for nodename in expand_hostlist(args.hostlist):
+            rows.extend(inventory.get_instances(nodename, states))
+    else:
+        rows = inventory.get_instances(states=states)
+
+    for row in rows:
+        print("%s %s %s %s %s %s" % (
+            row["nodename"], row["instance_id"], row["state"],
+            row["lifecycle"] or "-", row["instance_type"] or "-",
+            format_time(row["launch_time"])))
+
+    print("Last refresh: %s" % format_time(inventory.last_refresh),
+          file=stderr)
+    return 0
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from datetime import datetime, timedelta
+from importlib import import_module
+from .ratelimit import connect_ec2, connect_vpc
+from .statefile import StateFile
+from sys import stderr
+from time import time
+
+# Launch failures per availability zone; written by slurm-ec2-resume.
+LAUNCH_FAILURES_FILENAME = "/var/slurm/ec2-launch-failures.json"
+
+# Launch failures older than this many seconds are forgotten.
+LAUNCH_FAILURE_WINDOW = 24 * 60 * 60
+
+# Cached spot prices per instance type.
+SPOT_PRICES_FILENAME = "/var/slurm/ec2-spot-prices.json"
+
+# How long cached spot prices are used before asking EC2 again, in seconds.
+SPOT_PRICE_TTL = 60 * 60
+
+# Weights are clamped to this so no subnet is dropped from the ordering
+# entirely; max_nodes may need every address.
+MIN_WEIGHT = 0.01
+
+def record_launch_failure(availability_zone, now=None):
+    """
+    Record a failed (or unfulfilled) launch in the given availability zone.
+    This is advisory; errors are logged and otherwise ignored.  Failures
+    only affect the address ordering when the subnet weights are next
+    computed (slurm-ec2-clusterconfig --reweight).
+    """
+    if now is None:
+        now = time()
+    try:
+        with StateFile(LAUNCH_FAILURES_FILENAME) as state:
+            for az in list(state.keys()):
+                state[az] = [t for t in state[az]
+                             if now - t < LAUNCH_FAILURE_WINDOW]
+                if not state[az]:
+                    del state[az]
+            state.setdefault(availability_zone, []).append(now)
+    except (IOError, OSError) as e:
+        print("Unable to record launch failure: %s" % (e,), file=stderr)
+    return
+
+def interleave_addresses(hosts_by_subnet, weights, limit=None):
+    """
+    interleave_addresses(hosts_by_subnet, weights, limit=None) -> [host]
+
+    Merge the per-subnet host lists so that each subnet's share of any
+    prefix of the result is proportional to its weight (smooth weighted
+    round-robin).  Subnets whose lists are exhausted drop out.
+    """
+    hosts_by_subnet = [list(hosts) for hosts in hosts_by_subnet]
+    result = []
+
+    if len(set(weights)) <= 1:
+        # Strict round-robin.  This is the historical ordering; existing
+        # clusters depend on it for their node name to address mapping.
+        for i in xrange(max([len(hosts) for hosts in hosts_by_subnet] or
+                            [0])):
+            for hosts in hosts_by_subnet:
+                if i < len(hosts):
+                    result.append(hosts[i])
+                    if limit is not None and len(result) >= limit:
+                        return result
+        return result
+
+    positions = [0] * len(hosts_by_subnet)
+    current = [0.0] * len(hosts_by_subnet)
+    active = [i for i, hosts in enumerate(hosts_by_subnet) if hosts]
+
+    while active and (limit is None or len(result) < limit):
+        total = sum(weights[i] for i in active)
+        best = None
+        for i in active:
+            current[i] += weights[i]
+            if best is None or current[i] > current[best]:
+                best = i
+        current[best] -= total
+
+        result.append(hosts_by_subnet[best][positions[best]])
+        positions[best] += 1
+        if positions[best] >= len(hosts_by_subnet[best]):
+            active.remove(best)
+
+    return result
+
+class AddressOrderingPolicy(object):
+    """
+    Decides how compute node addresses are distributed across subnets.
+
+    Node names map to addresses in order, and SLURM wakes the low-numbered
+    nodes first, so subnets with higher weights receive more of the nodes
+    launched first.  Weights are computed when slurm-ec2.conf is generated
+    and stored there, so every node derives the same mapping.  They are
+    never recomputed automatically, since that would move running nodes to
+    new addresses; they stay fixed until slurm-ec2-clusterconfig --reweight
+    is run.
+
+    Subclasses override get_weights() and are registered with
+    register_policy(); a policy may also be given as "module:ClassName".
+    """
+    name = None
+
+    def get_weights(self, cc, subnets):
+        """
+        policy.get_weights(cc, subnets) -> {subnet_id: weight}
+
+        Returns the relative weight of each subnet.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def weights_by_az(subnets, az_weights, default=1.0):
+        return dict((subnet.id, az_weights.get(subnet.availability_zone,
+                                               default))
+                    for subnet in subnets)
+
+class RoundRobinPolicy(AddressOrderingPolicy):
+    """
+    Alternate between subnets equally.
+    """
+    name = "round-robin"
+
+    def get_weights(self, cc, subnets):
+        return dict((subnet.id, 1.0) for subnet in subnets)
+
+class FreeAddressesPolicy(AddressOrderingPolicy):
+    """
+    Weight subnets by their number of free IP addresses.
+    """
+    name = "free-addresses"
+
+    def get_weights(self, cc, subnets):
+        # Subnets read from slurm-ec2.conf don't have live counts.
+        vpc = connect_vpc(cc.region)
+        if vpc is None:
+            raise ValueError("Unable to connect to VPC endpoint in region %r"
+                             % (cc.region,))
+        return dict(
+            (subnet.id, float(subnet.available_ip_address_count))
+            for subnet in vpc.get_all_subnets(
+                subnet_ids=[subnet.id for subnet in subnets]))
+
+class LaunchFailuresPolicy(AddressOrderingPolicy):
+    """
+    Weight availability zones down by their launch failures in the
+    LAUNCH_FAILURE_WINDOW before the weights are computed.
+    """
+    name = "launch-failures"
+
+    def get_weights(self, cc, subnets):
+        now = time()
+        with StateFile(LAUNCH_FAILURES_FILENAME, readonly=True) as state:
+            failures = dict(
+                (az, len([t for t in times
+                          if now - t < LAUNCH_FAILURE_WINDOW]))
+                for az, times in state.iteritems())
+        return self.weights_by_az(subnets, dict(
+            (az, 1.0 / (1 + count)) for az, count in failures.iteritems()))
+
+class SpotPricePolicy(AddressOrderingPolicy):
+    """
+    Weight availability zones by the inverse of the spot price of
+    compute_instance_type when the weights are computed.  Prices are cached
+    for SPOT_PRICE_TTL seconds.
+    """
+    name = "spot-price"
+    product_description = "Linux/UNIX (Amazon VPC)"
+
+    def get_spot_prices(self, cc):
+        """
+        Returns a dict of availability zone -> latest spot price.
+        """
+        instance_type = cc.compute_instance_type
+        now = time()
+        with StateFile(SPOT_PRICES_FILENAME) as state:
+            cached = state.get(instance_type)
+            if cached is not None and now - cached["time"] < SPOT_PRICE_TTL:
+                return cached["prices"]
+
+            ec2 = connect_ec2(cc.region)
+            if ec2 is None:
+                raise ValueError("Unable to connect to EC2 endpoint in "
+                                 "region %r" % (cc.region,))
+
+            start = datetime.utcnow() - timedelta(seconds=SPOT_PRICE_TTL)
+            history = ec2.get_spot_price_history(
+                start_time=start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                instance_type=instance_type,
+                product_description=self.product_description)
+
+            # Keep the most recent price in each AZ.
+            latest = {}
+            for entry in history:
+                az = entry.availability_zone
+                if az not in latest or entry.timestamp > latest[az][0]:
+                    latest[az] = (entry.timestamp, entry.price)
+
+            prices = dict((az, price)
+                          for az, (timestamp, price) in latest.iteritems())
+            state[instance_type] = {"time": now, "prices": prices}
+            return prices
+
+    def get_weights(self, cc, subnets):
+        prices = self.get_spot_prices(cc)
+        if not prices:
+            return RoundRobinPolicy().get_weights(cc, subnets)
+
+        cheapest = min(prices.itervalues())
+        # AZs without a price (no capacity offered) get the lowest weight.
+        return self.weights_by_az(subnets, dict(
+            (az, cheapest / price if price > 0 else 1.0)
+            for az, price in prices.iteritems()), default=MIN_WEIGHT)
+
+policies = {}
+
+def register_policy(cls):
+    """
+    Register an AddressOrderingPolicy subclass under its name.
+    """
+    policies[cls.name] = cls
+    return cls
+
+for _cls in (RoundRobinPolicy, FreeAddressesPolicy, LaunchFailuresPolicy,
+             SpotPricePolicy):
+    register_policy(_cls)
+del _cls
+
+def get_policy(name):
+    """
+    get_policy(name) -> AddressOrderingPolicy
+
+    Returns an instance of the named policy, which is either a registered
+    name or "module:ClassName".
+    """
+    if name in policies:
+        return policies[name]()
+
+    if ":" in name:
+        module_name, class_name = name.split(":", 1)
+        return getattr(import_module(module_name), class_name)()
+
+    raise ValueError("Unknown address ordering policy %r" % (name,))
+
+def get_subnet_weights(policy_name, cc, subnets):
+    """
+    Returns {subnet_id: weight} for the given policy, clamped to at least
+    MIN_WEIGHT and normalized so the largest weight is 1.
+    """
+    weights = get_policy(policy_name).get_weights(cc, subnets)
+    weights = dict((subnet.id, max(float(weights.get(subnet.id, 1.0)), 0.0))
+                   for subnet in subnets)
+    largest = max(weights.itervalues()) if weights else 0.0
+    if largest <= 0:
+        return dict((subnet_id, 1.0) for subnet_id in weights)
+    return dict((subnet_id, round(max(weight / largest, MIN_WEIGHT), 4))
+                for subnet_id, weight in weights.iteritems())
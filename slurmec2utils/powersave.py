@@ -1,14 +1,28 @@
 #!/usr/bin/python
 from __future__ import absolute_import, print_function
-from base64 import b64encode
-import boto.ec2
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
 from boto.ec2.networkinterface import (
     NetworkInterfaceCollection, NetworkInterfaceSpecification)
-from .clusterconfig import ClusterConfiguration
+from boto.exception import EC2ResponseError
+from .clusterconfig import (
+    ClusterConfiguration, expand_hostlist, publish_slurm_ec2_configuration)
+from .fetch import parallel_map
+try: from cStringIO import StringIO
+except ImportError: from StringIO import StringIO
+from gzip import GzipFile
+from hashlib import sha256
 from .instanceinfo import get_instance_id, get_region, get_vpc_id
+from .inventory import (
+    LIVE_STATES, TERMINABLE_STATES, TRUST_PERIOD, open_inventory)
+from os import fdopen, makedirs, rename
+from os.path import isdir, join as path_join
+from random import uniform
+from .ordering import record_launch_failure
+from .ratelimit import connect_ec2
+from .statefile import StateFile
 import sys
 from sys import argv
+from tempfile import mkstemp
 from time import gmtime, sleep, strftime, time
 
 amazon_linux_ami = {
@@ -24,44 +38,116 @@ amazon_linux_ami = {
     "us-west-2":        "ami-b5a7ea85",
 }
 
-init_script = """\
+# How often to check whether spot requests have been fulfilled, in seconds.
+SPOT_POLL_INTERVAL = 5
+
+# How many nodes to launch concurrently.
+MAX_LAUNCH_WORKERS = 16
+
+# Nodes in a placement group are launched all at once, up to this many, to
+# improve the odds that EC2 grants the group's capacity together.
+MAX_PLACEMENT_BATCH = 128
+
+# Spot request status codes which indicate the request is unlikely to be
+# fulfilled soon; we move on to the next instance type when we see these.
+spot_failure_codes = {
+    "bad-parameters", "capacity-not-available", "capacity-oversubscribed",
+    "constraint-not-fulfillable", "launch-group-constraint",
+    "az-group-constraint", "placement-group-constraint", "price-too-low",
+    "system-error",
+}
+
+# Outstanding spot requests per node; see slurmec2utils.reconcile.
+SPOT_REQUESTS_FILENAME = "/var/slurm/ec2-spot-requests.json"
+
+# On-demand launch errors which indicate the node's AZ (or subnet) is short
+# of capacity; these are recorded for the launch-failures address ordering.
+capacity_error_codes = {
+    "InsufficientInstanceCapacity", "InsufficientFreeAddressesInSubnet",
+    "InstanceLimitExceeded",
+}
+
+# Where rendered user data templates are cached, keyed by configuration.
+USER_DATA_CACHE_DIR = "/var/slurm/user-data"
+
+# The per-node part of the user data; init_script follows this.
+user_data_header = """\
 #!/bin/sh
-hostname '%(nodename)s'
+NODENAME='%(nodename)s'
+"""
+
+# The node-independent part of the user data.  The configuration is
+# downloaded by digest rather than embedded so the user data stays small
+# regardless of the number of subnets.
+init_script = """\
+hostname "$NODENAME"
 instance_id=`curl --silent http://169.254.169.254/latest/meta-data/instance-id`
+
+# Tag the instance, download the configuration and fetch the external
+# packages concurrently with the OS package install.
 aws --region %(region)s ec2 create-tags --resources $instance_id --tags \
-'Key=SLURMHostname,Value=%(nodename)s' \
+"Key=SLURMHostname,Value=$NODENAME" \
 'Key=SLURMS3Root,Value=%(slurm_s3_root)s' \
-'Key=Name,Value=SLURM Computation Node %(nodename)s'
-cat > /etc/slurm-ec2.conf <<.EOF
-%(slurm_ec2_conf)s
-.EOF
+"Key=Name,Value=SLURM Computation Node $NODENAME" &
+tag_pid=$!
+
+for attempt in 1 2 3 4 5; do
+    if aws --region %(region)s s3 cp '%(slurm_ec2_conf_url)s' \
+        /etc/slurm-ec2.conf && \
+        echo '%(slurm_ec2_conf_sha256)s  /etc/slurm-ec2.conf' | \
+        sha256sum --check --status; then
+        break;
+    fi;
+    rm -f /etc/slurm-ec2.conf;
+    sleep $attempt;
+done &
+conf_pid=$!
+
+pkgdir=`mktemp -d`
+package_urls=""
+for package in %(external_packages)s; do
+    package_urls="$package_urls %(slurm_s3_root)s/packages/$package"
+done
+
+# Use the parallel fetcher if it's baked into the AMI; otherwise, fall back to
+# downloading one package at a time.
+if [[ ! -z "$package_urls" ]]; then
+    if ! which slurm-ec2-fetch > /dev/null 2>&1 || \
+        ! slurm-ec2-fetch --dest $pkgdir $package_urls; then
+        for url in $package_urls; do
+            aws s3 cp $url $pkgdir/`basename $url`
+        done
+    fi
+fi &
+fetch_pid=$!
+
 if [[ ! -z "%(os_packages)s" ]]; then
     yum -y install %(os_packages)s;
 fi;
+wait $fetch_pid
 
 for package in %(external_packages)s; do
-    tmpdir=`mktemp -d`
-    aws s3 cp %(slurm_s3_root)s/packages/$package $tmpdir/$package
     case $package in
         *.rpm )
-            rpm --install $tmpdir/$package;;
+            rpm --install $pkgdir/$package;;
 
         *.tgz | *.tar.gz )
-            tar -C / -x -z -f $tmpdir/$package;;
+            tar -C / -x -z -f $pkgdir/$package;;
 
         *.tbz2 | *.tar.bz2 )
-            tar -C / -x -j -f $tmpdir/$package;;
+            tar -C / -x -j -f $pkgdir/$package;;
 
         *.tZ | *.tar.Z )
-            tar -C / -x -Z -f $tmpdir/$package;;
+            tar -C / -x -Z -f $pkgdir/$package;;
 
         * )
-            chmod 755 $tmpdir/$package;
-            mv $tmpdir/$package /usr/bin;;
+            install -m 755 $pkgdir/$package /usr/bin/$package;;
     esac;
-
-    rm -rf $tmpdir;
 done
+rm -rf $pkgdir
+
+# slurm-ec2-set-hostname reads the tag back.
+wait $conf_pid $tag_pid
 
 aws s3 cp %(slurm_s3_root)s/packages/slurm-ec2-bootstrap \
 /usr/bin/slurm-ec2-bootstrap
@@ -69,35 +155,97 @@ chmod 755 /usr/bin/slurm-ec2-bootstrap
 /usr/bin/slurm-ec2-bootstrap --slurm-s3-root '%(slurm_s3_root)s'
 """
 
-def start_logging():
-    fd = open("/var/log/slurm/slurm-ec2-powersave.log", "a")
-    sys.stdout = sys.stderr = fd
+def get_user_data_template(cc, region, config_filename=None):
+    """
+    get_user_data_template(cc, region, config_filename=None) -> str
 
-def start_node():
-    start_logging()
+    Returns the node-independent part of the compute node user data.
 
-    print(" ".join(argv))
+    The configuration file is published to S3 by digest and the rendered
+    template is cached in USER_DATA_CACHE_DIR, so this work is done once per
+    configuration version rather than once per launch.
+    """
+    if config_filename is None:
+        config_filename = ClusterConfiguration.default_config_filename
 
-    if len(argv) != 2:
-        print("Usage: %s <nodename>" % (argv[0],), file=sys.stderr)
-        return 1
+    with open(config_filename, "rb") as fd:
+        conf = fd.read()
 
-    nodename = argv[1]
+    conf_digest = sha256(conf).hexdigest()
+    cache_filename = path_join(USER_DATA_CACHE_DIR, "%s-%s" % (
+        conf_digest, sha256(init_script).hexdigest()[:16]))
 
-    cc = ClusterConfiguration.from_config()
-    region = get_region()
-    ec2 = boto.ec2.connect_to_region(region)
-    
-    if not ec2:
-        print("Could not connect to EC2 endpoint in region %r" % (region,),
-              file=sys.stderr)
-        return 1
+    try:
+        with open(cache_filename, "r") as fd:
+            return fd.read()
+    except IOError:
+        pass
+
+    conf_url = publish_slurm_ec2_configuration(cc.slurm_s3_root, conf, region)
+    template = init_script % {
+        "region": region,
+        "os_packages": " ".join(
+            cc.compute_os_packages
+            if cc.compute_os_packages is not None
+            else []),
+        "external_packages": " ".join(
+            cc.compute_external_packages
+            if cc.compute_external_packages is not None
+            else []),
+        "slurm_ec2_conf_url": conf_url,
+        "slurm_ec2_conf_sha256": conf_digest,
+        "slurm_s3_root": cc.slurm_s3_root,
+    }
+
+    # Write the cache entry atomically; concurrent resume processes may be
+    # doing the same thing.
+    try:
+        if not isdir(USER_DATA_CACHE_DIR):
+            makedirs(USER_DATA_CACHE_DIR)
+        fd, tmp_filename = mkstemp(dir=USER_DATA_CACHE_DIR)
+        with fdopen(fd, "w") as fp:
+            fp.write(template)
+        rename(tmp_filename, cache_filename)
+    except (IOError, OSError) as e:
+        print("Unable to cache user data in %s: %s" % (
+            USER_DATA_CACHE_DIR, e), file=sys.stderr)
+
+    return template
+
+def get_user_data(cc, region, nodename):
+    """
+    get_user_data(cc, region, nodename) -> str
+
+    Returns the gzip-compressed user data for launching the given node.
+    cloud-init decompresses this before executing it.
+    """
+    buf = StringIO()
+    gz = GzipFile(fileobj=buf, mode="wb", mtime=0)
+    gz.write(user_data_header % {"nodename": nodename})
+    gz.write(get_user_data_template(cc, region))
+    gz.close()
+    return buf.getvalue()
+
+def start_logging():
+    fd = open("/var/log/slurm/slurm-ec2-powersave.log", "a")
+    sys.stdout = sys.stderr = fd
 
+def get_launch_kw(cc, pool, region, nodename, instance_type,
+                  placement_group=None):
+    """
+    get_launch_kw(cc, pool, region, nodename, instance_type,
+                  placement_group=None) -> dict
+
+    Returns the keyword arguments common to run_instances and
+    request_spot_instances for launching the given node as instance_type,
+    optionally in the given placement group.
+    """
     kw = {}
-    slurm_s3_root = cc.slurm_s3_root
+    if placement_group is not None:
+        kw['placement_group'] = placement_group
 
     kw['image_id'] = (
-        cc.compute_ami if cc.compute_ami is not None
+        pool.ami if pool.ami is not None
         else amazon_linux_ami[region])
     if cc.instance_profile is not None:
         if cc.instance_profile.startswith("arn:"):
@@ -105,31 +253,12 @@ def start_node():
         else:
             kw['instance_profile_name'] = cc.instance_profile
     kw['key_name'] = cc.key_name
-    kw['instance_type'] = cc.compute_instance_type
+    kw['instance_type'] = instance_type
 
-    if cc.compute_bid_price is not None:
-        end = time() + 24 * 60 * 60  # FIXME: Don't hardcode this.
-        kw['price'] = cc.compute_bid_price
-        kw['valid_until'] = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime(end))
-    
     node_address = cc.get_address_for_nodename(nodename)
     node_subnet = cc.get_subnet_for_address(node_address)
-    user_data = init_script % {
-        "region": region,
-        "nodename": nodename,
-        "os_packages": " ".join(
-            cc.compute_os_packages
-            if cc.compute_os_packages is not None
-            else []),
-        "external_packages": " ".join(
-            cc.compute_external_packages
-            if cc.compute_external_packages is not None
-            else []),
-        "slurm_ec2_conf": cc.slurm_ec2_configuration,
-        "slurm_s3_root": slurm_s3_root,
-    }
-    user_data = b64encode(user_data)
-    kw['user_data'] = user_data
+    # boto base64-encodes the user data itself.
+    kw['user_data'] = get_user_data(cc, region, nodename)
 
     # Map the ethernet interface to the correct IP address
     eth0 = NetworkInterfaceSpecification(
@@ -145,7 +274,7 @@ def start_node():
     # Attach any ephemeral storage devices
     block_device_map = BlockDeviceMapping()
     block_device_map['/dev/xvda'] = BlockDeviceType(size=32, volume_type="gp2")
-    devices = cc.ephemeral_stores[cc.compute_instance_type]
+    devices = cc.ephemeral_stores.get(instance_type, [])
 
     for i, device in enumerate(devices):
         drive = "/dev/sd" + chr(ord('b') + i)
@@ -153,58 +282,411 @@ def start_node():
             ephemeral_name="ephemeral%d" % i)
 
     kw['block_device_map'] = block_device_map
+    return kw
+
+def create_placement_group(ec2, name):
+    """
+    Create the given cluster placement group if it doesn't exist.
+    """
+    try:
+        ec2.create_placement_group(name, strategy="cluster")
+        print("Created placement group %s" % (name,))
+    except EC2ResponseError as e:
+        if e.error_code != "InvalidPlacementGroup.Duplicate":
+            raise
+    return
+
+def get_node_tags(cc, pool, nodename):
+    """
+    Returns the tags to apply to the instance for the given node.
+    """
+    return {
+        'SLURMHostname': nodename,
+        'SLURMNodePool': pool.name,
+        'SLURMS3Root': cc.slurm_s3_root,
+        'Name': "SLURM Computation Node %s" % nodename,
+    }
+
+def record_spot_requests(nodename, request_ids, instance_type):
+    """
+    Record outstanding spot requests for the given node so the reconciler
+    can tag or cancel them if this process goes away.
+    """
+    try:
+        with StateFile(SPOT_REQUESTS_FILENAME) as state:
+            node_requests = state.setdefault(nodename, [])
+            for request_id in request_ids:
+                node_requests.append({
+                    "id": request_id,
+                    "instance_type": instance_type,
+                    "created": time(),
+                })
+    except (IOError, OSError) as e:
+        print("Unable to record spot requests in %s: %s" % (
+            SPOT_REQUESTS_FILENAME, e), file=sys.stderr)
+    return
+
+def forget_spot_requests(request_ids):
+    """
+    Remove the given spot requests from the outstanding request state.
+    """
+    request_ids = set(request_ids)
+    try:
+        with StateFile(SPOT_REQUESTS_FILENAME) as state:
+            for nodename in list(state.keys()):
+                state[nodename] = [
+                    request for request in state[nodename]
+                    if request["id"] not in request_ids]
+                if not state[nodename]:
+                    del state[nodename]
+    except (IOError, OSError) as e:
+        print("Unable to update spot requests in %s: %s" % (
+            SPOT_REQUESTS_FILENAME, e), file=sys.stderr)
+    return
+
+def tag_instances(ec2, instance_ids, tags):
+    """
+    Apply tags to the given instances, retrying if EC2 doesn't know about
+    them yet.
+    """
+    # create-tags can fail at times since the tag resource database is
+    # a bit behind EC2's actual state.  (Throttling is retried by the
+    # connection; see slurmec2utils.ratelimit.)
+    for i in xrange(10):
+        try:
+            ec2.create_tags(instance_ids, tags)
+            return
+        except Exception as e:
+            print("Failed to tag instance: %s" % e, file=sys.stderr)
+            # Jittered so concurrent resume processes spread out.
+            sleep(min(0.5 * (1 << i), 10.0) * uniform(0.5, 1.5))
+    return
+
+def request_spot_instance(ec2, kw, price, timeout, nodename):
+    """
+    request_spot_instance(ec2, kw, price, timeout, nodename)
+        -> instance_id | None
+
+    Request a spot instance for the given node and wait up to timeout
+    seconds for it to be fulfilled.  If the request can't be fulfilled in
+    time, it is cancelled and None is returned.
+    """
+    end = time() + timeout
+    kw = dict(kw)
+    kw['valid_until'] = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime(end))
+
+    print("request_spot_instances: %r" % kw)
+    requests = ec2.request_spot_instances(price, **kw)
+    request_ids = [request.id for request in requests]
+    print("requests: %s" % " ".join(request_ids))
+    record_spot_requests(nodename, request_ids, kw['instance_type'])
+
+    while True:
+        sleep(SPOT_POLL_INTERVAL)
+
+        try:
+            requests = ec2.get_all_spot_instance_requests(request_ids)
+        except Exception as e:
+            # The request may not be visible yet.
+            print("Failed to describe spot requests: %s" % e, file=sys.stderr)
+            requests = []
+
+        for request in requests:
+            if request.instance_id is not None:
+                forget_spot_requests(request_ids)
+                return request.instance_id
+
+        failed = [request for request in requests
+                  if request.state in ("cancelled", "closed", "failed") or
+                  (request.status is not None and
+                   request.status.code in spot_failure_codes)]
+        if failed or time() >= end:
+            break
+
+    for request in failed:
+        print("Spot request %s not fulfilled: %s" % (
+            request.id, request.status.code if request.status else
+            request.state))
+
+    print("Cancelling spot request(s): %s" % " ".join(request_ids))
+    ec2.cancel_spot_instance_requests(request_ids)
+
+    # The request may have been fulfilled before the cancellation took
+    # effect; cancelling leaves the instance running, so use it.
+    instance_id = None
+    for request in ec2.get_all_spot_instance_requests(request_ids):
+        if request.instance_id is not None:
+            instance_id = request.instance_id
+
+    forget_spot_requests(request_ids)
+    return instance_id
+
+def get_live_instance_ids(ec2, inventory, nodename):
+    """
+    get_live_instance_ids(ec2, inventory, nodename) -> [instance_id, ...]
+
+    Returns the ids of pending or running instances for the given node
+    according to the inventory.  Entries which haven't been refreshed
+    recently are checked with EC2 first.
+    """
+    now = time()
+    instance_ids = []
+    for row in inventory.get_live_instances(nodename):
+        if now - row["updated"] < TRUST_PERIOD:
+            instance_ids.append(row["instance_id"])
+            continue
+
+        instances = ec2.get_only_instances(
+            filters={"instance-id": row["instance_id"]})
+        if instances:
+            inventory.set_state([row["instance_id"]], instances[0].state)
+            if instances[0].state in LIVE_STATES:
+                instance_ids.append(row["instance_id"])
+        else:
+            inventory.set_state([row["instance_id"]], "terminated")
+
+    return instance_ids
+
+def get_open_spot_request_ids(nodename, max_age):
+    """
+    Returns the ids of spot requests made for the given node in the last
+    max_age seconds which haven't been resolved.
+    """
+    now = time()
+    try:
+        with StateFile(SPOT_REQUESTS_FILENAME, readonly=True) as state:
+            return [request["id"] for request in state.get(nodename, [])
+                    if now - request["created"] < max_age]
+    except (IOError, OSError):
+        return []
+
+def launch_node(ec2, cc, region, nodename):
+    """
+    launch_node(ec2, cc, region, nodename)
+
+    Launch an instance for the given node using its pool's settings.
+
+    If the pool has a bid price, spot instances are requested for each of
+    the pool's spot instance types in turn; if none is fulfilled within the
+    pool's spot timeout, an on-demand instance is launched unless the pool's
+    spot fallback is "none".
+    """
+    # Inventory connections are per-thread, so each launch opens (and
+    # closes) its own.
+    inventory = open_inventory()
+    try:
+        _launch_node(ec2, cc, region, nodename, inventory)
+    finally:
+        if inventory is not None:
+            inventory.close()
+    return
+
+def _launch_node(ec2, cc, region, nodename, inventory):
+    pool, index = cc.get_pool_for_nodename(nodename)
+
+    # Don't launch a duplicate if the node already has an instance or an
+    # outstanding spot request.
+    if inventory is not None:
+        instance_ids = get_live_instance_ids(ec2, inventory, nodename)
+        if instance_ids:
+            print("%s already has instance(s) %s; not launching" % (
+                nodename, " ".join(instance_ids)))
+            return
+
+    request_ids = get_open_spot_request_ids(nodename, pool.spot_timeout)
+    if request_ids:
+        print("%s already has spot request(s) %s; not launching" % (
+            nodename, " ".join(request_ids)))
+        return
+
+    print("Launching %s in node pool %s" % (nodename, pool.name))
+    tags = get_node_tags(cc, pool, nodename)
+    availability_zone = cc.get_subnet_for_address(
+        cc.get_address_for_nodename(nodename)).availability_zone
+
+    placement_group = pool.placement_group
+
+    if pool.bid_price is not None:
+        for instance_type in pool.spot_instance_types:
+            kw = get_launch_kw(cc, pool, region, nodename, instance_type,
+                               placement_group)
+            instance_id = request_spot_instance(
+                ec2, kw, pool.bid_price, pool.spot_timeout, nodename)
+
+            if instance_id is not None:
+                print("instances: %s" % instance_id)
+                if inventory is not None:
+                    inventory.record(instance_id, nodename, "pending",
+                                     launch_time=time(), lifecycle="spot",
+                                     instance_type=instance_type)
+                tag_instances(ec2, [instance_id], tags)
+                return
+
+            print("No %s spot capacity for %s" % (instance_type, nodename))
+            record_launch_failure(availability_zone)
+
+        if pool.spot_fallback != "ondemand":
+            raise ValueError("No spot capacity available for %s" %
+                             (nodename,))
+
+        print("Falling back to on-demand for %s" % (nodename,))
+
+    kw = get_launch_kw(cc, pool, region, nodename, pool.instance_type,
+                       placement_group)
+    print("run_instances: %r" % kw)
+    try:
+        reservation = ec2.run_instances(**kw)
+    except EC2ResponseError as e:
+        if e.error_code not in capacity_error_codes:
+            raise
+        record_launch_failure(availability_zone)
 
-    if cc.compute_bid_price is None:
+        if placement_group is None or pool.placement_fallback != "no-group":
+            raise
+
+        print("No capacity in placement group %s for %s; launching outside "
+              "the group" % (placement_group, nodename))
+        del kw['placement_group']
         print("run_instances: %r" % kw)
         reservation = ec2.run_instances(**kw)
-        tags = {
-            'SLURMHostname': nodename,
-            'SLURMS3Root': slurm_s3_root,
-            'Name': "SLURM Computation Node %s" % nodename,
-        }
-
-        print("instances: %s" %
-              " ".join([instance.id for instance in reservation.instances]))
-
-        # create-tags can fail at times since the tag resource database is
-        # a bit behind EC2's actual state.
-        for i in xrange(10):
-            try:
-                ec2.create_tags([
-                    instance.id for instance in reservation.instances], tags)
-                break
-            except Exception as e:
-                print("Failed to tag instance: %s" % e, file=sys.stderr)
-                sleep(0.5 * i)
-    else:
-        print("request_spot_instances: %r" % kw, file=sys.stderr)
-        requests = ec2.request_spot_instances(**kw)
-        print("requests: %s" % " ".join([request.id for request in requests]))
+    instance_ids = [instance.id for instance in reservation.instances]
 
-    return 0
+    print("instances: %s" % " ".join(instance_ids))
+    if inventory is not None:
+        for instance_id in instance_ids:
+            inventory.record(instance_id, nodename, "pending",
+                             launch_time=time(), lifecycle="ondemand",
+                             instance_type=pool.instance_type)
+    tag_instances(ec2, instance_ids, tags)
+    return
 
-def stop_node():
+def start_node():
     start_logging()
 
     print(" ".join(argv))
 
     if len(argv) != 2:
-        print("Usage: %s <nodename>" % (argv[0],), file=sys.stderr)
+        print("Usage: %s <hostlist>" % (argv[0],), file=sys.stderr)
         return 1
 
-    nodename = argv[1]
+    nodenames = expand_hostlist(argv[1])
 
     cc = ClusterConfiguration.from_config()
     region = get_region()
-    ec2 = boto.ec2.connect_to_region(region)
 
-    instances = ec2.get_only_instances(filters={"tag:SLURMHostname": nodename})
-    if len(instances) == 0:
-        print("No instances found for %r" % nodename)
+    # Spot requests can take minutes to be fulfilled, so launch nodes
+    # concurrently.  boto connections aren't thread-safe; each launch gets
+    # its own.  All of them (and other resume processes) share the EC2 API
+    # rate limit.
+    connections = []
+
+    def launch(nodename):
+        ec2 = connect_ec2(region)
+        if not ec2:
+            print("Could not connect to EC2 endpoint in region %r" %
+                  (region,), file=sys.stderr)
+            return 1
+        connections.append(ec2)
+
+        try:
+            launch_node(ec2, cc, region, nodename)
+        except Exception as e:
+            print("Failed to launch %s: %s" % (nodename, e), file=sys.stderr)
+            return 1
+        return 0
+
+    # Render the user data template once before starting threads.
+    get_user_data_template(cc, region)
+
+    # Nodes in placement groups go first, all at once, so their launches
+    # reach EC2 together; the rest are launched MAX_LAUNCH_WORKERS at a time
+    # behind them.
+    grouped = []
+    ungrouped = []
+    placement_groups = set()
+    failed = 0
+    for nodename in nodenames:
+        try:
+            pool, index = cc.get_pool_for_nodename(nodename)
+        except ValueError as e:
+            print("Failed to launch %s: %s" % (nodename, e), file=sys.stderr)
+            failed = 1
+            continue
+
+        if pool.placement_group is not None:
+            placement_groups.add(pool.placement_group)
+            grouped.append(nodename)
+        else:
+            ungrouped.append(nodename)
+
+    if placement_groups:
+        ec2 = connect_ec2(region)
+        if ec2 is not None:
+            connections.append(ec2)
+        for name in sorted(placement_groups):
+            try:
+                create_placement_group(ec2, name)
+            except Exception as e:
+                print("Failed to create placement group %s: %s" % (name, e),
+                      file=sys.stderr)
+
+    workers = max(MAX_LAUNCH_WORKERS, min(len(grouped), MAX_PLACEMENT_BATCH))
+    result = max(parallel_map(launch, grouped + ungrouped, workers) +
+                 [failed])
+
+    print("EC2 API: %d call(s), %d throttled, %.1f seconds waiting for the "
+          "rate limit" % (sum([ec2.n_calls for ec2 in connections]),
+                          sum([ec2.n_throttled for ec2 in connections]),
+                          sum([ec2.wait_seconds for ec2 in connections])))
+    return result
+
+def stop_node():
+    start_logging()
+
+    print(" ".join(argv))
+
+    if len(argv) != 2:
+        print("Usage: %s <hostlist>" % (argv[0],), file=sys.stderr)
         return 1
 
-    instance_ids = [instance.id for instance in instances]
-    print("Terminating instance(s): %s" % " ".join(instance_ids))
-    ec2.terminate_instances(instance_ids)
-    return 0
+    nodenames = expand_hostlist(argv[1])
 
+    cc = ClusterConfiguration.from_config()
+    region = get_region()
+    ec2 = connect_ec2(region)
+    inventory = open_inventory()
+
+    result = 0
+    for nodename in nodenames:
+        try:
+            pool, index = cc.get_pool_for_nodename(nodename)
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            result = 1
+            continue
+
+        # Use the inventory if it knows about the node; otherwise, ask EC2.
+        instance_ids = []
+        if inventory is not None:
+            instance_ids = [
+                row["instance_id"] for row in
+                inventory.get_instances(nodename, TERMINABLE_STATES)]
+
+        if not instance_ids:
+            instances = ec2.get_only_instances(
+                filters={"tag:SLURMHostname": nodename})
+            instance_ids = [instance.id for instance in instances
+                            if instance.state in TERMINABLE_STATES]
+
+        if len(instance_ids) == 0:
+            print("No instances found for %r" % nodename)
+            result = 1
+            continue
+
+        print("Terminating %s instance(s) in node pool %s: %s" % (
+            nodename, pool.name, " ".join(instance_ids)))
+        ec2.terminate_instances(instance_ids)
+        if inventory is not None:
+            inventory.set_state(instance_ids, "shutting-down")
+
+    return result
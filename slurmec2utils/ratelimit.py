@@ -0,0 +1,230 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+import boto.ec2
+import boto.vpc
+from boto.exception import EC2ResponseError
+from random import uniform
+from .statefile import StateFile
+from sys import stderr
+from threading import Lock
+from time import sleep, time
+
+# Token bucket state shared by every process on the node (slurmctld forks a
+# slurm-ec2-resume per batch of nodes).
+RATE_LIMIT_FILENAME = "/var/slurm/ec2-api-rate.json"
+
+# Sustained EC2 API calls per second, and how many may be made at once after
+# an idle period.
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 20
+
+# After a throttling error, every process holds off for BACKOFF_BASE *
+# 2^(consecutive throttles) seconds (up to MAX_BACKOFF), randomized by
+# +/- 50% so they don't resume in lockstep.
+BACKOFF_BASE = 1.0
+MAX_BACKOFF = 60.0
+
+# Calls are retried this many times when throttled.
+MAX_ATTEMPTS = 8
+
+# Waits longer than this are logged.
+LOG_WAIT_THRESHOLD = 1.0
+
+throttle_error_codes = {"RequestLimitExceeded", "Throttling"}
+
+class TokenBucket(object):
+    """
+    A token bucket shared between processes through a locked state file.
+
+    acquire() blocks until a token is available and no throttle backoff is
+    in effect; throttled() starts (or lengthens) a backoff for every process
+    using the bucket, and the next successful call from any of them ends the
+    run of throttles through succeeded().  Cumulative call and wait
+    statistics are kept in the state file as well.
+
+    If the state file can't be used (e.g. its directory isn't writable),
+    calls aren't limited.
+    """
+
+    def __init__(self, filename=RATE_LIMIT_FILENAME, rate=DEFAULT_RATE,
+                 burst=DEFAULT_BURST):
+        self.filename = filename
+        self.rate = float(rate)
+        self.burst = burst
+        self.disabled = False
+        # Whether a run of throttles was in progress at the last acquire().
+        self.throttling = False
+        return
+
+    def _update(self, fn):
+        """
+        Call fn(state, now) with the state file locked, returning its result.
+        Returns None if the state file is unusable.
+        """
+        if self.disabled:
+            return None
+        try:
+            with StateFile(self.filename) as state:
+                now = time()
+                tokens = state.get("tokens", float(self.burst))
+                last = state.get("time", now)
+                state["tokens"] = min(
+                    float(self.burst),
+                    tokens + max(now - last, 0.0) * self.rate)
+                state["time"] = now
+                return fn(state, now)
+        except (IOError, OSError) as e:
+            print("EC2 rate limiting disabled: %s" % (e,), file=stderr)
+            self.disabled = True
+            return None
+
+    def acquire(self):
+        """
+        Wait for a token.  Returns the number of seconds waited.
+        """
+        start = time()
+
+        def take(state, now):
+            backoff_until = state.get("backoff_until", 0.0)
+            if backoff_until > now:
+                return backoff_until - now
+            if state["tokens"] >= 1.0:
+                state["tokens"] -= 1.0
+                self.throttling = bool(state.get("consecutive_throttles"))
+                self._record(state, now - start)
+                return 0.0
+            return (1.0 - state["tokens"]) / self.rate
+
+        while True:
+            wait = self._update(take)
+            if not wait:
+                break
+            # Jitter so waiting processes don't all retry at once.
+            sleep(wait * uniform(1.0, 1.5))
+
+        return time() - start
+
+    @staticmethod
+    def _record(state, waited, throttled=False):
+        stats = state.setdefault("stats", {
+            "calls": 0, "throttled": 0, "wait_seconds": 0.0})
+        if throttled:
+            stats["throttled"] += 1
+        else:
+            stats["calls"] += 1
+            stats["wait_seconds"] += waited
+        return
+
+    def throttled(self):
+        """
+        Record a throttling error, backing off every user of the bucket.
+        Returns the backoff in seconds.
+        """
+        def backoff(state, now):
+            n = state["consecutive_throttles"] = (
+                state.get("consecutive_throttles", 0) + 1)
+            delay = min(BACKOFF_BASE * (1 << min(n - 1, 16)), MAX_BACKOFF)
+            delay *= uniform(0.5, 1.5)
+            state["backoff_until"] = max(state.get("backoff_until", 0.0),
+                                         now + delay)
+            state["tokens"] = 0.0
+            self._record(state, 0.0, throttled=True)
+            return delay
+
+        delay = self._update(backoff)
+        if delay is None:
+            # No shared state; back off locally.
+            delay = BACKOFF_BASE * uniform(0.5, 1.5)
+            sleep(delay)
+        return delay
+
+    def succeeded(self):
+        """
+        Record a successful call, ending the run of throttling errors.
+        """
+        def reset(state, now):
+            if state.get("consecutive_throttles"):
+                state["consecutive_throttles"] = 0
+            return
+
+        self._update(reset)
+        self.throttling = False
+        return
+
+class RateLimitedConnection(object):
+    """
+    Wraps a boto EC2 (or VPC) connection so every API call waits for the
+    shared token bucket and is retried with backoff when EC2 throttles it.
+
+    The time this process's calls spent waiting is kept in wait_seconds.
+    """
+
+    def __init__(self, connection, bucket=None):
+        self.connection = connection
+        self.bucket = bucket if bucket is not None else TokenBucket()
+        self.n_calls = 0
+        self.n_throttled = 0
+        self.wait_seconds = 0.0
+        self._lock = Lock()
+        return
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def call(*args, **kw):
+            for attempt in xrange(1, MAX_ATTEMPTS + 1):
+                waited = self.bucket.acquire()
+                with self._lock:
+                    self.n_calls += 1
+                    self.wait_seconds += waited
+                if waited >= LOG_WAIT_THRESHOLD:
+                    print("EC2 %s waited %.1f seconds for the rate limiter" %
+                          (name, waited))
+
+                try:
+                    result = attr(*args, **kw)
+                except EC2ResponseError as e:
+                    if (e.error_code not in throttle_error_codes or
+                        attempt == MAX_ATTEMPTS):
+                        raise
+                    with self._lock:
+                        self.n_throttled += 1
+                    delay = self.bucket.throttled()
+                    print("EC2 %s throttled (attempt %d); backing off %.1f "
+                          "seconds" % (name, attempt, delay), file=stderr)
+                    continue
+
+                # Reset the shared throttle count whenever it's non-zero,
+                # even if this process wasn't the one throttled.
+                if attempt > 1 or self.bucket.throttling:
+                    self.bucket.succeeded()
+                return result
+
+        call.__name__ = name
+        return call
+
+def connect_ec2(region, bucket=None):
+    """
+    connect_ec2(region, bucket=None) -> RateLimitedConnection | None
+
+    Returns a rate limited EC2 connection, or None if the region is
+    unknown.
+    """
+    ec2 = boto.ec2.connect_to_region(region)
+    if ec2 is None:
+        return None
+    return RateLimitedConnection(ec2, bucket)
+
+def connect_vpc(region, bucket=None):
+    """
+    connect_vpc(region, bucket=None) -> RateLimitedConnection | None
+
+    Returns a rate limited VPC connection, or None if the region is
+    unknown.  VPC calls count against the EC2 API limits.
+    """
+    vpc = boto.vpc.connect_to_region(region)
+    if vpc is None:
+        return None
+    return RateLimitedConnection(vpc, bucket)
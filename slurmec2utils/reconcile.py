@@ -0,0 +1,282 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from .clusterconfig import ClusterConfiguration
+from .instanceinfo import get_metadata, get_region
+from .inventory import get_slurm_instances, open_inventory, parse_aws_time
+from .powersave import SPOT_REQUESTS_FILENAME, get_node_tags, tag_instances
+from .ratelimit import connect_ec2
+from .statefile import StateFile
+from subprocess import PIPE, Popen
+from sys import stderr
+from time import sleep, time
+
+# How many ids to pass to each describe call.
+DESCRIBE_BATCH_SIZE = 200
+
+# Open spot requests are cancelled once they are this many seconds older than
+# their pool's spot timeout.
+STALE_GRACE = 300
+
+# Instances launched less than this many seconds ago are never considered
+# orphans; SLURM may not have noticed the node powering up yet.
+ORPHAN_GRACE = 900
+
+DEFAULT_INTERVAL = 60
+
+def get_slurm_node_states():
+    """
+    get_slurm_node_states() -> {nodename: state} | None
+
+    Returns the compact SLURM state (e.g. "idle~", "alloc", "idle#") of each
+    node, or None if SLURM can't be queried.  A "~" suffix indicates the node
+    is powered down; "#" indicates it is powering up.
+    """
+    try:
+        proc = Popen(["sinfo", "--noheader", "--Node", "--format=%N %t"],
+                     stdout=PIPE, stderr=PIPE, close_fds=True)
+        out, err = proc.communicate()
+    except OSError as e:
+        print("Unable to run sinfo: %s" % (e,), file=stderr)
+        return None
+
+    if proc.returncode != 0:
+        print("sinfo failed: %s" % (err.strip(),), file=stderr)
+        return None
+
+    states = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            states[parts[0]] = parts[1]
+    return states
+
+class SpotReconciler(object):
+    """
+    Reconcile outstanding spot requests and SLURM compute instances.
+
+    Each pass:
+        - tags instances from fulfilled spot requests with their node's tags;
+        - cancels duplicate open requests (more than one per node) and stale
+          requests (open well past their pool's spot timeout);
+        - terminates orphaned instances, i.e. instances of this cluster whose
+          node SLURM considers powered down;
+        - refreshes the local instance inventory from the same listing.
+
+    Outstanding requests are read from the state file written by
+    slurm-ec2-resume.  All EC2 queries are batched, so a pass costs a handful
+    of API calls regardless of cluster size.
+    """
+
+    def __init__(self, ec2, cc, dry_run=False):
+        self.ec2 = ec2
+        self.cc = cc
+        self.dry_run = dry_run
+        return
+
+    def describe_spot_requests(self, request_ids):
+        """
+        Returns a dict of request id -> boto SpotInstanceRequest for the
+        given request ids.  Unknown ids are omitted.
+        """
+        requests = {}
+        for i in xrange(0, len(request_ids), DESCRIBE_BATCH_SIZE):
+            batch = request_ids[i:i + DESCRIBE_BATCH_SIZE]
+            # Use a filter rather than ids so an expired id doesn't fail the
+            # entire call.
+            for request in self.ec2.get_all_spot_instance_requests(
+                    filters={"spot-instance-request-id": batch}):
+                requests[request.id] = request
+        return requests
+
+    def reconcile_spot_requests(self, now):
+        """
+        Tag fulfilled spot requests and cancel duplicate or stale ones.
+        Returns a (tagged, cancelled) tuple of counts.
+        """
+        with StateFile(SPOT_REQUESTS_FILENAME, readonly=True) as state:
+            tracked = dict(state)
+
+        request_ids = [entry["id"] for entries in tracked.itervalues()
+                       for entry in entries]
+        if not request_ids:
+            return 0, 0
+
+        requests = self.describe_spot_requests(request_ids)
+        resolved = set()
+        to_cancel = []
+        tagged = 0
+
+        for nodename, entries in sorted(tracked.iteritems()):
+            try:
+                pool, index = self.cc.get_pool_for_nodename(nodename)
+            except ValueError:
+                pool = None
+
+            fulfilled = []
+            still_open = []
+            for entry in entries:
+                request = requests.get(entry["id"])
+                if request is None:
+                    # No longer known to EC2.
+                    resolved.add(entry["id"])
+                elif request.instance_id is not None:
+                    fulfilled.append(request)
+                elif request.state == "open":
+                    still_open.append((entry["created"], request))
+                else:
+                    resolved.add(entry["id"])
+
+            if fulfilled:
+                instance_ids = [request.instance_id for request in fulfilled]
+                print("Tagging %s instance(s): %s" % (
+                    nodename, " ".join(instance_ids)))
+                if pool is not None and not self.dry_run:
+                    tag_instances(self.ec2, instance_ids,
+                                  get_node_tags(self.cc, pool, nodename))
+                tagged += len(instance_ids)
+                resolved.update(request.id for request in fulfilled)
+
+                # The node has capacity; anything else is a duplicate.
+                duplicates = [request for created, request in still_open]
+                still_open = []
+            else:
+                # Keep only the newest open request.
+                still_open.sort()
+                duplicates = [request for created, request in still_open[:-1]]
+                still_open = still_open[-1:]
+
+            for request in duplicates:
+                print("Cancelling duplicate spot request %s for %s" % (
+                    request.id, nodename))
+                to_cancel.append(request.id)
+
+            timeout = (pool.spot_timeout if pool is not None
+                       else self.cc.compute_spot_timeout)
+            for created, request in still_open:
+                if pool is None or now - created > timeout + STALE_GRACE:
+                    print("Cancelling stale spot request %s for %s" % (
+                        request.id, nodename))
+                    to_cancel.append(request.id)
+
+        if to_cancel and not self.dry_run:
+            for i in xrange(0, len(to_cancel), DESCRIBE_BATCH_SIZE):
+                self.ec2.cancel_spot_instance_requests(
+                    to_cancel[i:i + DESCRIBE_BATCH_SIZE])
+        resolved.update(to_cancel)
+
+        if not self.dry_run:
+            with StateFile(SPOT_REQUESTS_FILENAME) as state:
+                for nodename in list(state.keys()):
+                    state[nodename] = [
+                        entry for entry in state[nodename]
+                        if entry["id"] not in resolved]
+                    if not state[nodename]:
+                        del state[nodename]
+
+        return tagged, len(to_cancel)
+
+    def terminate_orphans(self, instances, now):
+        """
+        Terminate instances of this cluster whose nodes are powered down in
+        SLURM.  Returns the number of instances terminated.
+        """
+        states = get_slurm_node_states()
+        if states is None:
+            return 0
+
+        orphans = []
+        for instance in instances:
+            if instance.state not in ("pending", "running"):
+                continue
+
+            nodename = instance.tags.get("SLURMHostname")
+
+            # Leave anything that isn't a compute node (e.g. the controller)
+            # alone.
+            try:
+                self.cc.get_pool_for_nodename(nodename)
+            except ValueError:
+                continue
+
+            if now - parse_aws_time(instance.launch_time) < ORPHAN_GRACE:
+                continue
+
+            if states.get(nodename, "").endswith("~"):
+                print("Terminating orphaned instance %s for powered down "
+                      "node %s" % (instance.id, nodename))
+                orphans.append(instance.id)
+
+        if orphans and not self.dry_run:
+            for i in xrange(0, len(orphans), DESCRIBE_BATCH_SIZE):
+                self.ec2.terminate_instances(
+                    orphans[i:i + DESCRIBE_BATCH_SIZE])
+
+        return len(orphans)
+
+    def reconcile(self):
+        """
+        Perform a single reconciliation pass.
+        """
+        now = time()
+        tagged, cancelled = self.reconcile_spot_requests(now)
+
+        instances = get_slurm_instances(self.ec2, filters={
+            "tag:SLURMS3Root": self.cc.slurm_s3_root})
+        if not self.dry_run:
+            inventory = open_inventory()
+            if inventory is not None:
+                inventory.update_from_instances(instances)
+                inventory.close()
+
+        terminated = self.terminate_orphans(instances, now)
+        print("Reconciled: %d tagged, %d cancelled, %d terminated" % (
+            tagged, cancelled, terminated))
+        return
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description=("Tag fulfilled spot requests, cancel stale or duplicate "
+                     "requests and terminate orphaned SLURM instances."))
+    parser.add_argument(
+        "--once", action="store_true", default=False,
+        help=("Perform a single pass and exit."))
+    parser.add_argument(
+        "--interval", "-i", type=int, default=DEFAULT_INTERVAL,
+        help=("Seconds between passes.  Defaults to %d." % DEFAULT_INTERVAL))
+    parser.add_argument(
+        "--dry-run", "-n", action="store_true", default=False,
+        help=("Report what would be done without doing it."))
+    parser.add_argument(
+        "--controller-only", action="store_true", default=False,
+        help=("Exit quietly unless this instance is the SLURM controller."))
+    args = parser.parse_args()
+
+    cc = ClusterConfiguration.from_config()
+
+    if (args.controller_only and
+        get_metadata().get('local-ipv4') != str(cc.controller_address)):
+        return 0
+
+    region = get_region()
+    ec2 = connect_ec2(region)
+    if ec2 is None:
+        print("Could not connect to EC2 endpoint in region %r" % (region,),
+              file=stderr)
+        return 1
+
+    reconciler = SpotReconciler(ec2, cc, dry_run=args.dry_run)
+    while True:
+        try:
+            reconciler.reconcile()
+        except Exception as e:
+            print("Reconciliation failed: %s" % (e,), file=stderr)
+            if args.once:
+                return 1
+
+        if args.once:
+            break
+        sleep(args.interval)
+
+    return 0
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from errno import EEXIST
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
+from json import dump as json_dump, load as json_load
+from os import fdopen, makedirs, rename
+from os.path import dirname
+from tempfile import mkstemp
+
+class StateFile(object):
+    """
+    A JSON state file shared between processes.
+
+    Use as a context manager; the file is locked for the duration of the
+    with block and the data (a dictionary) is written back atomically on exit
+    if no exception occurred:
+
+        with StateFile("/var/slurm/example.json") as state:
+            state["key"] = "value"
+
+    The lock is held on a separate <filename>.lock file so the state file
+    itself can be replaced by rename.
+    """
+
+    def __init__(self, filename, readonly=False):
+        """
+        StateFile(filename, readonly=False)
+
+        If readonly is True, a shared lock is taken and the data is not
+        written back.
+        """
+        self.filename = filename
+        self.readonly = readonly
+        self.data = None
+        self._lock_fd = None
+        return
+
+    def __enter__(self):
+        try:
+            makedirs(dirname(self.filename))
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+
+        self._lock_fd = open(self.filename + ".lock", "a")
+        flock(self._lock_fd, LOCK_SH if self.readonly else LOCK_EX)
+
+        try:
+            with open(self.filename, "r") as fd:
+                self.data = json_load(fd)
+        except (IOError, ValueError):
+            # Missing or corrupt; start over.
+            self.data = {}
+
+        return self.data
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and not self.readonly:
+                fd, tmp_filename = mkstemp(dir=dirname(self.filename))
+                with fdopen(fd, "w") as fp:
+                    json_dump(self.data, fp, indent=1, sort_keys=True)
+                rename(tmp_filename, self.filename)
+        finally:
+            flock(self._lock_fd, LOCK_UN)
+            self._lock_fd.close()
+            self._lock_fd = None
+        return False
@@ -0,0 +1,378 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+from .clusterconfig import ClusterConfiguration
+from .instanceinfo import get_instance_type, get_metadata
+from json import dump as json_dump
+from os import chmod, fsync, listdir, makedirs, unlink
+from os.path import exists, isdir, join as path_join, realpath
+from subprocess import check_call, PIPE, Popen
+from sys import exit, stderr
+from time import time
+
+VOLUME_GROUP = "vgephemeral"
+LOGICAL_VOLUME = "lvephemeral"
+LOGICAL_VOLUME_PATH = "/dev/%s/%s" % (VOLUME_GROUP, LOGICAL_VOLUME)
+DEFAULT_MOUNT_POINT = "/ephemeral"
+
+# The results of the setup and self-test.
+STORAGE_RECORD_FILENAME = "/var/slurm/ec2-ephemeral.json"
+
+SYSFS_BLOCK_DIR = "/sys/block"
+
+# Stripes are sized so a full stripe is about this many KB, within the
+# limits below; large sequential scratch I/O then hits every device.
+FULL_STRIPE_KB = 1024
+MIN_STRIPE_KB = 64
+MAX_STRIPE_KB = 512
+
+# Devices within this fraction of the expected ephemeral store size match.
+SIZE_TOLERANCE = 0.15
+
+# Size of the self-test file, in MB.
+SELF_TEST_SIZE = 256
+
+# The model string reported by NVMe instance store devices on Nitro
+# instances.
+NVME_INSTANCE_STORE_MODEL = "Amazon EC2 NVMe Instance Storage"
+
+def get_root_device():
+    """
+    Returns the name of the block device (e.g. "xvda") holding the root
+    filesystem.
+    """
+    with open("/proc/mounts", "r") as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) >= 2 and fields[1] == "/":
+                device = realpath(fields[0]).rsplit("/", 1)[-1]
+                break
+        else:
+            return None
+
+    # Strip the partition (xvda1 -> xvda, nvme0n1p1 -> nvme0n1).
+    for name in listdir(SYSFS_BLOCK_DIR):
+        if device != name and device.startswith(name):
+            return name
+    return device
+
+def get_device_info(name):
+    """
+    Returns {"name", "path", "size", "rotational"} for the given block
+    device; size is in bytes.
+    """
+    sys_dir = path_join(SYSFS_BLOCK_DIR, name)
+    with open(path_join(sys_dir, "size"), "r") as fd:
+        size = int(fd.read()) * 512
+    try:
+        with open(path_join(sys_dir, "queue", "rotational"), "r") as fd:
+            rotational = fd.read().strip() == "1"
+    except IOError:
+        rotational = False
+    return {"name": name, "path": "/dev/" + name, "size": size,
+            "rotational": rotational}
+
+def get_device_model(name):
+    """
+    Returns the model string of the given block device, or None if it
+    doesn't report one (e.g. Xen virtual disks).
+    """
+    try:
+        with open(path_join(SYSFS_BLOCK_DIR, name, "device", "model"),
+                  "r") as fd:
+            return fd.read().strip()
+    except IOError:
+        return None
+
+def get_metadata_ephemeral_names():
+    """
+    Returns the names of the block devices the instance metadata maps to
+    ephemeral stores.  Metadata uses sd names (e.g. "sdb"); Xen kernels
+    present them as xvd devices, so both are returned.
+    """
+    mapping = get_metadata().get("block-device-mapping") or {}
+    names = set()
+    for key, device in mapping.items():
+        if not key.startswith("ephemeral"):
+            continue
+        name = device.rsplit("/", 1)[-1]
+        names.add(name)
+        if name.startswith("sd"):
+            names.add("xv" + name[1:])
+    return names
+
+def discover_devices(expected_sizes=None):
+    """
+    discover_devices(expected_sizes=None) -> [device info]
+
+    Returns the local disks which are ephemeral stores.  Only devices the
+    instance identifies as ephemeral (NVMe instance storage, or ephemeral
+    entries in the metadata's block device mapping) are considered;
+    unclassified disks may be EBS volumes and are never used.  If
+    expected_sizes (a list of sizes in GB, from
+    ClusterConfiguration.ephemeral_stores) is given, only those devices
+    matching the sizes are returned, at most one per entry.
+    """
+    root = get_root_device()
+    ephemeral_names = get_metadata_ephemeral_names()
+    devices = []
+    for name in sorted(listdir(SYSFS_BLOCK_DIR)):
+        if name == root or name.startswith(("loop", "ram", "dm-", "md", "sr",
+                                            "zram")):
+            continue
+        if not exists("/dev/" + name):
+            continue
+        if (name not in ephemeral_names and
+            get_device_model(name) != NVME_INSTANCE_STORE_MODEL):
+            continue
+        devices.append(get_device_info(name))
+
+    if expected_sizes is None:
+        return devices
+
+    # Check the ephemeral devices against the expected sizes.  Sizes in the
+    # table are decimal GB and a little generous.
+    result = []
+    remaining = sorted(expected_sizes, reverse=True)
+    for device in sorted(devices, key=lambda d: -d["size"]):
+        size_gb = device["size"] / 1e9
+        for expected in remaining:
+            if abs(size_gb - expected) <= expected * SIZE_TOLERANCE:
+                remaining.remove(expected)
+                result.append(device)
+                break
+    return sorted(result, key=lambda d: d["name"])
+
+def get_stripe_size(n_devices):
+    """
+    Returns the stripe size in KB for striping across n_devices, a power of
+    two so a full stripe is about FULL_STRIPE_KB.
+    """
+    stripe = MAX_STRIPE_KB
+    while stripe > MIN_STRIPE_KB and stripe * n_devices > FULL_STRIPE_KB:
+        stripe //= 2
+    return stripe
+
+def get_layout(devices):
+    """
+    get_layout(devices) -> dict
+
+    Returns the striping, ext4 tuning and mount options for an array of the
+    given devices.
+    """
+    n = len(devices)
+    stripe_kb = get_stripe_size(n) if n > 1 else None
+    # ext4 stride and stripe width are in 4 KB blocks.
+    stride = (stripe_kb // 4) if stripe_kb is not None else None
+    rotational = any(device["rotational"] for device in devices)
+
+    mount_options = ["noatime"]
+    if not rotational:
+        # Instance store SSDs need TRIM to keep their write performance.
+        mount_options.append("discard")
+
+    mkfs_options = ["-m", "0"]
+    extended = ["lazy_itable_init=1", "nodiscard"]
+    if stride is not None:
+        extended += ["stride=%d" % stride, "stripe_width=%d" % (stride * n)]
+    mkfs_options += ["-E", ",".join(extended)]
+
+    return {
+        "devices": [device["path"] for device in devices],
+        "stripes": n,
+        "stripe_kb": stripe_kb,
+        "rotational": rotational,
+        "mkfs_options": mkfs_options,
+        "mount_options": ",".join(mount_options),
+        # Read ahead a full stripe (in 512 byte sectors).
+        "read_ahead": ((stripe_kb or 256) * max(n, 1) * 2),
+    }
+
+def is_mounted(path):
+    """
+    Returns the mount point of the given device or mount point if it is
+    mounted, or None.
+    """
+    with open("/proc/mounts", "r") as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) >= 2 and path in (fields[0], fields[1]):
+                return fields[1]
+    return None
+
+def run(cmd, dry_run=False):
+    print(" ".join(cmd))
+    if not dry_run:
+        check_call(cmd)
+    return
+
+def create_array(layout, mount_point=DEFAULT_MOUNT_POINT, dry_run=False):
+    """
+    Build the LVM array and ext4 filesystem described by layout and mount it.
+    """
+    devices = layout["devices"]
+
+    # Some AMIs mount the ephemeral drives; unmount them.
+    for device in devices:
+        mounted = is_mounted(device)
+        if mounted is not None:
+            run(["umount", mounted], dry_run)
+
+    run(["pvcreate", "-ff", "-y"] + devices, dry_run)
+    run(["vgcreate", VOLUME_GROUP] + devices, dry_run)
+    lvcreate = ["lvcreate", "-y", "--name", LOGICAL_VOLUME,
+                "--extents", "100%VG"]
+    if layout["stripes"] > 1:
+        lvcreate += ["--stripes", str(layout["stripes"]),
+                     "--stripesize", "%dk" % layout["stripe_kb"]]
+    run(lvcreate + [VOLUME_GROUP], dry_run)
+    run(["mkfs.ext4", "-F"] + layout["mkfs_options"] + [LOGICAL_VOLUME_PATH],
+        dry_run)
+    mount_array(layout, mount_point, dry_run)
+    return
+
+def mount_array(layout, mount_point=DEFAULT_MOUNT_POINT, dry_run=False):
+    if not dry_run and not isdir(mount_point):
+        makedirs(mount_point)
+    run(["blockdev", "--setra", str(layout["read_ahead"]),
+         LOGICAL_VOLUME_PATH], dry_run)
+    run(["mount", "-t", "ext4", "-o", layout["mount_options"],
+         LOGICAL_VOLUME_PATH, mount_point], dry_run)
+    if not dry_run:
+        # Restricted delete, like /tmp.
+        chmod(mount_point, 0o1777)
+    return
+
+def self_test(mount_point=DEFAULT_MOUNT_POINT, size_mb=SELF_TEST_SIZE):
+    """
+    self_test(mount_point=DEFAULT_MOUNT_POINT, size_mb=SELF_TEST_SIZE)
+        -> {"write_mb_per_s", "read_mb_per_s"}
+
+    Measure sequential direct I/O throughput on the mounted array with dd.
+    """
+    filename = path_join(mount_point, ".slurm-ec2-self-test")
+    result = {"size_mb": size_mb}
+    try:
+        for direction, cmd in [
+                ("write", ["dd", "if=/dev/zero", "of=" + filename, "bs=1M",
+                           "count=%d" % size_mb, "oflag=direct"]),
+                ("read", ["dd", "if=" + filename, "of=/dev/null", "bs=1M",
+                          "iflag=direct"])]:
+            start = time()
+            proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+            out, err = proc.communicate()
+            elapsed = time() - start
+            if proc.returncode != 0:
+                raise OSError("%s failed: %s" % (" ".join(cmd), err.strip()))
+            result[direction + "_mb_per_s"] = round(
+                size_mb / max(elapsed, 1e-6), 1)
+    finally:
+        try:
+            unlink(filename)
+        except OSError:
+            pass
+    return result
+
+def write_record(record, filename=STORAGE_RECORD_FILENAME):
+    directory = filename.rsplit("/", 1)[0]
+    if not isdir(directory):
+        makedirs(directory)
+    with open(filename, "w") as fd:
+        json_dump(record, fd, indent=2, sort_keys=True)
+        fd.write("\n")
+        fd.flush()
+        fsync(fd.fileno())
+    return
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description=("Stripe the instance's ephemeral stores into a single "
+                     "LVM volume, tuned for the instance type, and mount "
+                     "it."))
+    parser.add_argument(
+        "--mount-point", "-m", default=DEFAULT_MOUNT_POINT,
+        help=("Where to mount the volume.  Defaults to %s." %
+              DEFAULT_MOUNT_POINT))
+    parser.add_argument(
+        "--instance-type", "-i",
+        help=("The instance type whose ephemeral stores to expect.  "
+              "Defaults to this instance's type."))
+    parser.add_argument(
+        "--dry-run", "-n", action="store_true", default=False,
+        help=("Print the commands which would be run."))
+    parser.add_argument(
+        "--self-test-size", type=int, default=SELF_TEST_SIZE,
+        help=("The size of the throughput self-test, in MB (0 to skip).  "
+              "Defaults to %d." % SELF_TEST_SIZE))
+    parser.add_argument(
+        "--record", default=STORAGE_RECORD_FILENAME,
+        help=("Where to write the layout and self-test results.  Defaults "
+              "to %s." % STORAGE_RECORD_FILENAME))
+    args = parser.parse_args()
+
+    instance_type = (args.instance_type if args.instance_type is not None
+                     else get_instance_type())
+    expected = ClusterConfiguration.ephemeral_stores.get(instance_type)
+
+    if is_mounted(args.mount_point):
+        print("%s is already mounted" % (args.mount_point,))
+        return 0
+
+    if exists(LOGICAL_VOLUME_PATH):
+        # Ephemeral stores survive a reboot; reuse the array.
+        devices = discover_devices(expected)
+        layout = get_layout(devices)
+        created = False
+        try:
+            mount_array(layout, args.mount_point, args.dry_run)
+        except Exception as e:
+            print("Unable to mount %s: %s" % (LOGICAL_VOLUME_PATH, e),
+                  file=stderr)
+            return 1
+    else:
+        if expected is None:
+            print("No ephemeral store sizes known for %s; using the devices "
+                  "the instance reports as ephemeral" % (instance_type,))
+        devices = discover_devices(expected)
+        if expected is not None and len(devices) < len(expected):
+            print("Expected %d ephemeral store(s) for %s; found %d" % (
+                len(expected), instance_type, len(devices)), file=stderr)
+        if not devices:
+            print("No ephemeral stores found")
+            return 0
+
+        layout = get_layout(devices)
+        created = True
+        try:
+            create_array(layout, args.mount_point, args.dry_run)
+        except Exception as e:
+            print("Unable to create the ephemeral volume: %s" % (e,),
+                  file=stderr)
+            return 1
+
+    record = dict(layout, instance_type=instance_type, created=created,
+                  mount_point=args.mount_point)
+    if args.dry_run:
+        print(record)
+        return 0
+
+    if args.self_test_size > 0:
+        try:
+            record["self_test"] = self_test(args.mount_point,
+                                            args.self_test_size)
+            print("Self-test: %(write_mb_per_s)s MB/s write, "
+                  "%(read_mb_per_s)s MB/s read" % record["self_test"])
+        except (IOError, OSError) as e:
+            print("Self-test failed: %s" % (e,), file=stderr)
+            record["self_test"] = {"error": str(e)}
+
+    try:
+        write_record(record, args.record)
+    except (IOError, OSError) as e:
+        print("Unable to write %s: %s" % (args.record, e), file=stderr)
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,25 +1,98 @@
 #!/usr/bin/python
 from __future__ import absolute_import, print_function
+import boto.s3
 import boto.sqs
 from boto.sqs.message import Message
 from .clusterconfig import ClusterConfiguration
+from .fetch import parse_s3_url
 from getopt import getopt, GetoptError
-from .instanceinfo import get_region
+from .instanceinfo import get_instance_type, get_metadata, get_region
+from .interruption import SpotInterruptionWatcher, drain_node
 from json import dumps as json_dumps, loads as json_loads
-from os import environ, urandom
-from signal import signal, SIGUSR1
+from os import environ, killpg, setpgid, urandom
+from os.path import join as path_join
+from Queue import Empty, Queue
+from signal import signal, SIGKILL, SIGTERM, SIGUSR1
 from subprocess import PIPE, Popen
 from sys import argv, stderr, stdout
-from time import sleep
+from threading import Event, Lock, Thread, Timer
+from time import sleep, time
 from types import NoneType
 
 BUFSIZE = 1 << 20 # 1 MB
 SLEEP_TIME = 5
 MAX_TIMES_EMPTY = 3
 
+# Memory (in MB) left for the system when packing tasks.
+MEMORY_RESERVE = 512
+
+# Runners hold messages for this many seconds at a time and extend the hold
+# every HEARTBEAT_INTERVAL seconds while the task is waiting or running, so
+# a task whose runner dies is redelivered quickly while long tasks are never
+# redelivered.
+HEARTBEAT_VISIBILITY = 300
+HEARTBEAT_INTERVAL = 60
+
+# Deliveries of a message before SQS moves it to the dead-letter queue.
+MAX_RECEIVE_COUNT = 5
+
+# Dead-lettered messages are kept for the SQS maximum (14 days).
+DEAD_LETTER_RETENTION = 14 * 24 * 60 * 60
+
+# Delay before retrying a failed task; doubled on each attempt.
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 900
+
+# Array tasks are split into messages of at most this many indices.  Larger
+# ranges are split ARRAY_FANOUT ways by whichever runner receives them, so
+# a sweep spreads across runners in a few rounds.
+DEFAULT_ARRAY_CHUNK = 100
+ARRAY_FANOUT = 10
+
+# Chunk responses whose outputs exceed this are written to S3 instead (SQS
+# messages are limited to 256 KB).
+MAX_INLINE_OUTPUT = 64 * 1024
+
+# Priority lanes, highest first.  Each lane has its own request queue; the
+# normal lane's is slurm-<queue_id>-request, so queues created before lanes
+# existed keep working.
+PRIORITY_LANES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+# Under the weighted policy, lanes with work share receives in proportion
+# to these weights.
+LANE_WEIGHTS = {"high": 8, "normal": 4, "low": 1}
+
+# A lane which hasn't been served for this many seconds is polled first,
+# whatever the policy.
+LANE_STARVATION_TIME = 300
+
+# Tasks which outlive their timeout or are cancelled are sent SIGTERM, then
+# SIGKILL if they're still running this many seconds later.
+KILL_GRACE_PERIOD = 30
+
+# Seconds between checks for cancelled tasks.
+CANCEL_POLL_INTERVAL = 30
+
+# Task statuses reported in responses.
+COMPLETED = "completed"
+TIMED_OUT = "timed_out"
+CANCELLED = "cancelled"
+
+# The status of tasks stopped by a spot interruption.  These are requeued
+# for another node rather than answered.
+INTERRUPTED = "interrupted"
+
+# Exit codes reported for tasks which timed out (as timeout(1) does) or
+# were cancelled.
+TIMEOUT_EXIT_CODE = 124
+CANCELLED_EXIT_CODE = 130
+
+SYSFS_CPU_DIR = "/sys/devices/system/cpu"
+
 exit_requested = False
 
-def request_exit():
+def request_exit(*args):
     global exit_requested
     exit_requested = True
 
@@ -28,120 +101,1794 @@ def get_sqs():
     region = get_region()
     return boto.sqs.connect_to_region(region)
 
-def run_tasks():
-    global exit_requested
-    queue_id = environ.get("SLURM_EC2_QUEUE_ID")
-    if queue_id is None:
-        print("SLURM_EC2_QUEUE_ID environment variable not set", file=stderr)
+def get_s3():
+    return boto.s3.connect_to_region(get_region())
+
+def get_task_root(queue_id):
+    """
+    Returns the S3 prefix for a task queue's files,
+    <slurm_s3_root>/tasks/<queue_id>.
+    """
+    cc = ClusterConfiguration.from_config()
+    return "%s/tasks/%s" % (cc.slurm_s3_root.rstrip("/"), queue_id)
+
+def get_request_queue_name(queue_id, priority=DEFAULT_PRIORITY):
+    """
+    Returns the name of the request queue for the given priority lane.
+    """
+    if priority not in PRIORITY_LANES:
+        raise ValueError("Unknown priority %r; expected one of %s" % (
+            priority, ", ".join(PRIORITY_LANES)))
+    if priority == DEFAULT_PRIORITY:
+        return "slurm-%s-request" % queue_id
+    return "slurm-%s-request-%s" % (queue_id, priority)
+
+def get_request_queues(sqs, queue_id):
+    """
+    get_request_queues(sqs, queue_id) -> [(priority, queue)]
+
+    Returns the existing request queues, highest priority first.
+    """
+    result = []
+    for priority in PRIORITY_LANES:
+        queue = sqs.get_queue(get_request_queue_name(queue_id, priority))
+        if queue is not None:
+            result.append((priority, queue))
+    return result
+
+def batch_by_queue(msgs):
+    """
+    Group messages by the queue they were received from, in batches of ten
+    (the limit for the SQS batch calls).  Yields (queue, msgs).
+    """
+    by_queue = {}
+    for msg in msgs:
+        by_queue.setdefault(msg.queue, []).append(msg)
+    for queue, queue_msgs in by_queue.items():
+        for i in xrange(0, len(queue_msgs), 10):
+            yield queue, queue_msgs[i:i + 10]
+
+def get_max_receive_count(queue):
+    """
+    Returns the maxReceiveCount of the queue's redrive policy, or
+    MAX_RECEIVE_COUNT if it has none.
+    """
+    try:
+        policy = queue.get_attributes("RedrivePolicy").get("RedrivePolicy")
+        if policy:
+            return int(json_loads(policy)["maxReceiveCount"])
+    except Exception:
+        pass
+    return MAX_RECEIVE_COUNT
+
+def get_receive_count(msg):
+    try:
+        return int(msg.attributes.get("ApproximateReceiveCount", 1))
+    except (AttributeError, ValueError):
         return 1
 
-    request_queue_name = "slurm-%s-request" % queue_id
-    response_queue_name = "slurm-%s-response" % queue_id
+def parse_cpu_list(value):
+    """
+    Parse a Linux CPU list such as "0-3,8,10-11" into a list of CPU ids.
+    """
+    cpus = []
+    for item in value.strip().split(","):
+        if not item:
+            continue
+        if "-" in item:
+            first, last = item.split("-", 1)
+            cpus.extend(xrange(int(first), int(last) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
 
-    sqs = get_sqs()
-    request_queue = sqs.get_queue(request_queue_name)
-    response_queue = sqs.get_queue(response_queue_name)
+def format_cpu_list(cpus):
+    return ",".join([str(cpu) for cpu in sorted(cpus)])
 
-    # Handle a USR1 signal by setting the exit_requested flag -- we'll exit
-    # when we find no more tasks in the queue.
-    signal(SIGUSR1, request_exit)
+def get_node_memory():
+    """
+    Returns the memory (in MB) available for tasks on this node.
+    """
+    try:
+        with open("/proc/meminfo", "r") as fd:
+            for line in fd:
+                if line.startswith("MemTotal:"):
+                    total = int(line.split()[1]) // 1024
+                    return max(total - MEMORY_RESERVE, 0)
+    except (IOError, ValueError):
+        pass
+    return 0
 
-    # Keep reading tasks from the request queue.
-    while True:
-        msg = request_queue.read()
-        if msg is None:
-            if exit_requested:
+def set_cpu_affinity(cpus):
+    """
+    Restrict the calling process (and its future children) to the given
+    CPUs.
+    """
+    try:
+        from os import sched_setaffinity
+        sched_setaffinity(0, cpus)
+        return
+    except ImportError:
+        pass
+
+    # Python 2 has no binding; call sched_setaffinity(2) directly.
+    from ctypes import CDLL, c_ulong, get_errno, sizeof
+    from ctypes.util import find_library
+    libc = CDLL(find_library("c"), use_errno=True)
+    bits = 8 * sizeof(c_ulong)
+    mask = (c_ulong * (max(cpus) // bits + 1))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    if libc.sched_setaffinity(0, sizeof(mask), mask) != 0:
+        raise OSError(get_errno(), "sched_setaffinity failed")
+    return
+
+def split_array(request, fanout=ARRAY_FANOUT):
+    """
+    split_array(request, fanout=ARRAY_FANOUT) -> [request]
+
+    Split an array request covering more than one chunk into at most fanout
+    requests along chunk boundaries.  Chunk boundaries are counted from the
+    start of the range, so every split of the same array yields the same
+    chunks.  Returns [request] if it is a single chunk.
+    """
+    array = request["array"]
+    start, stop = array["start"], array["stop"]
+    chunk = array.get("chunk", DEFAULT_ARRAY_CHUNK)
+    n_chunks = (stop - start + chunk - 1) // chunk
+    if n_chunks <= 1:
+        return [request]
+
+    chunks_per_piece = (n_chunks + fanout - 1) // fanout
+    result = []
+    for piece_start in xrange(start, stop, chunks_per_piece * chunk):
+        piece = dict(request)
+        piece["array"] = dict(array, start=piece_start, stop=min(
+            piece_start + chunks_per_piece * chunk, stop))
+        result.append(piece)
+    return result
+
+def expand_command(cmd, index, param=None):
+    """
+    Substitute {index} and {param} in each argument of an array task's
+    command.
+    """
+    result = []
+    for arg in cmd:
+        arg = arg.replace("{index}", str(index))
+        if param is not None:
+            arg = arg.replace("{param}", param)
+        result.append(arg)
+    return result
+
+def encode_exit_codes(exit_codes):
+    """
+    encode_exit_codes([0, 0, 0, 1, 0]) -> [[0, 3], [1, 1], [0, 1]]
+
+    Run-length encode a list of exit codes.
+    """
+    result = []
+    for exit_code in exit_codes:
+        if result and result[-1][0] == exit_code:
+            result[-1][1] += 1
+        else:
+            result.append([exit_code, 1])
+    return result
+
+def decode_exit_codes(runs):
+    """
+    decode_exit_codes([[0, 3], [1, 1], [0, 1]]) -> [0, 0, 0, 1, 0]
+    """
+    result = []
+    for exit_code, count in runs:
+        result.extend([exit_code] * count)
+    return result
+
+def combine_statuses(statuses):
+    """
+    Returns the status of a group of results: CANCELLED if any was
+    cancelled, otherwise TIMED_OUT if any timed out, otherwise COMPLETED.
+    """
+    for status in (CANCELLED, TIMED_OUT):
+        if status in statuses:
+            return status
+    return COMPLETED
+
+def terminate_process_group(proc, grace_period=KILL_GRACE_PERIOD):
+    """
+    Send SIGTERM to the process group led by proc, then SIGKILL if the group
+    is still around grace_period seconds later.
+    """
+    try:
+        killpg(proc.pid, SIGTERM)
+    except OSError:
+        return
+
+    def kill():
+        try:
+            killpg(proc.pid, SIGKILL)
+        except OSError:
+            pass
+
+    timer = Timer(grace_period, kill)
+    timer.daemon = True
+    timer.start()
+    return
+
+def read_url(url):
+    """
+    Returns the contents of an S3 object (s3://...) or local file.
+    """
+    if not url.startswith("s3://"):
+        with open(url, "rb") as fd:
+            return fd.read()
+
+    bucket_name, key_name = parse_s3_url(url)
+    key = get_s3().get_bucket(bucket_name, validate=False).get_key(key_name)
+    if key is None:
+        raise ValueError("S3 object not found: %s" % (url,))
+    return key.get_contents_as_string()
+
+def write_url(url, data):
+    bucket_name, key_name = parse_s3_url(url)
+    get_s3().get_bucket(bucket_name, validate=False).new_key(
+        key_name).set_contents_from_string(data)
+    return url
+
+def get_array_outputs(response):
+    """
+    get_array_outputs(response) -> {index: (stdout, stderr)}
+
+    Returns the outputs of a chunk response, fetching them from S3 if they
+    were spilled there.  Indices with no output are omitted.
+    """
+    if response.get("output_url") is not None:
+        outputs = json_loads(read_url(response["output_url"]))
+    else:
+        outputs = response.get("outputs", {})
+    return dict((int(index), tuple(output))
+                for index, output in outputs.iteritems())
+
+class CpuTopology(object):
+    """
+    The logical CPUs of a node grouped by socket and core.
+
+    sockets is a list of sockets; each socket is a list of cores; each core
+    is a list of logical CPU ids (hyperthreads sharing the core).
+    """
+
+    def __init__(self, sockets):
+        self.sockets = sockets
+        return
+
+    @property
+    def cpus(self):
+        return [cpu for socket in self.sockets for core in socket
+                for cpu in core]
+
+    @property
+    def n_cpus(self):
+        return len(self.cpus)
+
+    def __repr__(self):
+        return "CpuTopology(%r)" % (self.sockets,)
+
+    @classmethod
+    def from_sysfs(cls, root=SYSFS_CPU_DIR):
+        """
+        Read the topology of the online CPUs from sysfs.
+        """
+        with open(path_join(root, "online"), "r") as fd:
+            online = parse_cpu_list(fd.read())
+
+        cores = {}
+        for cpu in online:
+            topology_dir = path_join(root, "cpu%d" % cpu, "topology")
+            with open(path_join(topology_dir, "physical_package_id")) as fd:
+                socket_id = int(fd.read())
+            with open(path_join(topology_dir, "core_id")) as fd:
+                core_id = int(fd.read())
+            cores.setdefault(socket_id, {}).setdefault(core_id, []).append(cpu)
+
+        return cls([[sorted(socket[core_id]) for core_id in sorted(socket)]
+                    for socket_id, socket in sorted(cores.iteritems())])
+
+    @classmethod
+    def from_features(cls, features):
+        """
+        Derive the topology from a SLURM node description such as
+        "Sockets=2 CoresPerSocket=8 ThreadsPerCore=2".
+        """
+        values = {}
+        for item in features.split():
+            if "=" in item:
+                key, value = item.split("=", 1)
+                values[key] = value
+        return cls.from_hardware(values)
+
+    @classmethod
+    def from_hardware(cls, values):
+        """
+        Derive the topology from a dict of Sockets, CoresPerSocket and
+        ThreadsPerCore (see ClusterConfiguration.get_node_hardware()).
+        Linux on EC2 numbers the first thread of every core before the
+        second threads, so core c has CPUs c, c + n_cores, ...
+        """
+        sockets = int(values.get("Sockets", 1))
+        cores_per_socket = int(values.get("CoresPerSocket", 1))
+        threads_per_core = int(values.get("ThreadsPerCore", 1))
+        n_cores = sockets * cores_per_socket
+
+        return cls([
+            [[core + thread * n_cores for thread in xrange(threads_per_core)]
+             for core in xrange(socket * cores_per_socket,
+                                (socket + 1) * cores_per_socket)]
+            for socket in xrange(sockets)])
+
+    @classmethod
+    def detect(cls):
+        """
+        Returns the topology of this node from sysfs, falling back to the
+        SLURM description of this instance type.
+        """
+        try:
+            return cls.from_sysfs()
+        except (IOError, OSError, ValueError):
+            pass
+
+        try:
+            hardware = ClusterConfiguration.get_node_hardware(
+                get_instance_type())
+        except Exception:
+            hardware = None
+
+        if hardware:
+            return cls.from_hardware(hardware)
+
+        from multiprocessing import cpu_count
+        return cls([[[cpu] for cpu in xrange(cpu_count())]])
+
+class CpuAllocator(object):
+    """
+    Allocate CPUs and memory on a node to tasks.
+
+    Tasks are packed into whole cores where possible, and into a single
+    socket if one has room (best fit), so co-located tasks share as little
+    as possible.
+    """
+
+    def __init__(self, topology, memory):
+        self.topology = topology
+        self.total_memory = memory
+        self.free_memory = memory
+        # For each socket, for each core, the set of free CPUs.
+        self.free = [[set(core) for core in socket]
+                     for socket in topology.sockets]
+        return
+
+    def fits_node(self, cpus, memory):
+        """
+        Returns True if a task of this size could ever run on this node.
+        """
+        return (cpus <= self.topology.n_cpus and
+                (memory <= self.total_memory or self.total_memory == 0))
+
+    def allocate(self, cpus, memory):
+        """
+        allocator.allocate(cpus, memory) -> [cpu] | None
+
+        Reserve the given number of CPUs and memory (MB).  Returns the CPU
+        ids, or None if there isn't room right now.
+        """
+        if memory > self.free_memory and self.total_memory > 0:
+            return None
+
+        free_per_socket = [sum([len(core) for core in socket])
+                           for socket in self.free]
+        if sum(free_per_socket) < cpus:
+            return None
+
+        # Best fit: the socket with the least room that still fits the task;
+        # otherwise spread over the sockets with the most room.
+        fitting = [i for i, n in enumerate(free_per_socket) if n >= cpus]
+        if fitting:
+            order = [min(fitting, key=lambda i: free_per_socket[i])]
+        else:
+            order = sorted(xrange(len(self.free)),
+                           key=lambda i: -free_per_socket[i])
+
+        chosen = []
+        for socket_index in order:
+            topology_socket = self.topology.sockets[socket_index]
+            # Whole free cores first, then the fullest partially used cores.
+            cores = sorted(
+                [(len(core) != len(topology_socket[core_index]), len(core),
+                  core_index)
+                 for core_index, core in enumerate(self.free[socket_index])
+                 if core])
+            for partial, n_free, core_index in cores:
+                core = self.free[socket_index][core_index]
+                for cpu in sorted(core):
+                    if len(chosen) == cpus:
+                        break
+                    chosen.append(cpu)
+            if len(chosen) == cpus:
                 break
 
-            # Don't exit just yet...
-            sleep(SLEEP_TIME)
-            continue
+        for socket in self.free:
+            for core in socket:
+                core.difference_update(chosen)
 
-        print("Message received: %r" % msg.get_body())
-        
+        if self.total_memory > 0:
+            self.free_memory -= memory
+        return chosen
+
+    def release(self, cpus, memory):
+        """
+        Return CPUs and memory from a finished task.
+        """
+        cpus = set(cpus)
+        for socket_index, socket in enumerate(self.topology.sockets):
+            for core_index, core in enumerate(socket):
+                self.free[socket_index][core_index].update(
+                    cpus.intersection(core))
+        if self.total_memory > 0:
+            self.free_memory += memory
+        return
+
+class TaskCancellations(object):
+    """
+    The cancelled tasks of a queue.  A task is cancelled by writing an empty
+    object named for its id under the queue's cancel prefix
+    (<slurm_s3_root>/tasks/<queue_id>/cancel/<task id>); runners list the
+    prefix at most every refresh_interval seconds.
+    """
+
+    def __init__(self, url, refresh_interval=CANCEL_POLL_INTERVAL):
+        self.url = url.rstrip("/")
+        self.bucket_name, self.prefix = parse_s3_url(self.url + "/")
+        self.refresh_interval = refresh_interval
+        self.task_ids = frozenset()
+        self.last_refresh = None
+        self._bucket = None
+        return
+
+    @classmethod
+    def for_queue(cls, queue_id, refresh_interval=CANCEL_POLL_INTERVAL):
+        return cls(get_task_root(queue_id) + "/cancel", refresh_interval)
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = get_s3().get_bucket(self.bucket_name,
+                                               validate=False)
+        return self._bucket
+
+    def __contains__(self, task_id):
+        return task_id in self.task_ids
+
+    def refresh(self, force=False):
+        """
+        Re-read the cancelled task ids if refresh_interval seconds have
+        passed since the last refresh (or force is True).
+        """
+        now = time()
+        if (not force and self.last_refresh is not None and
+            now - self.last_refresh < self.refresh_interval):
+            return self.task_ids
+
+        self.last_refresh = now
+        self.task_ids = frozenset(
+            key.name[len(self.prefix):]
+            for key in self.bucket.list(prefix=self.prefix))
+        return self.task_ids
+
+    def cancel(self, task_id):
+        self.bucket.new_key(self.prefix + task_id).set_contents_from_string(
+            "")
+        return
+
+    def clear(self):
+        """
+        Delete every cancellation.
+        """
+        names = [key.name for key in self.bucket.list(prefix=self.prefix)]
+        if names:
+            self.bucket.delete_keys(names)
+        self.task_ids = frozenset()
+        return
+
+class LaneScheduler(object):
+    """
+    Decides the order in which a runner polls the priority lanes.
+
+    Under the "weighted" policy, lanes with work share receives in
+    proportion to their weights (smooth weighted round robin), so urgent
+    tasks overtake a large backlog without stopping it.  Under "strict", a
+    lane is only polled when every higher lane is empty.  Either way, a
+    lane which hasn't been served for starvation_time seconds is polled
+    first.
+    """
+
+    policies = ("weighted", "strict")
+
+    def __init__(self, lanes, policy="weighted", weights=None,
+                 starvation_time=LANE_STARVATION_TIME):
+        if policy not in self.policies:
+            raise ValueError("Unknown lane policy %r; expected one of %s" % (
+                policy, ", ".join(self.policies)))
+        self.lanes = list(lanes)
+        self.policy = policy
+        self.weights = dict(weights if weights is not None else LANE_WEIGHTS)
+        self.starvation_time = starvation_time
+        self.credit = dict((lane, 0) for lane in self.lanes)
+        self.last_order = list(self.lanes)
+        now = time()
+        # When each lane was last served or given a starvation poll.
+        self.last_chance = dict((lane, now) for lane in self.lanes)
+        return
+
+    def get_weight(self, lanes):
+        return sum(self.weights.get(lane, 1) for lane in lanes)
+
+    def order(self):
+        """
+        Returns the lanes in the order to poll them.
+        """
+        if self.policy == "strict":
+            result = list(self.lanes)
+        else:
+            for lane in self.lanes:
+                self.credit[lane] += self.weights.get(lane, 1)
+            # sorted() is stable, so ties go to the higher priority.
+            result = sorted(self.lanes, key=lambda lane: -self.credit[lane])
+
+        now = time()
+        starving = [lane for lane in self.lanes
+                    if now - self.last_chance[lane] >= self.starvation_time]
+        if starving:
+            lane = min(starving, key=lambda lane: self.last_chance[lane])
+            self.last_chance[lane] = now
+            result.remove(lane)
+            result.insert(0, lane)
+        self.last_order = result
+        return result
+
+    def served(self, lane):
+        """
+        Record that a task was received from lane after polling the lanes
+        in the last order().
+        """
+        self.last_chance[lane] = time()
+        if self.policy == "weighted":
+            # The lanes polled before this one were empty; they don't
+            # accumulate credit (so they can't monopolize the runner when
+            # work arrives) and the rest share the receives.
+            idle = self.last_order[:self.last_order.index(lane)]
+            for idle_lane in idle:
+                self.credit[idle_lane] = 0
+            self.credit[lane] -= self.get_weight(
+                [other for other in self.lanes if other not in idle])
+        return
+
+    def all_empty(self):
+        """
+        Record that every lane was empty.
+        """
+        for lane in self.lanes:
+            self.credit[lane] = 0
+        return
+
+class TaskRunner(object):
+    """
+    Run tasks from a SLURM EC2 task queue, several at a time.
+
+    Tasks are JSON messages with the keys:
+        id      the task id (required)
+        cmd     the command line, as a list (required)
+        env     the environment, as a dict (defaults to the runner's)
+        cpus    the number of logical CPUs to reserve (defaults to 1)
+        memory  the memory to reserve, in MB (defaults to 0)
+        retries how many times to retry the task if it exits with a non-zero
+                status (defaults to 0)
+        timeout the wall-clock limit in seconds (for an array task, on each
+                index)
+        array   makes this an array task (see below)
+        output  an S3 prefix for spilled array outputs (defaults to
+                <slurm_s3_root>/tasks/<queue_id>/output)
+
+    An array task runs cmd once for each index in a range:
+        {"start": 0, "stop": 1000000, "chunk": 100,
+         "params": "s3://bucket/params.txt"}
+    "{index}" in the arguments of cmd is replaced with the index (also
+    passed in SLURM_EC2_TASK_INDEX) and "{param}" with that line of the
+    optional params file.  A runner receiving more than one chunk splits it
+    (see split_array()); a single chunk runs its indices in turn and sends
+    one response with the run-length encoded exit codes of the chunk and
+    its non-empty outputs, which are written to S3 if they are large.
+
+    Tasks are started as soon as the node has room for them; each is pinned
+    to the CPUs reserved for it, which are also passed to it in the
+    SLURM_EC2_TASK_CPUS environment variable.
+
+    A task which exceeds its timeout, or is cancelled (see
+    TaskCancellations) while running, has its process group terminated
+    (SIGTERM, then SIGKILL after KILL_GRACE_PERIOD seconds).  A cancelled
+    task which hasn't started is answered without running.  Responses
+    carry a status of completed, timed_out or cancelled; cancelled tasks
+    aren't retried.
+
+    Messages are held with a short visibility timeout which is extended
+    while the task waits or runs.  A message which keeps failing (or keeps
+    crashing runners) is moved to the dead-letter queue,
+    slurm-<queue_id>-dead.
+
+    Tasks are submitted to one of the priority lanes (PRIORITY_LANES), each
+    with its own request queue; lane_policy decides how they are polled
+    (see LaneScheduler).
+
+    When the node receives a spot interruption notice (see interrupt()),
+    the runner stops taking work, terminates its tasks, makes their messages
+    visible to other runners as soon as they stop and exits.  Tasks which
+    finished before the interruption are answered as usual.
+    """
+
+    def __init__(self, sqs, queue_id, topology=None, memory=None,
+                 output_root=None, lane_policy="weighted"):
+        self.queue_id = queue_id
+        self.request_queues = dict(get_request_queues(sqs, queue_id))
+        self.request_queue = self.request_queues.get(DEFAULT_PRIORITY)
+        self.scheduler = LaneScheduler(
+            [lane for lane in PRIORITY_LANES if lane in self.request_queues],
+            lane_policy)
+        self.response_queue = sqs.get_queue("slurm-%s-response" % queue_id)
+        self.dead_letter_queue = sqs.get_queue("slurm-%s-dead" % queue_id)
+        self.max_receive_count = get_max_receive_count(self.request_queue)
+        self.topology = (topology if topology is not None
+                         else CpuTopology.detect())
+        self.allocator = CpuAllocator(
+            self.topology, memory if memory is not None else get_node_memory())
+        # Results from task threads: (msg, request, cpus, exit_code, out,
+        # err).  boto connections aren't thread-safe, so responses are only
+        # sent from the main thread.
+        self.results = Queue()
+        self.n_running = 0
+        self.pending = None
+        # Messages we hold (waiting or running), by receipt handle.
+        self.in_flight = {}
+        self.last_heartbeat = time()
+        # Running child processes by task id (id[index] for array tasks);
+        # updated by task threads.
+        self.procs = {}
+        # Why each stopped process was stopped (TIMED_OUT, CANCELLED or
+        # INTERRUPTED).
+        self.stopped = {}
+        self.procs_lock = Lock()
+        self.cancellations = None
+        self.interrupted = False
+        self.requeued = False
+        self._output_root = output_root
+        # Array parameter files by URL; read by task threads.
+        self.params = {}
+        self.params_lock = Lock()
+        return
+
+    @property
+    def output_root(self):
+        """
+        The default S3 prefix for spilled array task outputs.
+        """
+        if self._output_root is None:
+            self._output_root = get_task_root(self.queue_id) + "/output"
+        return self._output_root
+
+    def refresh_cancellations(self):
+        """
+        Re-read the cancelled task list if it's due.
+        """
         try:
-            # Decode the message as JSON
-            request = json_loads(msg.get_body())
+            if self.cancellations is None:
+                self.cancellations = TaskCancellations.for_queue(
+                    self.queue_id)
+            self.cancellations.refresh()
+        except Exception as e:
+            print("Unable to check for cancelled tasks: %s" % (e,),
+                  file=stderr)
+        return
 
-            print("Message decoded: %r" % (request,))
+    def is_cancelled(self, task_id):
+        """
+        Returns True if the task has been cancelled (as of the last
+        refresh).  This may be called from any thread.
+        """
+        return self.cancellations is not None and task_id in self.cancellations
 
-            id = request.get("id")
-            if id is None:
-                raise ValueError("Missing id in message")
+    def stop_task(self, key, status):
+        """
+        Terminate a running process (by its key in self.procs) because it
+        timed out or was cancelled.  This may be called from any thread.
+        """
+        with self.procs_lock:
+            proc = self.procs.get(key)
+            if proc is None or key in self.stopped:
+                return
+            self.stopped[key] = status
+
+        print("Stopping task %s (%s)" % (key, status))
+        terminate_process_group(proc)
+        return
+
+    def check_cancellations(self):
+        """
+        Stop running tasks which have been cancelled.
+        """
+        self.refresh_cancellations()
+        if self.cancellations is None or not self.cancellations.task_ids:
+            return
+
+        with self.procs_lock:
+            keys = list(self.procs)
+        for key in keys:
+            if self.is_cancelled(key.split("[", 1)[0]):
+                self.stop_task(key, CANCELLED)
+        return
+
+    def interrupt(self, notice=None):
+        """
+        Stop taking work and terminate running tasks.  This may be called
+        from any thread; the main loop requeues the messages of the tasks
+        terminated here (tasks which had already finished are answered as
+        usual).
+        """
+        self.interrupted = True
+        with self.procs_lock:
+            for task_id, proc in self.procs.items():
+                # A task already being stopped for a timeout or cancellation
+                # keeps that status.
+                self.stopped.setdefault(task_id, INTERRUPTED)
+                print("Terminating task %s" % (task_id,))
+                terminate_process_group(proc)
+        return
 
-            cmd = request.get("cmd")
-            env = request.get("env")
-
-            if cmd is None:
-                # No command to execute.
-                exit_code = 127
-                err = "No command to execute"
-                print(err)
-                out = ""
-            elif not isinstance(cmd, (list, tuple)):
-                # Invalid command line
-                exit_code = 127
-                err = ("Invalid command -- expected list instead of %s" %
-                       (type(cmd).__name__))
-                print(err)
-                out = ""
-            elif not isinstance(env, (dict, NoneType)):
-                # Invalid environment
-                exit_code = 127
-                err = ("Invalid environment -- expected dict instead of %s" %
-                       (type(cmd).__name__))
-                print(err)
-                out = ""
+    def requeue_pending(self):
+        """
+        Make the message waiting to start (if any) visible to other runners
+        now.  Running tasks' messages are requeued as they finish (see
+        finish_task()).
+        """
+        if self.pending is not None:
+            msg = self.pending[0]
+            self.in_flight.pop(msg.receipt_handle, None)
+            try:
+                msg.change_visibility(0)
+                print("Requeued task %s" % (self.pending[1]["id"],))
+            except Exception as e:
+                print("Unable to requeue message: %s" % (e,), file=stderr)
+        self.pending = None
+        self.requeued = True
+        return
+
+    @staticmethod
+    def validate(request):
+        """
+        Returns an error message if the request is invalid, or None.
+        """
+        cmd = request.get("cmd")
+        env = request.get("env")
+        cpus = request.get("cpus", 1)
+        memory = request.get("memory", 0)
+        retries = request.get("retries", 0)
+        timeout = request.get("timeout")
+
+        if cmd is None:
+            return "No command to execute"
+        if not isinstance(cmd, (list, tuple)):
+            return ("Invalid command -- expected list instead of %s" %
+                    (type(cmd).__name__))
+        if not isinstance(env, (dict, NoneType)):
+            return ("Invalid environment -- expected dict instead of %s" %
+                    (type(env).__name__))
+        if not isinstance(cpus, (int, long)) or cpus < 1:
+            return "Invalid cpus -- expected a positive integer"
+        if not isinstance(memory, (int, long)) or memory < 0:
+            return "Invalid memory -- expected a non-negative integer (MB)"
+        if not isinstance(retries, (int, long)) or retries < 0:
+            return "Invalid retries -- expected a non-negative integer"
+        if timeout is not None and (
+                isinstance(timeout, bool) or
+                not isinstance(timeout, (int, long, float)) or timeout <= 0):
+            return "Invalid timeout -- expected a positive number of seconds"
+        if "array" in request:
+            array = request["array"]
+            if not isinstance(array, dict):
+                return ("Invalid array -- expected dict instead of %s" %
+                        (type(array).__name__))
+            start = array.get("start", 0)
+            stop = array.get("stop")
+            chunk = array.get("chunk", DEFAULT_ARRAY_CHUNK)
+            if (not isinstance(start, (int, long)) or
+                not isinstance(stop, (int, long)) or not 0 <= start < stop):
+                return "Invalid array range -- expected 0 <= start < stop"
+            if not isinstance(chunk, (int, long)) or chunk < 1:
+                return "Invalid array chunk -- expected a positive integer"
+            if not isinstance(array.get("params"), (basestring, NoneType)):
+                return "Invalid array params -- expected a URL"
+        return None
+
+    def send_response(self, id, exit_code, out, err, status=COMPLETED):
+        response = self.response_queue.new_message(json_dumps({
+            'id': id,
+            'exit_code': exit_code,
+            'stdout': out,
+            'stderr': err,
+            'status': status,
+        }))
+        self.response_queue.write(response)
+        return
+
+    def send_array_response(self, request, exit_codes, outs, errs,
+                            statuses):
+        """
+        Send the response for a chunk of an array task.
+        """
+        array = request["array"]
+        start = array["start"]
+        outputs = dict(
+            (str(start + i), [out, err])
+            for i, (out, err) in enumerate(zip(outs, errs)) if out or err)
+        response = {
+            'id': request["id"],
+            'array': {'start': start, 'stop': array["stop"]},
+            'exit_code': max(exit_codes, key=lambda code: code != 0),
+            'exit_codes': encode_exit_codes(exit_codes),
+            'status': combine_statuses(statuses),
+        }
+        if response['status'] != COMPLETED:
+            # Run-length encoded like the exit codes.
+            response['statuses'] = encode_exit_codes(statuses)
+
+        data = json_dumps(outputs)
+        if len(data) > MAX_INLINE_OUTPUT:
+            response['output_url'] = write_url("%s/%s/%d-%d.json" % (
+                request.get("output", self.output_root).rstrip("/"),
+                request["id"], start, array["stop"]), data)
+        else:
+            response['outputs'] = outputs
+
+        self.response_queue.write(
+            self.response_queue.new_message(json_dumps(response)))
+        return
+
+    def split_array(self, msg, request):
+        """
+        Replace an array request covering several chunks with requests for
+        its parts, in the same lane.
+        """
+        parts = split_array(request)
+        print("Splitting %s[%d:%d] into %d part(s)" % (
+            request["id"], request["array"]["start"],
+            request["array"]["stop"], len(parts)))
+
+        result = msg.queue.write_batch([
+            (str(i), Message(body=json_dumps(part)).get_body_encoded(), 0)
+            for i, part in enumerate(parts)])
+        if result.errors:
+            raise ValueError("Unable to queue array parts: %s" % (
+                ", ".join([error["message"] for error in result.errors]),))
+        self.delete(msg)
+        return
+
+    def get_params(self, url):
+        """
+        Returns the lines of an array parameter file.
+        """
+        with self.params_lock:
+            params = self.params.get(url)
+            if params is None:
+                params = self.params[url] = read_url(url).splitlines()
+        return params
+
+    def delete(self, msg):
+        self.in_flight.pop(msg.receipt_handle, None)
+        msg.delete()
+        return
+
+    def dead_letter(self, msg, reason):
+        """
+        Move a message to the dead-letter queue.
+        """
+        print("Moving message to the dead-letter queue (%s): %r" % (
+            reason, msg.get_body()))
+        if self.dead_letter_queue is not None:
+            self.dead_letter_queue.write(
+                self.dead_letter_queue.new_message(msg.get_body()))
+        self.delete(msg)
+        return
+
+    def heartbeat(self):
+        """
+        Extend the visibility timeout of the messages we hold.
+        """
+        now = time()
+        if now - self.last_heartbeat < HEARTBEAT_INTERVAL:
+            return
+        self.last_heartbeat = now
+
+        for queue, batch in batch_by_queue(self.in_flight.values()):
+            try:
+                queue.change_message_visibility_batch(
+                    [(msg, HEARTBEAT_VISIBILITY) for msg in batch])
+            except Exception as e:
+                print("Unable to extend message visibility: %s" % (e,),
+                      file=stderr)
+        return
+
+    def execute(self, request, cpus):
+        """
+        Run a task on the given CPUs.  Returns (exit_code, stdout, stderr,
+        status), or lists of each for an array task.
+        """
+        env = dict(request["env"] if request.get("env") is not None
+                   else environ)
+        env["SLURM_EC2_TASK_CPUS"] = format_cpu_list(cpus)
+        print("Environment: %r" % (request.get("env"),))
+        timeout = request.get("timeout")
+        cancelled = (CANCELLED_EXIT_CODE, "", "Task cancelled", CANCELLED)
+        interrupted = (143, "", "Node interrupted before the task started",
+                       INTERRUPTED)
+
+        if "array" not in request:
+            if self.is_cancelled(request["id"]):
+                return cancelled
+            return self.run_command(request["id"], request["cmd"], env, cpus,
+                                    timeout)
+
+        array = request["array"]
+        params = (self.get_params(array["params"])
+                  if array.get("params") is not None else None)
+        exit_codes, outs, errs, statuses = [], [], [], []
+
+        for index in xrange(array["start"], array["stop"]):
+            if self.interrupted:
+                exit_code, out, err, status = interrupted
+            elif self.is_cancelled(request["id"]):
+                # Answer for the remaining indices without running them.
+                exit_code, out, err, status = cancelled
+            elif params is not None and index >= len(params):
+                exit_code, out, err, status = (
+                    127, "", "No parameter for index %d in %s" % (
+                        index, array["params"]), COMPLETED)
             else:
-                print("Invoking: %r" % (cmd,))
-                print("Environment: %r" % (env,))
+                env["SLURM_EC2_TASK_INDEX"] = str(index)
+                exit_code, out, err, status = self.run_command(
+                    "%s[%d]" % (request["id"], index),
+                    expand_command(request["cmd"], index,
+                                   params[index] if params is not None
+                                   else None), env, cpus, timeout)
+
+            exit_codes.append(exit_code)
+            outs.append(out)
+            errs.append(err)
+            statuses.append(status)
+
+        return exit_codes, outs, errs, statuses
+
+    def run_command(self, task_id, cmd, env, cpus, timeout=None):
+        """
+        Run a single command on the given CPUs, stopping it after timeout
+        seconds if timeout is not None.  Returns (exit_code, stdout, stderr,
+        status).
+        """
+        print("Invoking %s on CPUs %s: %r" % (
+            task_id, env["SLURM_EC2_TASK_CPUS"], cmd))
+
+        def prepare_child():
+            # Put the task in its own process group so it can be signalled
+            # along with anything it starts.
+            setpgid(0, 0)
+            try:
+                set_cpu_affinity(cpus)
+            except Exception:
+                # Pinning is an optimization; run unpinned rather than fail.
+                pass
 
+        with self.procs_lock:
+            if self.interrupted:
+                return (143, "", "Node interrupted before the task started",
+                        INTERRUPTED)
+            try:
                 proc = Popen(cmd, bufsize=BUFSIZE, stdin=PIPE, stdout=PIPE,
                              stderr=PIPE, close_fds=True, shell=False,
-                             env=env)
-
-                out, err = proc.communicate()
-                exit_code = proc.returncode
-
-                print("Process exited with exit_code %d" % exit_code)
-                print("stdout:-----")
-                print(out)
-                print("stderr:-----")
-                print(err)
-
-                del proc
-
-            response = response_queue.new_message(json_dumps({
-                'id': id,
-                'exit_code': exit_code,
-                'stdout': out,
-                'stderr': err
-            }))
-            response_queue.write(response)
-            msg.delete()
+                             env=env, preexec_fn=prepare_child)
+            except OSError as e:
+                return (127, "", "Unable to execute %r: %s" % (cmd, e),
+                        COMPLETED)
+            self.procs[task_id] = proc
+
+        timer = None
+        if timeout is not None:
+            timer = Timer(timeout, self.stop_task, (task_id, TIMED_OUT))
+            timer.daemon = True
+            timer.start()
+
+        try:
+            out, err = proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self.procs_lock:
+                self.procs.pop(task_id, None)
+                status = self.stopped.pop(task_id, COMPLETED)
+        exit_code = proc.returncode
+
+        print("Process %s exited with exit_code %d" % (task_id, exit_code))
+        print("stdout:-----")
+        print(out)
+        print("stderr:-----")
+        print(err)
+
+        if status == TIMED_OUT:
+            exit_code = TIMEOUT_EXIT_CODE
+            err += "\nTask timed out after %s seconds\n" % (timeout,)
+        elif status == CANCELLED:
+            exit_code = CANCELLED_EXIT_CODE
+            err += "\nTask cancelled\n"
+        return exit_code, out, err, status
+
+    def start_task(self, msg, request, cpus):
+        def run():
+            try:
+                exit_code, out, err, status = self.execute(request, cpus)
+            except Exception as e:
+                exit_code, out, err, status = 127, "", str(e), COMPLETED
+                if "array" in request:
+                    n = request["array"]["stop"] - request["array"]["start"]
+                    exit_code, out, err, status = (
+                        [127] * n, [""] * n, [str(e)] * n, [COMPLETED] * n)
+            self.results.put((msg, request, cpus, exit_code, out, err,
+                              status))
+
+        self.n_running += 1
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return
+
+    def finish_task(self, result):
+        msg, request, cpus, exit_code, out, err, status = result
+        self.n_running -= 1
+        self.allocator.release(cpus, request.get("memory", 0))
+
+        if INTERRUPTED in (status if "array" in request else [status]):
+            # Hand the whole task to another node.
+            print("Task %s stopped by interruption; requeuing" %
+                  (request["id"],))
+            self.in_flight.pop(msg.receipt_handle, None)
+            msg.change_visibility(0)
+            return
+
+        if "array" in request:
+            failed = any(exit_code)
+            cancelled = CANCELLED in status
+            respond = lambda: self.send_array_response(
+                request, exit_code, out, err, status)
+        else:
+            failed = exit_code != 0
+            cancelled = status == CANCELLED
+            respond = lambda: self.send_response(
+                request["id"], exit_code, out, err, status)
+
+        if failed and not cancelled and request.get("retries", 0) > 0:
+            attempt = get_receive_count(msg)
+            if attempt <= request["retries"] and (
+                    attempt < self.max_receive_count):
+                delay = min(RETRY_DELAY << (attempt - 1), MAX_RETRY_DELAY)
+                print("Task %s failed (attempt %d); retrying in %d seconds" %
+                      (request["id"], attempt, delay))
+                self.in_flight.pop(msg.receipt_handle, None)
+                msg.change_visibility(delay)
+                return
+
+            respond()
+            self.dead_letter(msg, "failed %d time(s)" % attempt)
+            return
+
+        respond()
+        self.delete(msg)
+        return
+
+    def collect_results(self, timeout=None):
+        """
+        Send the responses for finished tasks, waiting up to timeout seconds
+        for the first one if timeout is not None.
+        """
+        try:
+            result = self.results.get(timeout is not None, timeout)
+        except Empty:
+            return
+
+        while True:
+            try:
+                self.finish_task(result)
+            except Exception as e:
+                # The task will be redelivered once its visibility times out.
+                print("Unable to finish task: %s" % (e,), file=stderr)
+                self.in_flight.pop(result[0].receipt_handle, None)
+
+            try:
+                result = self.results.get(False)
+            except Empty:
+                return
+
+    def receive(self):
+        """
+        Read the next request into self.pending.  Invalid requests are
+        answered (or dropped) immediately.  Returns False if every lane was
+        empty.
+        """
+        lanes = self.scheduler.order()
+        for i, lane in enumerate(lanes):
+            if i < len(lanes) - 1:
+                # Move on to the next lane rather than long polling.
+                wait_time = 0
+            else:
+                # Don't block on a long poll while tasks may be finishing.
+                wait_time = 1 if self.n_running > 0 else None
+            msgs = self.request_queues[lane].get_messages(
+                1, visibility_timeout=HEARTBEAT_VISIBILITY,
+                attributes="ApproximateReceiveCount",
+                wait_time_seconds=wait_time)
+            if msgs:
+                break
+        else:
+            self.scheduler.all_empty()
+            return False
+
+        self.scheduler.served(lane)
+        msg = msgs[0]
+        self.in_flight[msg.receipt_handle] = msg
+        try:
+            self.handle_message(msg)
+        except Exception:
+            # Let the message become visible again.
+            self.in_flight.pop(msg.receipt_handle, None)
+            raise
+        return True
+
+    def handle_message(self, msg):
+        """
+        Decode and validate a request message.  Valid requests are placed
+        in self.pending.
+        """
+        print("Message received: %r" % msg.get_body())
+
+        # SQS enforces the redrive policy itself; this covers queues created
+        # without one.
+        if get_receive_count(msg) > self.max_receive_count:
+            self.dead_letter(msg, "received %d times" % get_receive_count(msg))
+            return
+
+        try:
+            # Decode the message as JSON
+            request = json_loads(msg.get_body())
+            print("Message decoded: %r" % (request,))
+            if not isinstance(request, dict) or request.get("id") is None:
+                raise ValueError("Missing id in message")
         except ValueError as e:
             # Yikes.  Log this error and give up processing the message
             # (silently fail).
             print("Unable to decode message: %r" % (msg.get_body(),))
-            msg.delete()
-            
-    return 0
+            self.delete(msg)
+            return
+
+        err = self.validate(request)
+        if err is None and not self.allocator.fits_node(
+                request.get("cpus", 1), request.get("memory", 0)):
+            err = ("Task requires %d CPU(s) and %d MB; this node has %d "
+                   "CPU(s) and %d MB" % (
+                       request.get("cpus", 1), request.get("memory", 0),
+                       self.topology.n_cpus, self.allocator.total_memory))
+
+        if err is not None:
+            print(err)
+            self.send_response(request["id"], 127, "", err)
+            self.delete(msg)
+            return
+
+        if "array" in request:
+            request["array"].setdefault("start", 0)
+
+        if self.is_cancelled(request["id"]):
+            print("Task %s was cancelled" % (request["id"],))
+            if "array" in request:
+                # Answer for the whole range, unsplit.
+                n = request["array"]["stop"] - request["array"]["start"]
+                self.send_array_response(
+                    request, [CANCELLED_EXIT_CODE] * n, [""] * n, [""] * n,
+                    [CANCELLED] * n)
+            else:
+                self.send_response(request["id"], CANCELLED_EXIT_CODE, "",
+                                   "Task cancelled", CANCELLED)
+            self.delete(msg)
+            return
+
+        if "array" in request:
+            if len(split_array(request)) > 1:
+                self.split_array(msg, request)
+                return
+
+        self.pending = (msg, request)
+        return
+
+    def step(self):
+        """
+        Perform one iteration of the runner loop.  Returns False when the
+        runner should exit.
+        """
+        if self.interrupted:
+            if not self.requeued:
+                self.requeue_pending()
+            self.collect_results(timeout=SLEEP_TIME)
+            return self.n_running > 0
+
+        self.heartbeat()
+        self.check_cancellations()
+        self.collect_results()
+
+        if self.pending is None and not self.receive():
+            if self.n_running == 0:
+                if exit_requested:
+                    return False
+
+                # Don't exit just yet...
+                sleep(SLEEP_TIME)
+            return True
+
+        if self.pending is not None:
+            msg, request = self.pending
+            cpus = self.allocator.allocate(
+                request.get("cpus", 1), request.get("memory", 0))
+            if cpus is None:
+                # Wait for a running task to make room.
+                self.collect_results(timeout=SLEEP_TIME)
+                return True
+
+            self.pending = None
+            self.start_task(msg, request, cpus)
+
+        return True
+
+    def run(self):
+        # Keep reading tasks from the request queue.  A failure handling one
+        # message mustn't take down the runner (and its running tasks); the
+        # message becomes visible again and is eventually dead-lettered.
+        while True:
+            try:
+                if not self.step():
+                    break
+            except Exception as e:
+                print("Error processing tasks: %s" % (e,), file=stderr)
+                if self.pending is not None:
+                    self.in_flight.pop(self.pending[0].receipt_handle, None)
+                    self.pending = None
+                sleep(SLEEP_TIME)
+
+        return 0
+
+def run_tasks():
+    queue_id = environ.get("SLURM_EC2_QUEUE_ID")
+    if queue_id is None:
+        print("SLURM_EC2_QUEUE_ID environment variable not set", file=stderr)
+        return 1
+
+    # SLURM_EC2_LANE_POLICY selects weighted (the default) or strict
+    # priority between the lanes.
+    try:
+        runner = TaskRunner(get_sqs(), queue_id, lane_policy=environ.get(
+            "SLURM_EC2_LANE_POLICY", "weighted"))
+    except ValueError as e:
+        print(str(e), file=stderr)
+        return 1
+    if runner.request_queue is None:
+        print("Task queue %s does not exist" % (queue_id,), file=stderr)
+        return 1
+    print("CPU topology: %r" % (runner.topology,))
+
+    # On spot instances, hand tasks back to the queue and drain the node
+    # when EC2 announces an interruption.
+    if (get_metadata().get("instance-life-cycle") == "spot" or
+        "SLURM_EC2_METADATA_URL" in environ):
+        def on_interruption(notice):
+            runner.interrupt(notice)
+            drain_node()
+
+        SpotInterruptionWatcher(on_interruption).start()
+
+    # Handle a USR1 signal by setting the exit_requested flag -- we'll exit
+    # when we find no more tasks in the queue.
+    signal(SIGUSR1, request_exit)
+
+    return runner.run()
+
+def new_task_id():
+    return "task-%s" % "".join(["%02x" % ord(x) for x in urandom(10)])
+
+class TaskTimeout(Exception):
+    """
+    Raised when waiting for a task result times out.
+    """
+    pass
+
+class TaskFuture(object):
+    """
+    The pending result of a task submitted through a TaskClient.
+    """
+
+    def __init__(self, task_id):
+        self.id = task_id
+        self._response = None
+        self._done = Event()
+        self._callbacks = []
+        self._lock = Lock()
+        return
+
+    def __repr__(self):
+        return "<TaskFuture %s %s>" % (
+            self.id, "done" if self.done() else "pending")
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        future.result(timeout=None) -> dict
+
+        Wait for the task and return its response (a dict with the keys id,
+        exit_code, stdout, stderr and status: completed, timed_out or
+        cancelled).  Raises TaskTimeout if timeout seconds pass first.
+        """
+        if not self._done.wait(timeout):
+            raise TaskTimeout("Timed out waiting for task %s" % (self.id,))
+        return self._response
+
+    @property
+    def exit_code(self):
+        """
+        The exit code of the task (waiting for it to finish).
+        """
+        return self.result()["exit_code"]
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) when the task finishes (immediately if it already
+        has).  Callbacks run on the collector thread.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+        return
+
+    def set_result(self, response):
+        with self._lock:
+            self._response = response
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                print("Task callback failed: %s" % (e,), file=stderr)
+        return
+
+    def add_response(self, response):
+        """
+        Record a response for this task.  Returns True once the task is
+        complete.
+        """
+        self.set_result(response)
+        return True
+
+class ArrayTaskFuture(TaskFuture):
+    """
+    The pending result of an array task.  The result is a dict with the
+    keys id, exit_code (the first non-zero exit code, or 0), exit_codes (one
+    per index), status (see combine_statuses()), statuses (one per index)
+    and chunks (the chunk responses, in order; see get_array_outputs()).
+    """
+
+    def __init__(self, task_id, start, stop):
+        super(ArrayTaskFuture, self).__init__(task_id)
+        self.start = start
+        self.stop = stop
+        # Chunk responses by start index.  A chunk may be answered more
+        # than once if its message was redelivered.
+        self.chunks = {}
+        self.n_finished = 0
+        return
+
+    def add_response(self, response):
+        array = response.get("array")
+        if array is None:
+            # The whole array was rejected.
+            self.set_result(response)
+            return True
+
+        if array["start"] not in self.chunks:
+            self.chunks[array["start"]] = response
+            self.n_finished += array["stop"] - array["start"]
+
+        if self.n_finished < self.stop - self.start:
+            return False
+
+        chunks = [self.chunks[start] for start in sorted(self.chunks)]
+        exit_codes = []
+        statuses = []
+        for chunk in chunks:
+            chunk_exit_codes = decode_exit_codes(chunk["exit_codes"])
+            exit_codes.extend(chunk_exit_codes)
+            if chunk.get("statuses") is not None:
+                statuses.extend(decode_exit_codes(chunk["statuses"]))
+            else:
+                statuses.extend([chunk.get("status", COMPLETED)] *
+                                len(chunk_exit_codes))
+
+        self.set_result({
+            "id": self.id,
+            "exit_code": max(exit_codes, key=lambda code: code != 0),
+            "exit_codes": exit_codes,
+            "status": combine_statuses(statuses),
+            "statuses": statuses,
+            "chunks": chunks,
+        })
+        return True
+
+class TaskClient(object):
+    """
+    Submit tasks to a SLURM EC2 task queue and collect their results.
+
+        with TaskClient() as client:
+            futures = client.map([["echo", str(i)] for i in xrange(1000)])
+            for future in futures:
+                print(future.result()["stdout"])
+
+    Requests are sent over a single connection (ten per call when
+    submitted with map()).  A background collector thread, with its own
+    connection, reads the response queue and resolves the futures.
+    Responses for other clients' tasks are left on the queue for them.
+
+    Tasks go to the priority lane given by the priority argument of each
+    submission, or the client's default priority.
+
+    A task whose request is dead-lettered or lost never gets a response, so
+    waiting for it without a timeout blocks forever.  close_timeout limits
+    how long leaving a with block waits for outstanding tasks (by default,
+    indefinitely); TaskTimeout is raised if it passes.
+    """
+
+    # SQS limits for SendMessageBatch.
+    batch_size = 10
+    batch_bytes = 256 * 1024
+
+    def __init__(self, queue_id=None, priority=DEFAULT_PRIORITY,
+                 close_timeout=None):
+        """
+        TaskClient(queue_id=None, priority=DEFAULT_PRIORITY,
+                   close_timeout=None)
+
+        If queue_id is None, the SLURM_EC2_QUEUE_ID environment variable is
+        used.
+        """
+        if queue_id is None:
+            queue_id = environ.get("SLURM_EC2_QUEUE_ID")
+        if queue_id is None:
+            raise ValueError("SLURM_EC2_QUEUE_ID environment variable not set")
+
+        self.queue_id = queue_id
+        self.priority = priority
+        self.close_timeout = close_timeout
+        self._sqs = get_sqs()
+        self.request_queues = {}
+        self.request_queue = self.get_request_queue(DEFAULT_PRIORITY)
+        self.get_request_queue(priority)
+
+        self.futures = {}
+        # Ids of the tasks whose futures have been resolved, so redelivered
+        # responses for them are recognized as ours.
+        self.finished = set()
+        self.lock = Lock()
+        self._cancellations = None
+        self._closed = Event()
+        self._collector = Thread(target=self._collect,
+                                 name="TaskClientCollector")
+        self._collector.daemon = True
+        self._collector.start()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(wait=exc_type is None, timeout=self.close_timeout)
+        return False
+
+    @staticmethod
+    def make_request(task_id, cmd, env=None, cpus=None, memory=None,
+                     retries=None, timeout=None):
+        request = {"id": task_id, "cmd": list(cmd)}
+        for key, value in [("env", env), ("cpus", cpus), ("memory", memory),
+                           ("retries", retries), ("timeout", timeout)]:
+            if value is not None:
+                request[key] = value
+        return request
+
+    def get_request_queue(self, priority=None):
+        """
+        Returns the request queue for the given priority lane (by default,
+        the client's).
+        """
+        if priority is None:
+            priority = self.priority
+        queue = self.request_queues.get(priority)
+        if queue is None:
+            queue = self._sqs.get_queue(
+                get_request_queue_name(self.queue_id, priority))
+            if queue is None:
+                if priority == DEFAULT_PRIORITY:
+                    raise ValueError("Task queue %s does not exist" %
+                                     (self.queue_id,))
+                raise ValueError("Task queue %s has no %s priority lane" % (
+                    self.queue_id, priority))
+            self.request_queues[priority] = queue
+        return queue
+
+    def _register(self, request):
+        future = TaskFuture(request["id"])
+        with self.lock:
+            self.futures[request["id"]] = future
+        return future
+
+    def submit(self, cmd, env=None, cpus=None, memory=None, retries=None,
+               priority=None, timeout=None):
+        """
+        client.submit(cmd, env=None, cpus=None, memory=None, retries=None,
+                      priority=None, timeout=None) -> TaskFuture
+
+        Submit a single task.  The keyword arguments are the optional task
+        fields understood by TaskRunner; env defaults to the runner's
+        environment.
+        """
+        queue = self.get_request_queue(priority)
+        request = self.make_request(new_task_id(), cmd, env, cpus, memory,
+                                    retries, timeout)
+        future = self._register(request)
+        queue.write(queue.new_message(json_dumps(request)))
+        return future
+
+    def map(self, cmds, env=None, cpus=None, memory=None, retries=None,
+            priority=None, timeout=None):
+        """
+        client.map(cmds, env=None, cpus=None, memory=None, retries=None,
+                   priority=None, timeout=None) -> [TaskFuture]
+
+        Submit a task for each command line in cmds, sending them in
+        batches.  The futures are returned in the same order.
+        """
+        queue = self.get_request_queue(priority)
+        futures = []
+        batch = []
+        batch_bytes = 0
+
+        for cmd in cmds:
+            request = self.make_request(new_task_id(), cmd, env, cpus,
+                                        memory, retries, timeout)
+            # Bodies are base64-encoded like Queue.write() does, so runners
+            # decode them the same way.
+            body = Message(body=json_dumps(request)).get_body_encoded()
+            if batch and (len(batch) >= self.batch_size or
+                          batch_bytes + len(body) > self.batch_bytes):
+                self._send_batch(queue, batch)
+                batch = []
+                batch_bytes = 0
+
+            futures.append(self._register(request))
+            batch.append((str(len(batch)), body, 0))
+            batch_bytes += len(body)
+
+        if batch:
+            self._send_batch(queue, batch)
+        return futures
+
+    def submit_array(self, cmd, count=None, params=None, start=0,
+                     chunk=DEFAULT_ARRAY_CHUNK, env=None, cpus=None,
+                     memory=None, retries=None, output=None, priority=None,
+                     timeout=None):
+        """
+        client.submit_array(cmd, count=None, params=None, start=0,
+                            chunk=DEFAULT_ARRAY_CHUNK, env=None, cpus=None,
+                            memory=None, retries=None, output=None,
+                            priority=None, timeout=None) -> ArrayTaskFuture
+
+        Submit an array task running cmd for each index from start to
+        start + count, as a single message.  params is the URL (s3://...)
+        of a file with one parameter per line; if count is None, it is the
+        number of lines in the file.  chunk is the number of indices each
+        runner claims at a time.  See TaskRunner for the substitutions made
+        in cmd.  The array's parts stay in its lane.
+        """
+        queue = self.get_request_queue(priority)
+        if count is None:
+            if params is None:
+                raise ValueError("Either count or params must be specified")
+            count = len(read_url(params).splitlines()) - start
+
+        array = {"start": start, "stop": start + count, "chunk": chunk}
+        if params is not None:
+            array["params"] = params
+
+        request = self.make_request(new_task_id(), cmd, env, cpus, memory,
+                                    retries, timeout)
+        request["array"] = array
+        if output is not None:
+            request["output"] = output
+
+        future = ArrayTaskFuture(request["id"], array["start"],
+                                 array["stop"])
+        with self.lock:
+            self.futures[request["id"]] = future
+        queue.write(queue.new_message(json_dumps(request)))
+        return future
+
+    def _send_batch(self, queue, batch):
+        result = queue.write_batch(batch)
+        if result.errors:
+            # Resend the failed entries individually.
+            failed = set(error["id"] for error in result.errors)
+            for entry_id, body, delay in batch:
+                if entry_id in failed:
+                    msg = queue.new_message()
+                    msg.set_body(msg.decode(body))
+                    queue.write(msg)
+        return
+
+    def cancel(self, task):
+        """
+        Cancel a task (a TaskFuture or task id).  Runners stop it if it's
+        running and skip it otherwise; either way, its future resolves with
+        the status cancelled.
+        """
+        task_id = task.id if isinstance(task, TaskFuture) else task
+        if self._cancellations is None:
+            self._cancellations = TaskCancellations.for_queue(self.queue_id)
+        self._cancellations.cancel(task_id)
+        return
+
+    def wait(self, futures=None, timeout=None):
+        """
+        Wait for the given futures (by default, every outstanding one).
+        Raises TaskTimeout if they aren't all done within timeout seconds;
+        tasks which were dead-lettered or lost are never done.
+        """
+        if futures is None:
+            with self.lock:
+                futures = list(self.futures.values())
+
+        end = None if timeout is None else time() + timeout
+        for future in futures:
+            future.result(None if end is None else max(end - time(), 0))
+        return futures
+
+    @property
+    def n_outstanding(self):
+        with self.lock:
+            return len(self.futures)
+
+    def _collect(self):
+        # boto connections aren't thread-safe; the collector has its own.
+        response_queue = get_sqs().get_queue(
+            "slurm-%s-response" % self.queue_id)
+
+        while not self._closed.is_set():
+            try:
+                msgs = response_queue.get_messages(10, wait_time_seconds=20)
+            except Exception as e:
+                print("Unable to read task responses: %s" % (e,),
+                      file=stderr)
+                sleep(SLEEP_TIME)
+                continue
+
+            if not msgs:
+                continue
+
+            # Responses for our tasks (and undecodable ones, which no client
+            # can use) are deleted; the rest are made visible again for the
+            # clients waiting on them.
+            consumed = []
+            others = []
+            for msg in msgs:
+                try:
+                    response = json_loads(msg.get_body())
+                    task_id = response.get("id")
+                except (ValueError, AttributeError):
+                    print("Unable to decode response: %r" % (msg.get_body(),),
+                          file=stderr)
+                    consumed.append(msg)
+                    continue
+
+                with self.lock:
+                    future = self.futures.get(task_id)
+                    finished = task_id in self.finished
+                if future is not None:
+                    if future.add_response(response):
+                        with self.lock:
+                            self.futures.pop(task_id, None)
+                            self.finished.add(task_id)
+                    consumed.append(msg)
+                elif finished:
+                    # A redelivered response.
+                    consumed.append(msg)
+                else:
+                    others.append(msg)
+
+            if consumed:
+                try:
+                    response_queue.delete_message_batch(consumed)
+                except Exception as e:
+                    print("Unable to delete task responses: %s" % (e,),
+                          file=stderr)
+
+            if others:
+                try:
+                    response_queue.change_message_visibility_batch(
+                        [(msg, 0) for msg in others])
+                except Exception as e:
+                    print("Unable to return task responses: %s" % (e,),
+                          file=stderr)
+
+                if not consumed:
+                    # Don't spin receiving only other clients' responses.
+                    self._closed.wait(SLEEP_TIME)
+        return
+
+    def close(self, wait=True, timeout=None):
+        """
+        client.close(wait=True, timeout=None)
+
+        Stop the collector, first waiting for outstanding tasks if wait is
+        True.  If timeout is not None and they aren't all done within
+        timeout seconds, the collector is stopped anyway and TaskTimeout is
+        raised.
+        """
+        try:
+            if wait:
+                self.wait(timeout=timeout)
+        finally:
+            self._closed.set()
+        return
 
 def initialize_queue():
     queue_id = "".join(["%02x" % ord(x) for x in urandom(10)])
-    request_queue_name = "slurm-%s-request" % queue_id
     response_queue_name = "slurm-%s-response" % queue_id
+    dead_letter_queue_name = "slurm-%s-dead" % queue_id
     timeout = 43200
+    max_receive_count = MAX_RECEIVE_COUNT
 
     def usage():
         stderr.write("""\
-Usage: %s [--timeout=<timeout in seconds>]
+Usage: %s [--timeout=<timeout in seconds>] [--max-receive-count=<count>]
 Timeout must be an integer from 0 to 43200 (12 hours).
-""" % (argv[0],))
+Tasks delivered more than max-receive-count times (default %d) are moved to
+the dead-letter queue.  A request queue is created for each priority lane
+(%s).
+""" % (argv[0], MAX_RECEIVE_COUNT, ", ".join(PRIORITY_LANES)))
         return
 
     try:
-        opts, args = getopt(argv[1:], "t:", ["timeout="])
+        opts, args = getopt(argv[1:], "t:r:", ["timeout=",
+                                                "max-receive-count="])
     except GetoptError:
         usage()
         return 1
@@ -161,15 +1908,35 @@ Timeout must be an integer from 0 to 43200 (12 hours).
                 print("Invalid timeout value %r" % value, file=stderr)
                 usage()
                 return 1
+        elif opt in ("-r", "--max-receive-count"):
+            try:
+                max_receive_count = int(value)
+                if not (1 <= max_receive_count <= 1000):
+                    raise ValueError()
+            except ValueError:
+                print("Invalid max receive count %r" % value, file=stderr)
+                usage()
+                return 1
 
     sqs = get_sqs()
 
-    request_queue = sqs.create_queue(request_queue_name, timeout)
+    request_queues = [
+        sqs.create_queue(get_request_queue_name(queue_id, priority), timeout)
+        for priority in PRIORITY_LANES]
     response_queue = sqs.create_queue(response_queue_name, timeout)
+    dead_letter_queue = sqs.create_queue(dead_letter_queue_name, timeout)
+    dead_letter_queue.set_attribute("MessageRetentionPeriod",
+                                    DEAD_LETTER_RETENTION)
+    # Every lane shares the dead-letter queue.
+    for request_queue in request_queues:
+        request_queue.set_attribute("RedrivePolicy", json_dumps({
+            "maxReceiveCount": max_receive_count,
+            "deadLetterTargetArn": dead_letter_queue.arn,
+        }))
 
     try:
-        request_queue.set_attribute("ReceiveMessageWaitTimeSeconds", 20)
-        response_queue.set_attribute("ReceiveMessageWaitTimeSeconds", 20)
+        for queue in request_queues + [response_queue]:
+            queue.set_attribute("ReceiveMessageWaitTimeSeconds", 20)
     except Exception as e:
         # Ignore if unsupported
         pass
@@ -177,36 +1944,195 @@ Timeout must be an integer from 0 to 43200 (12 hours).
     print("export SLURM_EC2_QUEUE_ID=%s" % queue_id)
     return 0
 
+def get_priority_option(opts):
+    """
+    Returns the priority from --priority/-P in the parsed options, or
+    SLURM_EC2_TASK_PRIORITY, or DEFAULT_PRIORITY.
+    """
+    priority = environ.get("SLURM_EC2_TASK_PRIORITY", DEFAULT_PRIORITY)
+    for opt, value in opts:
+        if opt in ("-P", "--priority"):
+            priority = value
+    if priority not in PRIORITY_LANES:
+        raise ValueError("Invalid priority %r; expected one of %s" % (
+            priority, ", ".join(PRIORITY_LANES)))
+    return priority
+
+def get_timeout_option(opts):
+    """
+    Returns the timeout from --timeout/-t in the parsed options, or None.
+    """
+    timeout = None
+    for opt, value in opts:
+        if opt in ("-t", "--timeout"):
+            try:
+                timeout = float(value)
+                if timeout <= 0:
+                    raise ValueError()
+            except ValueError:
+                raise ValueError("Invalid timeout %r" % (value,))
+            if timeout == int(timeout):
+                timeout = int(timeout)
+    return timeout
+
 def submit_task():
     queue_id = environ.get("SLURM_EC2_QUEUE_ID")
-    task_id = "task-%s" % "".join(["%02x" % ord(x) for x in urandom(10)])
+    task_id = new_task_id()
+
+    def usage():
+        stderr.write("""\
+Usage: %s [--priority=<%s>] [--timeout=<seconds>]
+          [--] <command> [<args>...]
+The priority defaults to $SLURM_EC2_TASK_PRIORITY or %s.  A task still
+running after the timeout is killed.
+""" % (argv[0], "|".join(PRIORITY_LANES), DEFAULT_PRIORITY))
+        return
 
     if queue_id is None:
         print("SLURM_EC2_QUEUE_ID environment variable not set", file=stderr)
         return 1
 
-    request_queue_name = "slurm-%s-request" % queue_id
+    try:
+        # Options end at the command.
+        opts, args = getopt(argv[1:], "+P:t:", ["priority=", "timeout="])
+        priority = get_priority_option(opts)
+        timeout = get_timeout_option(opts)
+    except (GetoptError, ValueError) as e:
+        print(str(e), file=stderr)
+        usage()
+        return 1
+
+    sqs = get_sqs()
+    request_queue = sqs.get_queue(get_request_queue_name(queue_id, priority))
+    if request_queue is None:
+        print("Task queue %s has no %s priority lane" % (queue_id, priority),
+              file=stderr)
+        return 1
+    request = {
+        "id": task_id,
+        "cmd": args,
+        "env": dict(environ),
+    }
+    if timeout is not None:
+        request["timeout"] = timeout
+    request = request_queue.new_message(json_dumps(request))
+    request_queue.write(request)
+    print(task_id)
+    return 0
+
+def submit_array():
+    queue_id = environ.get("SLURM_EC2_QUEUE_ID")
+    task_id = new_task_id()
+    array = {"start": 0, "chunk": DEFAULT_ARRAY_CHUNK}
+
+    def usage():
+        stderr.write("""\
+Usage: %s [--count=<n>] [--params=<url>] [--start=<index>] [--chunk=<n>]
+          [--priority=<%s>] [--timeout=<seconds>] [--] <command> [<args>...]
+Submit a task running the command once for each index from start (default 0)
+to start + count.  {index} in the arguments is replaced with the index and
+{param} with that line of the params file (an S3 URL); count defaults to the
+number of lines in the file.  Runners claim chunk indices (default %d) at a
+time.  The priority defaults to $SLURM_EC2_TASK_PRIORITY or %s.  The timeout
+applies to each index.
+""" % (argv[0], "|".join(PRIORITY_LANES), DEFAULT_ARRAY_CHUNK,
+       DEFAULT_PRIORITY))
+        return
+
+    if queue_id is None:
+        print("SLURM_EC2_QUEUE_ID environment variable not set", file=stderr)
+        return 1
+
+    try:
+        # Options end at the command.
+        opts, args = getopt(argv[1:], "+n:p:s:c:P:t:", [
+            "count=", "params=", "start=", "chunk=", "priority=",
+            "timeout="])
+        priority = get_priority_option(opts)
+        timeout = get_timeout_option(opts)
+    except (GetoptError, ValueError) as e:
+        print(str(e), file=stderr)
+        usage()
+        return 1
+
+    count = None
+    try:
+        for opt, value in opts:
+            if opt in ("-n", "--count"):
+                count = int(value)
+            elif opt in ("-p", "--params"):
+                array["params"] = value
+            elif opt in ("-s", "--start"):
+                array["start"] = int(value)
+            elif opt in ("-c", "--chunk"):
+                array["chunk"] = int(value)
+    except ValueError:
+        print("Invalid value for %s: %r" % (opt, value), file=stderr)
+        usage()
+        return 1
+
+    if not args:
+        print("No command specified", file=stderr)
+        usage()
+        return 1
+
+    if count is None:
+        if "params" not in array:
+            print("Either --count or --params must be specified",
+                  file=stderr)
+            usage()
+            return 1
+        count = len(read_url(array["params"]).splitlines()) - array["start"]
+    array["stop"] = array["start"] + count
+
     sqs = get_sqs()
-    request_queue = sqs.get_queue(request_queue_name)
-    request = request_queue.new_message(json_dumps({
+    request_queue = sqs.get_queue(get_request_queue_name(queue_id, priority))
+    if request_queue is None:
+        print("Task queue %s has no %s priority lane" % (queue_id, priority),
+              file=stderr)
+        return 1
+    request = {
         "id": task_id,
-        "cmd": argv[1:],
+        "cmd": args,
         "env": dict(environ),
-    }))
+        "array": array,
+    }
+    if timeout is not None:
+        request["timeout"] = timeout
+    request = request_queue.new_message(json_dumps(request))
     request_queue.write(request)
     print(task_id)
     return 0
 
+def cancel_tasks():
+    queue_id = environ.get("SLURM_EC2_QUEUE_ID")
+    if queue_id is None:
+        print("SLURM_EC2_QUEUE_ID environment variable not set", file=stderr)
+        return 1
+
+    if len(argv) < 2 or argv[1].startswith("-"):
+        stderr.write("""\
+Usage: %s <task-id> [<task-id>...]
+Cancel tasks: running tasks are killed and queued tasks are skipped; both
+are reported with the status cancelled.  Runners notice within %d seconds.
+""" % (argv[0], CANCEL_POLL_INTERVAL))
+        return 1
+
+    cancellations = TaskCancellations.for_queue(queue_id)
+    for task_id in argv[1:]:
+        cancellations.cancel(task_id)
+        print("Cancelled %s" % (task_id,))
+    return 0
+
 def wait_tasks():
     queue_id = environ.get("SLURM_EC2_QUEUE_ID")
     if queue_id is None:
         print("SLURM_EC2_QUEUE_ID environment variable not set", file=stderr)
         return 1
     
-    request_queue_name = "slurm-%s-request" % queue_id
     response_queue_name = "slurm-%s-response" % queue_id
     sqs = get_sqs()
-    request_queue = sqs.get_queue(request_queue_name)
+    request_queues = get_request_queues(sqs, queue_id)
     response_queue = sqs.get_queue(response_queue_name)
 
     times_empty = 0
@@ -215,9 +2141,13 @@ def wait_tasks():
         msg = response_queue.read()
         if msg is None:
             # Are there pending requests?
-            attrs = request_queue.get_attributes()
-            in_flight = (int(attrs['ApproximateNumberOfMessages']) +
-                         int(attrs['ApproximateNumberOfMessagesNotVisible']))
+            lane_counts = []
+            for priority, request_queue in request_queues:
+                attrs = request_queue.get_attributes()
+                lane_counts.append((priority, (
+                    int(attrs['ApproximateNumberOfMessages']) +
+                    int(attrs['ApproximateNumberOfMessagesNotVisible']))))
+            in_flight = sum(count for priority, count in lane_counts)
 
             if in_flight == 0:
                 times_empty += 1
@@ -238,8 +2168,9 @@ def wait_tasks():
                       ((MAX_TIMES_EMPTY - times_empty) *
                        (SLEEP_TIME + long_poll_time)))
             else:
-                print("%s task(s) in flight, but none are ready" %
-                      (in_flight,))
+                print("%s task(s) in flight (%s), but none are ready" % (
+                    in_flight, ", ".join(["%s: %d" % lane_count
+                                          for lane_count in lane_counts])))
 
             sleep(SLEEP_TIME)
             continue
@@ -251,6 +2182,11 @@ def wait_tasks():
             response = json_loads(msg.get_body())
             id = response.get("id")
             exit_code = response.get("exit_code")
+            status = response.get("status", COMPLETED)
+            if response.get("array") is not None:
+                # One response per chunk of an array task.
+                id = "%s-%d-%d" % (id, response["array"]["start"],
+                                   response["array"]["stop"])
 
             log_dirs = [".", environ["HOME"], "/tmp", "/var/tmp"]
 
@@ -269,13 +2205,35 @@ def wait_tasks():
             fd.write(msg.get_body())
             fd.close()
             
-            print("Task %s finished with exit code %s; logged to %s" %
-                  (id, exit_code, filename))
+            if status == COMPLETED:
+                print("Task %s finished with exit code %s; logged to %s" %
+                      (id, exit_code, filename))
+            else:
+                print("Task %s %s (exit code %s); logged to %s" % (
+                    id, status.replace("_", " "), exit_code, filename))
         except:
             pass
         
         msg.delete()
 
-    sqs.delete_queue(request_queue)
+    for priority, request_queue in request_queues:
+        sqs.delete_queue(request_queue)
     sqs.delete_queue(response_queue)
+
+    try:
+        TaskCancellations.for_queue(queue_id).clear()
+    except Exception as e:
+        print("Unable to remove task cancellations: %s" % (e,), file=stderr)
+
+    # Keep the dead-letter queue for inspection if anything ended up there.
+    dead_letter_queue = sqs.get_queue("slurm-%s-dead" % queue_id)
+    if dead_letter_queue is not None:
+        attrs = dead_letter_queue.get_attributes()
+        n_dead = (int(attrs['ApproximateNumberOfMessages']) +
+                  int(attrs['ApproximateNumberOfMessagesNotVisible']))
+        if n_dead > 0:
+            print("%d task(s) failed repeatedly; see SQS queue %s" % (
+                n_dead, dead_letter_queue.name))
+            return 1
+        sqs.delete_queue(dead_letter_queue)
     return 0
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+import boto.s3
+from .fetch import parallel_map, parse_s3_url
+from .instanceinfo import get_metadata, get_region
+from .ratelimit import connect_ec2
+from json import dumps as json_dumps, loads as json_loads
+from sys import stderr
+from time import time
+
+"""
+Timing of the node bootstrap.
+
+slurm-ec2-bootstrap wraps each of its phases with phase_begin/phase_end,
+which append one JSON record per phase to BOOTSTRAP_TRACE_FILENAME:
+    {"run": <bootstrap start>, "phase": <name>, "start": <time>,
+     "end": <time>, "status": <exit status>}
+
+When the bootstrap exits, "slurm-ec2-trace publish" summarizes the latest
+run and uploads it to <slurm_s3_root>/bootstrap-trace/<instance id>.json
+(and a short form to the instance's BOOTSTRAP_TRACE_TAG tag);
+"slurm-ec2-trace report" aggregates the published summaries.
+"""
+
+BOOTSTRAP_TRACE_FILENAME = "/var/log/slurm-ec2-bootstrap-trace.json"
+
+# Summaries are published under this prefix of the SLURM S3 root.
+BOOTSTRAP_TRACE_PREFIX = "bootstrap-trace"
+
+BOOTSTRAP_TRACE_TAG = "SLURMBootstrap"
+
+# EC2 limits tag values to this many characters.
+MAX_TAG_VALUE_LENGTH = 255
+
+# Percentiles shown by the report.
+REPORT_PERCENTILES = (50, 90)
+
+def read_trace(filename=BOOTSTRAP_TRACE_FILENAME):
+    """
+    read_trace(filename=BOOTSTRAP_TRACE_FILENAME) -> [record]
+
+    Returns the phase records of the most recent bootstrap run in the trace
+    file, in the order they finished.  Unparseable lines are ignored.
+    """
+    records = []
+    with open(filename, "r") as fd:
+        for line in fd:
+            try:
+                record = json_loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "phase" in record:
+                records.append(record)
+
+    if not records:
+        return []
+
+    run = max(record.get("run", 0) for record in records)
+    return [record for record in records if record.get("run", 0) == run]
+
+def summarize_trace(records, status=None):
+    """
+    summarize_trace(records, status=None) -> dict
+
+    Summarize the phase records of a bootstrap run.  status is the exit
+    status of the bootstrap; if unspecified, it's the status of the first
+    failed phase (or 0).
+    """
+    phases = []
+    failed_phase = None
+    for record in records:
+        duration = round(max(record["end"] - record["start"], 0.0), 3)
+        phases.append({"phase": record["phase"], "duration": duration,
+                       "status": record.get("status", 0)})
+        if record.get("status", 0) != 0 and failed_phase is None:
+            failed_phase = record["phase"]
+
+    if status is None:
+        status = 1 if failed_phase is not None else 0
+
+    if records:
+        run = records[0].get("run", records[0]["start"])
+        end = max(record["end"] for record in records)
+        total = round(max(end - run, 0.0), 3)
+    else:
+        run = total = None
+
+    return {
+        "run": run,
+        "total": total,
+        "status": status,
+        "failed_phase": failed_phase,
+        "phases": phases,
+    }
+
+def format_tag_value(summary):
+    """
+    Returns a one-line form of the summary for the instance tag, e.g.
+    "ok 312.4s; os-update 140.2s, python-packages 61.0s, ...", listing
+    the slowest phases first and truncated to fit a tag value.
+    """
+    if summary["status"] == 0:
+        result = "ok"
+    elif summary["failed_phase"] is not None:
+        result = "failed (%s)" % summary["failed_phase"]
+    else:
+        result = "failed (status %d)" % summary["status"]
+
+    if summary["total"] is not None:
+        result += " %.1fs" % summary["total"]
+
+    phases = sorted(summary["phases"], key=lambda p: -p["duration"])
+    parts = ["%s %.1fs" % (p["phase"], p["duration"]) for p in phases]
+    if parts:
+        result += "; "
+        while parts:
+            part = parts.pop(0)
+            if len(result) + len(part) + 2 > MAX_TAG_VALUE_LENGTH:
+                break
+            result += part + (", " if parts else "")
+    return result.rstrip(", ")[:MAX_TAG_VALUE_LENGTH]
+
+def get_trace_bucket(slurm_s3_root, region=None):
+    """
+    get_trace_bucket(slurm_s3_root, region=None) -> (bucket, prefix)
+
+    Returns the S3 bucket and key prefix (ending in "/") holding the
+    published bootstrap summaries.
+    """
+    if region is None:
+        region = get_region()
+    bucket_name, prefix = parse_s3_url(slurm_s3_root)
+    s3 = boto.s3.connect_to_region(region)
+    if s3 is None:
+        raise ValueError("Unable to connect to S3 endpoint in region %r" %
+                         (region,))
+    prefix = "/".join(filter(None, [prefix.strip("/"),
+                                    BOOTSTRAP_TRACE_PREFIX])) + "/"
+    return s3.get_bucket(bucket_name, validate=False), prefix
+
+def publish_summary(summary, slurm_s3_root=None, region=None, tag=True):
+    """
+    Add this instance's identity to the summary and publish it to S3 and the
+    instance's tags.  Either destination may be skipped by passing
+    slurm_s3_root=None or tag=False.  Returns the number of failures.
+    """
+    metadata = get_metadata()
+    instance_id = metadata["instance-id"]
+    if region is None:
+        region = get_region()
+
+    summary = dict(summary)
+    summary.update({
+        "instance_id": instance_id,
+        "instance_type": metadata.get("instance-type"),
+        "availability_zone": metadata.get("placement", {}).get(
+            "availability-zone"),
+        "published": time(),
+    })
+
+    failures = 0
+    if slurm_s3_root is not None:
+        try:
+            bucket, prefix = get_trace_bucket(slurm_s3_root, region)
+            bucket.new_key(prefix + instance_id + ".json").\
+                set_contents_from_string(
+                    json_dumps(summary, sort_keys=True) + "\n")
+        except Exception as e:
+            print("Unable to upload bootstrap trace: %s" % (e,), file=stderr)
+            failures += 1
+
+    if tag:
+        try:
+            ec2 = connect_ec2(region)
+            if ec2 is None:
+                raise ValueError("Could not connect to EC2 endpoint in "
+                                 "region %r" % (region,))
+            ec2.create_tags([instance_id],
+                            {BOOTSTRAP_TRACE_TAG: format_tag_value(summary)})
+        except Exception as e:
+            print("Unable to tag instance with bootstrap trace: %s" % (e,),
+                  file=stderr)
+            failures += 1
+
+    return failures
+
+def load_summaries(slurm_s3_root, region=None, since=None):
+    """
+    load_summaries(slurm_s3_root, region=None, since=None) -> [summary]
+
+    Download the published bootstrap summaries, optionally only those
+    published at or after since (a time in seconds since the epoch).
+    """
+    bucket, prefix = get_trace_bucket(slurm_s3_root, region)
+    keys = [key for key in bucket.list(prefix=prefix)
+            if key.name.endswith(".json")]
+
+    def load(key):
+        try:
+            return json_loads(key.get_contents_as_string())
+        except Exception as e:
+            print("Unable to read %s: %s" % (key.name, e), file=stderr)
+            return None
+
+    summaries = [summary for summary in parallel_map(load, keys)
+                 if isinstance(summary, dict)]
+    if since is not None:
+        summaries = [summary for summary in summaries
+                     if summary.get("published", 0) >= since]
+    return summaries
+
+def percentile(values, pct):
+    """
+    Returns the pct'th percentile (nearest rank) of the sorted list values.
+    """
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def aggregate_summaries(summaries, group_by=None):
+    """
+    aggregate_summaries(summaries, group_by=None) -> {group: {phase: stats}}
+
+    Aggregate phase durations across bootstrap summaries.  group_by names a
+    summary field (e.g. "instance_type") to report separately; otherwise
+    every summary is in the group None.  The whole bootstrap is reported as
+    the phase "total".  stats is {"n", "failed", "mean", "max", "p<pct>"}.
+    """
+    durations = {}
+    failures = {}
+    for summary in summaries:
+        group = summary.get(group_by) if group_by is not None else None
+        phases = durations.setdefault(group, {})
+        group_failures = failures.setdefault(group, {})
+        for phase in summary.get("phases", []):
+            phases.setdefault(phase["phase"], []).append(phase["duration"])
+            if phase.get("status", 0) != 0:
+                group_failures[phase["phase"]] = (
+                    group_failures.get(phase["phase"], 0) + 1)
+        if summary.get("total") is not None:
+            phases.setdefault("total", []).append(summary["total"])
+            if summary.get("status", 0) != 0:
+                group_failures["total"] = group_failures.get("total", 0) + 1
+
+    result = {}
+    for group, phases in durations.items():
+        result[group] = {}
+        for phase, values in phases.items():
+            values.sort()
+            stats = {
+                "n": len(values),
+                "failed": failures[group].get(phase, 0),
+                "mean": sum(values) / len(values),
+                "max": values[-1],
+            }
+            for pct in REPORT_PERCENTILES:
+                stats["p%d" % pct] = percentile(values, pct)
+            result[group][phase] = stats
+    return result
+
+def print_report(aggregate):
+    pct_columns = ["p%d" % pct for pct in REPORT_PERCENTILES]
+    header = "%-24s %6s %6s %9s " % ("phase", "n", "failed", "mean")
+    header += " ".join("%9s" % column for column in pct_columns)
+    header += " %9s" % "max"
+
+    for group in sorted(aggregate):
+        if group is not None:
+            print("%s:" % (group,))
+        print(header)
+        # Slowest phases (by mean) first, with the total last.
+        phases = aggregate[group]
+        for phase in sorted(phases, key=lambda p: (p == "total",
+                                                   -phases[p]["mean"])):
+            stats = phases[phase]
+            line = "%-24s %6d %6d %9.1f " % (
+                phase, stats["n"], stats["failed"], stats["mean"])
+            line += " ".join("%9.1f" % stats[column]
+                             for column in pct_columns)
+            line += " %9.1f" % stats["max"]
+            print(line)
+        print()
+    return
+
+def main():
+    from argparse import ArgumentParser
+    from .clusterconfig import ClusterConfiguration
+
+    parser = ArgumentParser(
+        description="Publish or report on node bootstrap phase timings.")
+    parser.add_argument(
+        "--slurm-s3-root", "-S",
+        help=("The SLURM S3 root holding the bootstrap summaries.  Defaults "
+              "to the slurm_s3_root in %s." %
+              ClusterConfiguration.default_config_filename))
+    parser.add_argument(
+        "--region", "-r",
+        help=("The AWS region to use.  If unspecified, the region of the "
+              "current instance is used."))
+    subparsers = parser.add_subparsers(dest="command")
+
+    publish_parser = subparsers.add_parser(
+        "publish", help="Publish a summary of this node's last bootstrap.")
+    publish_parser.add_argument(
+        "--trace", default=BOOTSTRAP_TRACE_FILENAME,
+        help=("The bootstrap trace file.  Defaults to %s." %
+              BOOTSTRAP_TRACE_FILENAME))
+    publish_parser.add_argument(
+        "--status", type=int,
+        help=("The bootstrap's exit status.  Defaults to that of the first "
+              "failed phase."))
+    publish_parser.add_argument(
+        "--no-tag", action="store_true", default=False,
+        help=("Don't tag the instance with the summary."))
+
+    report_parser = subparsers.add_parser(
+        "report", help="Aggregate phase durations across published nodes.")
+    report_parser.add_argument(
+        "--since", type=float, metavar="HOURS",
+        help=("Only include nodes which published in the last HOURS hours."))
+    report_parser.add_argument(
+        "--by-instance-type", action="store_true", default=False,
+        help=("Report each instance type separately."))
+    report_parser.add_argument(
+        "--failed", action="store_true", default=False,
+        help=("List the nodes whose bootstrap failed."))
+    args = parser.parse_args()
+
+    slurm_s3_root = args.slurm_s3_root
+    if slurm_s3_root is None:
+        try:
+            slurm_s3_root = ClusterConfiguration.from_config().slurm_s3_root
+        except Exception as e:
+            if args.command != "publish":
+                print("Unable to determine the SLURM S3 root: %s" % (e,),
+                      file=stderr)
+                return 1
+            print("Not uploading bootstrap trace: %s" % (e,), file=stderr)
+
+    if args.command == "publish":
+        try:
+            records = read_trace(args.trace)
+        except IOError as e:
+            print("Unable to read %s: %s" % (args.trace, e), file=stderr)
+            return 1
+
+        summary = summarize_trace(records, args.status)
+        print(format_tag_value(summary))
+        if publish_summary(summary, slurm_s3_root, args.region,
+                           tag=not args.no_tag) > 0:
+            return 1
+        return 0
+
+    since = (time() - args.since * 3600) if args.since is not None else None
+    summaries = load_summaries(slurm_s3_root, args.region, since)
+    print("%d node(s)" % len(summaries))
+    print()
+    print_report(aggregate_summaries(
+        summaries, "instance_type" if args.by_instance_type else None))
+
+    if args.failed:
+        for summary in sorted(summaries,
+                              key=lambda s: s.get("published", 0)):
+            if summary.get("status", 0) != 0:
+                print("%s %s failed in %s" % (
+                    summary.get("instance_id"), summary.get("instance_type"),
+                    summary.get("failed_phase") or
+                    "status %s" % summary.get("status")))
+    return 0
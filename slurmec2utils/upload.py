@@ -0,0 +1,171 @@
+#!/usr/bin/python
+from __future__ import absolute_import, print_function
+import boto.s3
+from .fetch import MAX_WORKERS, parallel_map, parse_s3_url
+from .instanceinfo import get_region
+from os import kill, lstat, walk
+from os.path import join as path_join, relpath
+from signal import signal, SIGINT, SIGTERM
+from stat import S_ISREG
+from sys import stderr
+from threading import Event, local
+from time import time
+
+# Seconds between scans of the output directory.
+DEFAULT_INTERVAL = 10
+
+# Files not modified for this many seconds are considered complete.
+DEFAULT_SETTLE_TIME = 30
+
+class OutputUploader(object):
+    """
+    Upload files from a directory to an S3 prefix while they are still being
+    produced.
+
+    Each scan uploads, in parallel, the files which haven't been modified
+    for settle_time seconds and which have changed since they were last
+    uploaded.  Once the writer has finished, finish() uploads everything
+    that remains, so only the tail of the output is uploaded after compute
+    ends.
+    """
+
+    def __init__(self, directory, url, settle_time=DEFAULT_SETTLE_TIME,
+                 max_workers=MAX_WORKERS, region=None):
+        self.directory = directory
+        self.bucket_name, self.prefix = parse_s3_url(url)
+        if self.prefix and not self.prefix.endswith("/"):
+            self.prefix += "/"
+        self.settle_time = settle_time
+        self.max_workers = max_workers
+        self.region = region if region is not None else get_region()
+        # Relative path -> (size, mtime) as uploaded.
+        self.uploaded = {}
+        self._local = local()
+        return
+
+    @property
+    def bucket(self):
+        """
+        The S3 bucket for the current thread (boto connections are not
+        thread-safe).
+        """
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is None:
+            s3 = boto.s3.connect_to_region(self.region)
+            if s3 is None:
+                raise ValueError("Unable to connect to S3 endpoint in region "
+                                 "%r" % (self.region,))
+            bucket = self._local.bucket = s3.get_bucket(
+                self.bucket_name, validate=False)
+        return bucket
+
+    def get_changed(self, settled_only=True):
+        """
+        Returns [(relative path, (size, mtime))] for the files which need to
+        be uploaded.
+        """
+        now = time()
+        result = []
+        for dirpath, dirnames, filenames in walk(self.directory):
+            for filename in filenames:
+                path = path_join(dirpath, filename)
+                try:
+                    st = lstat(path)
+                except OSError:
+                    continue
+
+                if not S_ISREG(st.st_mode):
+                    continue
+                if settled_only and now - st.st_mtime < self.settle_time:
+                    continue
+
+                name = relpath(path, self.directory)
+                state = (st.st_size, st.st_mtime)
+                if self.uploaded.get(name) != state:
+                    result.append((name, state))
+        return result
+
+    def upload(self, item):
+        name, state = item
+        key = self.bucket.new_key(self.prefix + name)
+        try:
+            key.set_contents_from_filename(path_join(self.directory, name))
+        except Exception as e:
+            print("Unable to upload %s: %s" % (name, e), file=stderr)
+            return False
+
+        self.uploaded[name] = state
+        print("Uploaded %s" % (name,))
+        return True
+
+    def scan(self, settled_only=True):
+        """
+        Upload the changed files.  Returns the number of uploads which
+        failed.
+        """
+        results = parallel_map(self.upload, self.get_changed(settled_only),
+                               self.max_workers)
+        return len([result for result in results if not result])
+
+    def finish(self):
+        """
+        Upload every remaining file.  Returns the number of uploads which
+        failed.
+        """
+        return self.scan(settled_only=False)
+
+def _process_exists(pid):
+    try:
+        kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description=("Upload output files to S3 as they are completed.  On "
+                     "SIGTERM (or when --pid exits), upload the remaining "
+                     "files and exit."))
+    parser.add_argument(
+        "--interval", "-i", type=float, default=DEFAULT_INTERVAL,
+        help=("Seconds between scans.  Defaults to %d." % DEFAULT_INTERVAL))
+    parser.add_argument(
+        "--settle-time", "-s", type=float, default=DEFAULT_SETTLE_TIME,
+        help=("Upload files once they haven't been modified for this many "
+              "seconds.  Defaults to %d." % DEFAULT_SETTLE_TIME))
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=MAX_WORKERS,
+        help=("The number of concurrent uploads.  Defaults to %d." %
+              MAX_WORKERS))
+    parser.add_argument(
+        "--pid", "-p", type=int,
+        help=("Finish when the given process exits."))
+    parser.add_argument(
+        "--region", "-r",
+        help=("The AWS region to use.  If unspecified, the region of the "
+              "current instance is used."))
+    parser.add_argument("directory")
+    parser.add_argument("url", metavar="s3-url")
+    args = parser.parse_args()
+
+    uploader = OutputUploader(args.directory, args.url,
+                              settle_time=args.settle_time,
+                              max_workers=args.jobs, region=args.region)
+
+    finished = Event()
+    signal(SIGTERM, lambda *args: finished.set())
+    signal(SIGINT, lambda *args: finished.set())
+
+    # Failures during a scan are retried on the next one; only the final
+    # pass decides the exit status.
+    while not finished.is_set():
+        if args.pid is not None and not _process_exists(args.pid):
+            break
+        uploader.scan()
+        finished.wait(args.interval)
+
+    if uploader.finish() > 0:
+        return 1
+    return 0